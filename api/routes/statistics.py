@@ -3,7 +3,9 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, func
 from database.database import get_session
 from database.models import User, Video, Deposit, Withdrawal
+from database.crud import get_cache_stats, get_encode_stat_aggregates
 from pydantic import BaseModel
+from typing import List, Optional
 
 
 class StatisticsResponse(BaseModel):
@@ -20,6 +22,28 @@ class StatisticsResponse(BaseModel):
     pending_withdrawals: int
 
 
+class CacheStatisticsResponse(BaseModel):
+    hits: int
+    misses: int
+    hit_rate: float
+    entries: int
+    size_bytes: int
+
+
+class EncodeStatisticsResponse(BaseModel):
+    job: str
+    input_height: Optional[int]
+    jobs: int
+    avg_fps: Optional[float]
+    avg_speed: Optional[float]
+    avg_bitrate_kbps: Optional[float]
+    encode_seconds: float
+    input_seconds: float
+    seconds_per_input_minute: Optional[float]
+    dropped_frames: int
+    duplicated_frames: int
+
+
 router = APIRouter(prefix="/statistics", tags=["Statistics"])
 
 
@@ -76,3 +100,15 @@ async def get_statistics(session: AsyncSession = Depends(get_session)):
         pending_deposits=pending_deposits.scalar() or 0,
         pending_withdrawals=pending_withdrawals.scalar() or 0
     )
+
+
+@router.get("/cache", response_model=CacheStatisticsResponse)
+async def get_cache_statistics(session: AsyncSession = Depends(get_session)):
+    """Get result cache statistics"""
+    return CacheStatisticsResponse(**await get_cache_stats(session))
+
+
+@router.get("/encodes", response_model=List[EncodeStatisticsResponse])
+async def get_encode_statistics(session: AsyncSession = Depends(get_session)):
+    """Get ffmpeg encode statistics per job and input height"""
+    return [EncodeStatisticsResponse(**row) for row in await get_encode_stat_aggregates(session)]
@@ -21,6 +21,7 @@ class TariffPlanResponse(BaseModel):
     description: str | None
     videos_per_day: int
     videos_per_order: int
+    cpu_seconds_per_day: float | None = 0.0
     price: float
     is_active: bool
     
@@ -33,6 +34,7 @@ class TariffPlanCreate(BaseModel):
     description: str | None = None
     videos_per_day: int = 10
     videos_per_order: int = 5
+    cpu_seconds_per_day: float = 0.0
     price: float = 0.0
 
 
@@ -41,6 +43,7 @@ class TariffPlanUpdate(BaseModel):
     description: str | None = None
     videos_per_day: int | None = None
     videos_per_order: int | None = None
+    cpu_seconds_per_day: float | None = None
     price: float | None = None
     is_active: bool | None = None
 
@@ -88,7 +91,8 @@ async def create_plan(
         description=plan_data.description,
         videos_per_day=plan_data.videos_per_day,
         videos_per_order=plan_data.videos_per_order,
-        price=plan_data.price
+        price=plan_data.price,
+        cpu_seconds_per_day=plan_data.cpu_seconds_per_day
     )
     return plan
 
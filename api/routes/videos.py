@@ -1,8 +1,8 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
+from sqlalchemy import select, func, delete
 from database.database import get_session
-from database.models import Video
+from database.models import Video, EncodeStat
 from typing import List
 from pydantic import BaseModel
 from datetime import datetime
@@ -99,6 +99,7 @@ async def delete_video(
     if not video:
         raise HTTPException(status_code=404, detail="Video not found")
     
+    await session.execute(delete(EncodeStat).where(EncodeStat.video_id == video_id))
     await session.delete(video)
     await session.commit()
     return {"message": "Video deleted successfully"}
@@ -10,9 +10,11 @@ import os
 
 from config import settings
 from database.database import init_db, get_session
+from database.crud import get_encode_stat_aggregates, get_encode_stats_by_video
 from database.models import User, Video, Deposit, Withdrawal, Setting, TariffPlan
 from api.routes import users, videos, deposits, withdrawals, settings as settings_route, statistics, tariff_plans
 from api.auth import create_access_token, require_admin
+from utils.metrics import CONTENT_TYPE, REGISTRY
 
 
 @asynccontextmanager
@@ -50,6 +52,12 @@ async def root():
     return RedirectResponse(url="/admin")
 
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics of the API process (database timings); the bot exports its own"""
+    return Response(content=REGISTRY.render(), headers={"Content-Type": CONTENT_TYPE})
+
+
 @app.get("/login", response_class=HTMLResponse)
 async def login_page(request: Request, error: str = None):
     """Login page"""
@@ -102,15 +110,17 @@ async def admin_dashboard(
 ):
     """Admin dashboard page"""
     # Get statistics
-    from api.routes.statistics import get_statistics
+    from api.routes.statistics import get_statistics, get_cache_statistics
     stats = await get_statistics(session)
+    cache_stats = await get_cache_statistics(session)
     
     return templates.TemplateResponse(
         "dashboard.html",
         {
             "request": request,
             "active_page": "dashboard",
-            "stats": stats
+            "stats": stats,
+            "cache_stats": cache_stats
         }
     )
 
@@ -147,13 +157,17 @@ async def admin_videos(
     """Videos management page"""
     result = await session.execute(select(Video).limit(100))
     videos_list = result.scalars().all()
+    encode_stats = await get_encode_stats_by_video(session, [video.id for video in videos_list])
+    encode_aggregates = await get_encode_stat_aggregates(session)
     
     return templates.TemplateResponse(
         "videos.html",
         {
             "request": request,
             "active_page": "videos",
-            "videos": videos_list
+            "videos": videos_list,
+            "encode_stats": encode_stats,
+            "encode_aggregates": encode_aggregates
         }
     )
 
@@ -0,0 +1,321 @@
+"""
+In-memory stand-in for the Telegram Bot API, used by the load test.
+
+Serves the methods the bot calls (getUpdates, sendMessage, editMessageText, sendVideo,
+getFile, file downloads, ...) on a local aiohttp server. Simulated users push updates
+with send_text(), send_video() and press(); everything the bot sends to a chat is kept
+as an event log the users wait on. Downloads and uploads can be slowed down to a given
+bandwidth, and their durations are recorded per stage.
+"""
+import asyncio
+import itertools
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+BOT_USER = {'id': 100000, 'is_bot': True, 'first_name': 'Load Test Bot', 'username': 'load_test_bot'}
+
+
+class ChatLog:
+    """Messages the bot sent or edited in one chat, as (seq, message) events"""
+
+    def __init__(self):
+        self.events: List[tuple] = []
+        # message_id -> (seq of its last change, current version)
+        self.messages: Dict[int, tuple] = {}
+        self.changed = asyncio.Condition()
+
+    async def record(self, message: dict):
+        async with self.changed:
+            seq = len(self.events) + 1
+            self.messages[message['message_id']] = (seq, message)
+            self.events.append((seq, message))
+            self.changed.notify_all()
+
+
+def _buttons(message: dict) -> List[str]:
+    markup = message.get('reply_markup') or {}
+    return [button.get('callback_data') for row in markup.get('inline_keyboard', []) for button in row]
+
+
+class FakeBotAPI:
+    def __init__(self, download_mbps: float = 0, upload_mbps: float = 0):
+        self.download_mbps = download_mbps
+        self.upload_mbps = upload_mbps
+        self.files: Dict[str, dict] = {}
+        self.chats: Dict[int, ChatLog] = defaultdict(ChatLog)
+        self.updates: List[dict] = []
+        self.updates_added = asyncio.Condition()
+        self.timings: Dict[str, List[float]] = defaultdict(list)
+        self.uploaded_bytes = 0
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ''
+
+    # -- server -------------------------------------------------------------
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        app = web.Application(client_max_size=4 * 1024 ** 3)
+        app.router.add_post('/bot{token}/{method}', self._handle_method)
+        app.router.add_get('/file/bot{token}/{path:.+}', self._handle_file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://{host}:{port}'
+        return self.url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _throttle(self, size: int, mbps: float):
+        if mbps > 0:
+            await asyncio.sleep(size * 8 / (mbps * 1_000_000))
+
+    async def _handle_file(self, request: web.Request) -> web.StreamResponse:
+        start = time.perf_counter()
+        entry = self.files.get(request.match_info['path'])
+        if not entry:
+            raise web.HTTPNotFound()
+        await self._throttle(entry['size'], self.download_mbps)
+        response = web.FileResponse(entry['path'])
+        await response.prepare(request)
+        self.timings['download'].append(time.perf_counter() - start)
+        return response
+
+    async def _handle_method(self, request: web.Request) -> web.Response:
+        start = time.perf_counter()
+        method = request.match_info['method'].lower()
+        form = await request.post()
+        params = {}
+        uploaded = 0
+        for key, value in form.items():
+            if isinstance(value, web.FileField):
+                uploaded += len(value.file.read())
+                continue
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+
+        handler = getattr(self, f'_api_{method}', None)
+        result = await handler(params, uploaded) if handler else True
+        if uploaded:
+            self.uploaded_bytes += uploaded
+            self.timings['upload'].append(time.perf_counter() - start)
+        return web.json_response({'ok': True, 'result': result})
+
+    # -- Bot API methods ----------------------------------------------------
+
+    async def _api_getme(self, params, uploaded):
+        return BOT_USER
+
+    async def _api_getupdates(self, params, uploaded):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+
+        def pending():
+            return [update for update in self.updates if update['update_id'] >= offset]
+
+        async with self.updates_added:
+            # Confirmed updates are not needed anymore
+            self.updates = pending()
+            if not self.updates and timeout:
+                try:
+                    await asyncio.wait_for(self.updates_added.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return pending()[:100]
+
+    def _message(self, chat_id: int, params: dict, **fields) -> dict:
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+        }
+        # Only inline keyboards are attached to the returned message, as Telegram does
+        markup = params.get('reply_markup')
+        if markup and 'inline_keyboard' in markup:
+            message['reply_markup'] = markup
+        message.update(fields)
+        return message
+
+    async def _api_sendmessage(self, params, uploaded):
+        message = self._message(int(params['chat_id']), params, text=params.get('text', ''))
+        await self.chats[message['chat']['id']].record(message)
+        return message
+
+    async def _edit(self, params: dict, **fields) -> dict:
+        chat = self.chats[int(params['chat_id'])]
+        _, current = chat.messages.get(int(params['message_id']), (0, None))
+        message = dict(current or self._message(int(params['chat_id']), {}))
+        message.update(fields)
+        message['reply_markup'] = params.get('reply_markup')
+        await chat.record(message)
+        return message
+
+    async def _api_editmessagetext(self, params, uploaded):
+        return await self._edit(params, text=params.get('text', ''))
+
+    async def _api_editmessagecaption(self, params, uploaded):
+        return await self._edit(params, caption=params.get('caption', ''))
+
+    async def _api_editmessagereplymarkup(self, params, uploaded):
+        return await self._edit(params)
+
+    async def _uploaded_video(self, uploaded: int) -> dict:
+        await self._throttle(uploaded, self.upload_mbps)
+        file_id = f'sent{next(self._file_ids)}'
+        return {'file_id': file_id, 'file_unique_id': file_id, 'width': 0, 'height': 0,
+                'duration': 0, 'file_size': uploaded}
+
+    async def _api_sendvideo(self, params, uploaded):
+        video = await self._uploaded_video(uploaded)
+        message = self._message(int(params['chat_id']), params, video=video, caption=params.get('caption', ''))
+        await self.chats[message['chat']['id']].record(message)
+        return message
+
+    _api_senddocument = _api_sendvideo
+
+    async def _api_sendmediagroup(self, params, uploaded):
+        chat_id = int(params['chat_id'])
+        media = params.get('media') or []
+        # The attachments of the album arrive in one request
+        video = await self._uploaded_video(uploaded)
+        messages = []
+        for item in media:
+            message = self._message(chat_id, {}, video=dict(video), caption=item.get('caption', ''))
+            await self.chats[chat_id].record(message)
+            messages.append(message)
+        return messages
+
+    async def _api_getfile(self, params, uploaded):
+        file_id = params['file_id']
+        entry = next((entry for entry in self.files.values() if entry['file_id'] == file_id), None)
+        if not entry:
+            return {'file_id': file_id, 'file_unique_id': file_id}
+        return {'file_id': file_id, 'file_unique_id': entry['file_unique_id'],
+                'file_size': entry['size'], 'file_path': entry['file_path']}
+
+    # -- simulated users ----------------------------------------------------
+
+    async def push_update(self, **update):
+        update['update_id'] = next(self._update_ids)
+        async with self.updates_added:
+            self.updates.append(update)
+            self.updates_added.notify_all()
+
+    def add_file(self, path: str, info: dict) -> dict:
+        """Serve a local video under a new file_id, as if a user had uploaded it"""
+        number = next(self._file_ids)
+        entry = {
+            'file_id': f'upload{number}',
+            'file_unique_id': f'upload-unique{number}',
+            'file_path': f'videos/file_{number}.mp4',
+            'path': path,
+            'size': os.path.getsize(path),
+            'width': info.get('width') or 0,
+            'height': info.get('height') or 0,
+            'duration': int(info.get('duration') or 0),
+        }
+        self.files[entry['file_path']] = entry
+        return entry
+
+
+class SimulatedUser:
+    """One Telegram user clicking through the bot"""
+
+    def __init__(self, api: FakeBotAPI, user_id: int, timeout: float = 600, think_time: float = 0.5):
+        self.api = api
+        self.user_id = user_id
+        self.timeout = timeout
+        # Pause before every action, as a person reads the reply first. The bot may still be
+        # finishing the previous handler (e.g. switching state) after its reply went out
+        self.think_time = think_time
+        self.chat = api.chats[user_id]
+        # Last event seen by wait_for() and the last event before the previous button press
+        self.cursor = 0
+        self.press_cursor = 0
+        self._message_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+
+    @property
+    def _user(self) -> dict:
+        return {'id': self.user_id, 'is_bot': False, 'first_name': f'User {self.user_id}'}
+
+    def _message(self, **fields) -> dict:
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': self.user_id, 'type': 'private'},
+            'from': self._user,
+        }
+        message.update(fields)
+        return message
+
+    async def send_text(self, text: str):
+        await asyncio.sleep(self.think_time)
+        await self.api.push_update(message=self._message(text=text))
+
+    async def send_video(self, path: str, info: dict):
+        entry = self.api.add_file(path, info)
+        video = {key: entry[key] for key in ['file_id', 'file_unique_id', 'width', 'height', 'duration']}
+        video['file_size'] = entry['size']
+        await asyncio.sleep(self.think_time)
+        await self.api.push_update(message=self._message(video=video))
+
+    async def _wait(self, find) -> dict:
+        async def wait():
+            async with self.chat.changed:
+                while True:
+                    found = find()
+                    if found:
+                        return found
+                    await self.chat.changed.wait()
+        return await asyncio.wait_for(wait(), self.timeout)
+
+    async def wait_for(self, predicate) -> dict:
+        """Next message sent or edited after the last one waited for that matches `predicate`"""
+        def find():
+            for seq, message in self.chat.events:
+                if seq > self.cursor and predicate(message):
+                    self.cursor = seq
+                    return message
+        return await self._wait(find)
+
+    async def wait_for_text(self, *fragments: str) -> dict:
+        return await self.wait_for(
+            lambda message: any(fragment in (message.get('text') or message.get('caption') or '')
+                                for fragment in fragments)
+        )
+
+    async def press(self, callback_data: str) -> dict:
+        """
+        Wait for a message that shows the button and press it. Only messages changed
+        since the previous press count, so a keyboard the bot is about to replace is not used
+        """
+        def find():
+            shown = [(seq, message) for seq, message in self.chat.messages.values()
+                     if seq > self.press_cursor and callback_data in _buttons(message)]
+            if shown:
+                self.press_cursor = len(self.chat.events)
+                return max(shown, key=lambda item: item[0])[1]
+        message = await self._wait(find)
+        await asyncio.sleep(self.think_time)
+        await self.api.push_update(callback_query={
+            'id': f'{self.user_id}-{next(self._callback_ids)}',
+            'from': self._user,
+            'chat_instance': str(self.user_id),
+            'data': callback_data,
+            'message': message,
+        })
+        return message
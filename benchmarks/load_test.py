@@ -0,0 +1,283 @@
+"""
+Load test: simulated Telegram users driving the bot end to end
+
+Usage:
+    python benchmarks/load_test.py [--users 8] [--videos 2] [--flows mode1,mode2:all_with_all:vertical]
+                                   [--download-mbps 100] [--upload-mbps 50] [--output load.json]
+
+The bot from bot_main runs in this process against a local fake Bot API server
+(benchmarks/fake_bot_api.py), with its own database and video directories in a
+temporary directory. Every simulated user clicks through one flow - Mode 1, or Mode 2 /
+Mode N with a combine strategy and layout - uploading clips from the synthetic corpus of
+benchmarks/video_processing.py; flows are assigned round-robin and all users start at once.
+
+Reported as JSON: latency percentiles per stage (download from the Bot API, job queue
+wait, encode, upload to the Bot API), time from the final button to "Processing
+complete" per flow, and throughput (flows and delivered videos per minute).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The bot reads its configuration on import: point it at a scratch database and directories
+WORK_DIR = tempfile.mkdtemp(prefix='load_test_')
+os.environ.update(
+    BOT_TOKEN='123456:LOADTEST',
+    DATABASE_URL=f"sqlite+aiosqlite:///{os.path.join(WORK_DIR, 'bot.db')}",
+    TEMP_VIDEO_DIR=os.path.join(WORK_DIR, 'temp_videos'),
+    PROCESSED_VIDEO_DIR=os.path.join(WORK_DIR, 'processed_videos'),
+)
+
+from config import settings
+from bot_main import create_bot, create_dispatcher
+from database.database import async_session_maker, init_db
+from database.crud import assign_tariff_plan_to_user, create_tariff_plan, get_or_create_user
+from utils.job_executor import job_executor
+from utils.video_processing import get_video_info
+from fake_bot_api import FakeBotAPI, SimulatedUser
+from video_processing import CORPUS, clip_path, ensure_corpus
+
+STRATEGIES = ['sequential', 'first_with_first', 'all_with_all']
+LAYOUTS = ['horizontal', 'vertical', 'sequential']
+ALL_FLOWS = (
+    ['mode1']
+    + [f'mode2:{strategy}:{layout}' for strategy in STRATEGIES for layout in LAYOUTS]
+    + [f'moden:{strategy}:{layout}' for strategy in STRATEGIES for layout in LAYOUTS]
+)
+MODE_N_GROUPS = 3
+DONE_TEXTS = ('Processing complete', '❌')
+
+
+async def upload_group(user: SimulatedUser, clips: list, label: str):
+    for number, (path, info) in enumerate(clips, 1):
+        await user.send_video(path, info)
+        await user.wait_for_text(f'{label}Video {number} received')
+
+
+async def finish(user: SimulatedUser, button: str) -> tuple:
+    """Press the button that starts processing and wait for the final message"""
+    await user.press(button)
+    start = time.perf_counter()
+    message = await user.wait_for_text(*DONE_TEXTS)
+    elapsed = time.perf_counter() - start
+    text = message.get('text') or ''
+    return 'Processing complete' in text, elapsed, text
+
+
+async def run_mode1(user: SimulatedUser, clips: list, strategy=None, layout=None) -> tuple:
+    await user.send_text('🎬 Process 1 Video')
+    await user.press('mod_filter')
+    await user.press('filter_sepia')
+    await user.press('mod_done')
+    await user.wait_for_text("Click 'Done'")
+    for number, (path, info) in enumerate(clips, 1):
+        await user.send_video(path, info)
+        if number == 1 and settings.PREVIEW_ENABLED:
+            await user.press('preview_ok')
+            await user.wait_for_text('Modifications confirmed')
+        else:
+            await user.wait_for_text(f'Video {number} received')
+    return await finish(user, 'videos_done')
+
+
+async def run_mode2(user: SimulatedUser, clips: list, strategy: str, layout: str) -> tuple:
+    await user.send_text('🎥 Process 2 Videos')
+    await user.press('mod_filter')
+    await user.press('filter_sepia')
+    await user.press('mod_done')
+    await user.wait_for_text("Click 'Done'")
+    await upload_group(user, clips, 'Group 1 ')
+    await user.press('videos_done')
+    await user.press('mod_done')
+    await user.wait_for_text("Click 'Done'")
+    await upload_group(user, clips[::-1], 'Group 2 ')
+    await user.press('videos_done')
+    await user.press(f'strategy_{strategy}')
+    return await finish(user, f'merge_{layout}')
+
+
+async def run_moden(user: SimulatedUser, clips: list, strategy: str, layout: str) -> tuple:
+    await user.send_text('🎞️ Process N Videos')
+    await user.press(f'groups_{MODE_N_GROUPS}')
+    for group in range(1, MODE_N_GROUPS + 1):
+        if group == 1:
+            await user.press('mod_filter')
+            await user.press('filter_sepia')
+        await user.press('mod_done')
+        await user.wait_for_text("Click 'Done'")
+        await upload_group(user, clips, f'Group {group} ')
+        await user.press('videos_done')
+    await user.press(f'strategy_{strategy}')
+    return await finish(user, f'merge_{layout}')
+
+
+RUNNERS = {'mode1': run_mode1, 'mode2': run_mode2, 'moden': run_moden}
+
+
+async def run_user(api: FakeBotAPI, user_id: int, flow: str, clips: list,
+                   timeout: float, think_time: float) -> dict:
+    mode, *options = flow.split(':')
+    user = SimulatedUser(api, user_id, timeout, think_time)
+    start = time.perf_counter()
+    try:
+        success, processing, text = await RUNNERS[mode](user, clips, *options)
+    except asyncio.TimeoutError:
+        last = user.chat.events[-1][1] if user.chat.events else {}
+        success, processing = False, None
+        text = f"timed out after: {(last.get('text') or last.get('caption') or 'no reply').splitlines()[0]}"
+    delivered = sum(1 for _, message in user.chat.events if message.get('video'))
+    return {
+        'flow': flow,
+        'user_id': user_id,
+        'success': success,
+        'session_seconds': time.perf_counter() - start,
+        'processing_seconds': processing,
+        'delivered_videos': delivered,
+        'result': text.splitlines()[0] if success else text,
+    }
+
+
+def percentiles(values: list) -> dict:
+    """Nearest-rank p50/p90/p95/p99 and max"""
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+    return {
+        'count': len(ordered),
+        'p50': rank(50), 'p90': rank(90), 'p95': rank(95), 'p99': rank(99),
+        'max': ordered[-1], 'mean': sum(ordered) / len(ordered),
+    }
+
+
+async def prepare_users(user_ids: list):
+    """Users on an unlimited plan, so the load test is not cut short by daily limits"""
+    async with async_session_maker() as session:
+        plan = await create_tariff_plan(session, 'Load test', videos_per_day=100000, videos_per_order=10000)
+        for user_id in user_ids:
+            user = await get_or_create_user(session, telegram_id=user_id, username=f'load{user_id}')
+            await assign_tariff_plan_to_user(session, user.id, plan.id)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=len(ALL_FLOWS), help='simulated users running at once')
+    parser.add_argument('--flows', default=','.join(ALL_FLOWS),
+                        help='comma separated: mode1, mode2:<strategy>:<layout>, moden:<strategy>:<layout>')
+    parser.add_argument('--videos', type=int, default=2, help='uploads per group')
+    parser.add_argument('--clip', default='360p_5s', choices=list(CORPUS))
+    parser.add_argument('--download-mbps', type=float, default=0, help='simulated Bot API download bandwidth')
+    parser.add_argument('--upload-mbps', type=float, default=0, help='simulated Bot API upload bandwidth')
+    parser.add_argument('--timeout', type=float, default=1800, help='seconds a user waits for any reply')
+    parser.add_argument('--think-time', type=float, default=0.5, help='seconds a user pauses before each action')
+    parser.add_argument('--corpus-dir', default=os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'temp_videos', 'benchmark_corpus'))
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    flows = args.flows.split(',')
+    for flow in flows:
+        if flow.split(':')[0] not in RUNNERS:
+            parser.error(f"unknown flow {flow}")
+
+    logging.getLogger('aiogram').setLevel(logging.WARNING)
+    await ensure_corpus(args.corpus_dir, [args.clip])
+    corpus = [clip_path(args.corpus_dir, args.clip, take) for take in range(2)]
+    infos = [await get_video_info(path) for path in corpus]
+    clips = [(corpus[index % 2], infos[index % 2]) for index in range(args.videos)]
+
+    api = FakeBotAPI(args.download_mbps, args.upload_mbps)
+    settings.TELEGRAM_API_URL = await api.start()
+    await init_db()
+    user_ids = [1000 + index for index in range(args.users)]
+    await prepare_users(user_ids)
+
+    job_timings = defaultdict(list)
+
+    def record_job(job):
+        job_timings['queue_wait'].append(job.queue_wait)
+        job_timings['encode'].append(job.run_time)
+        job_timings[f'encode:{job.name}'].append(job.run_time)
+    job_executor.job_listeners.append(record_job)
+    await job_executor.start()
+
+    bot, dp = create_bot(), create_dispatcher()
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=1))
+    print(f"{args.users} users, {job_executor.max_workers} job workers, work dir {WORK_DIR}", file=sys.stderr)
+
+    start = time.perf_counter()
+    try:
+        results = await asyncio.gather(*[
+            run_user(api, user_id, flows[index % len(flows)], clips, args.timeout, args.think_time)
+            for index, user_id in enumerate(user_ids)
+        ])
+    finally:
+        wall = time.perf_counter() - start
+        await dp.stop_polling()
+        await asyncio.gather(polling, return_exceptions=True)
+        await job_executor.stop()
+        await api.stop()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    completed = [result for result in results if result['success']]
+    by_flow = defaultdict(list)
+    for result in completed:
+        by_flow[result['flow']].append(result['processing_seconds'])
+    stage_timings = {
+        'download': api.timings['download'],
+        'queue_wait': job_timings.pop('queue_wait', []),
+        'encode': job_timings.pop('encode', []),
+        'upload': api.timings['upload'],
+    }
+    delivered = sum(result['delivered_videos'] for result in results)
+    report = {
+        'config': {
+            'users': args.users, 'videos_per_group': args.videos, 'clip': args.clip,
+            'job_workers': job_executor.max_workers, 'cpu_count': os.cpu_count(),
+            'download_mbps': args.download_mbps, 'upload_mbps': args.upload_mbps,
+        },
+        'wall_seconds': wall,
+        'throughput': {
+            'flows_completed': len(completed),
+            'flows_failed': len(results) - len(completed),
+            'flows_per_minute': len(completed) / wall * 60,
+            'videos_delivered': delivered,
+            'videos_per_minute': delivered / wall * 60,
+            'uploaded_mb': api.uploaded_bytes / 1024 / 1024,
+        },
+        'stages': {stage: percentiles(values) for stage, values in stage_timings.items()},
+        'encode_by_job': {name.split(':', 1)[1]: percentiles(values) for name, values in job_timings.items()},
+        'processing_by_flow': {flow: percentiles(values) for flow, values in sorted(by_flow.items())},
+        'failures': [result for result in results if not result['success']],
+    }
+
+    for stage, summary in report['stages'].items():
+        if summary['count']:
+            print(f"{stage:<12} n={summary['count']:<4} p50 {summary['p50']:7.2f}s  p95 {summary['p95']:7.2f}s  "
+                  f"max {summary['max']:7.2f}s", file=sys.stderr)
+    throughput = report['throughput']
+    print(f"{throughput['flows_completed']} flows ok, {throughput['flows_failed']} failed in {wall:.1f}s: "
+          f"{throughput['flows_per_minute']:.2f} flows/min, {throughput['videos_per_minute']:.2f} videos/min",
+          file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
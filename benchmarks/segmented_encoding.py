@@ -0,0 +1,94 @@
+"""
+Benchmark: segment-parallel encoding vs. a single encoder process
+
+Usage:
+    python benchmarks/segmented_encoding.py [input.mp4] [--duration 300] [--workers N]
+
+Without an input a synthetic clip (test pattern + tone) of --duration seconds is generated.
+Both paths apply the same modification chain; wall time and output size are printed.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ffmpeg
+from config import settings
+from utils.video_processing import (
+    apply_modifications,
+    encode_segmented,
+    get_video_info,
+    run_ffmpeg,
+    segment_worker_count
+)
+
+MODIFICATIONS = [
+    {'type': 'filter', 'value': 'sepia'},
+    {'type': 'scale', 'width': 1280, 'height': 720},
+    {'type': 'text', 'value': 'benchmark', 'x': 10, 'y': 10}
+]
+
+
+async def generate_clip(path: str, duration: int):
+    """Create a 1080p test clip with audio and a 2 second GOP"""
+    video = ffmpeg.input(f'testsrc2=size=1920x1080:rate=30:duration={duration}', f='lavfi')
+    audio = ffmpeg.input(f'sine=frequency=440:duration={duration}', f='lavfi')
+    await run_ffmpeg(ffmpeg.output(video, audio, path, vcodec='libx264', acodec='aac', g=60))
+
+
+async def timed(label: str, coro, output_path: str) -> float:
+    start = time.perf_counter()
+    await coro
+    elapsed = time.perf_counter() - start
+    info = await get_video_info(output_path)
+    print(f"{label:<12} {elapsed:8.2f}s  duration {info.get('duration', 0):7.2f}s  "
+          f"size {info.get('size', 0) / 1024 / 1024:7.2f} MB")
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', nargs='?')
+    parser.add_argument('--duration', type=int, default=300)
+    parser.add_argument('--workers', type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(settings.TEMP_VIDEO_DIR, exist_ok=True)
+    input_path = args.input
+    generated = input_path is None
+    if generated:
+        input_path = os.path.join(settings.TEMP_VIDEO_DIR, 'benchmark_input.mp4')
+        print(f"Generating {args.duration}s test clip...")
+        await generate_clip(input_path, args.duration)
+
+    info = await get_video_info(input_path)
+    workers = args.workers or segment_worker_count()
+    print(f"Input: {input_path} ({info.get('duration', 0):.1f}s), {workers} chunk workers")
+    print()
+
+    monolithic_path = os.path.join(settings.TEMP_VIDEO_DIR, 'benchmark_monolithic.mp4')
+    segmented_path = os.path.join(settings.TEMP_VIDEO_DIR, 'benchmark_segmented.mp4')
+    try:
+        monolithic = await timed(
+            'monolithic',
+            apply_modifications(input_path, monolithic_path, MODIFICATIONS, segmented=False),
+            monolithic_path
+        )
+        segmented = await timed(
+            'segmented',
+            encode_segmented(input_path, segmented_path, MODIFICATIONS, info, workers=workers),
+            segmented_path
+        )
+        print()
+        print(f"Speedup: {monolithic / segmented:.2f}x")
+    finally:
+        for path in [monolithic_path, segmented_path] + ([input_path] if generated else []):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
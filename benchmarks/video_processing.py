@@ -0,0 +1,259 @@
+"""
+Benchmark: the operations of utils/video_processing on a synthetic corpus
+
+Usage:
+    python benchmarks/video_processing.py [--quick] [--ops speed,chain] [--repeat 3]
+                                          [--output results.json] [--compare baseline.json]
+
+The corpus is generated with ffmpeg testsrc2 + sine at fixed settings, so every run
+and every commit encodes the same input frames. Each operation runs in a fresh worker
+process; wall time, CPU time (the worker and every ffmpeg/ffprobe it started),
+peak RSS of the largest process and output size are reported as JSON together with
+the git commit and ffmpeg version. With --compare the run is checked against an
+earlier result file and exits with status 1 when an operation got slower than
+--threshold.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ffmpeg
+from config import settings
+from utils.video_processing import (
+    ENGINE_VERSION,
+    apply_filter,
+    apply_modifications,
+    change_video_speed,
+    concatenate_videos,
+    generate_variants,
+    merge_videos,
+    run_ffmpeg,
+    scale_video
+)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> (width, height, seconds)
+CORPUS = {
+    '360p_5s': (640, 360, 5),
+    '720p_10s': (1280, 720, 10),
+    '1080p_10s': (1920, 1080, 10),
+}
+QUICK_CORPUS = ['360p_5s']
+
+FULL_CHAIN = [
+    {'type': 'filter', 'value': 'sepia'},
+    {'type': 'speed', 'value': 1.25},
+    {'type': 'crop', 'width': 600, 'height': 340, 'x': 20, 'y': 10},
+    {'type': 'scale', 'width': 640, 'height': 360},
+    {'type': 'text', 'value': 'benchmark', 'x': 10, 'y': 10},
+    {'type': 'metadata', 'strip': True, 'tags': {'comment': 'benchmark'}}
+]
+
+# name -> coroutine factory(clip, second clip of the same size, output path)
+OPERATIONS = {
+    'speed': lambda clip, other, out: change_video_speed(clip, out, 1.5),
+    'filter': lambda clip, other, out: apply_filter(clip, out, 'sepia'),
+    'scale': lambda clip, other, out: scale_video(clip, out, 854, 480),
+    'merge': lambda clip, other, out: merge_videos([clip, other], out, 'horizontal'),
+    'concat': lambda clip, other, out: concatenate_videos([clip, other], out),
+    'concat_reencode': lambda clip, other, out: concatenate_videos([clip, other], out, stream_copy=False),
+    'chain': lambda clip, other, out: apply_modifications(clip, out, FULL_CHAIN, segmented=False),
+    'variants': lambda clip, other, out: generate_variants(
+        clip, [out] + [f'{out}.{index}.mp4' for index in range(1, 3)], seed=1
+    ),
+}
+
+
+def clip_path(corpus_dir: str, name: str, take: int = 0) -> str:
+    return os.path.join(corpus_dir, f'{name}_{take}.mp4')
+
+
+async def generate_clip(path: str, width: int, height: int, seconds: int, take: int):
+    """Deterministic test pattern with a tone; `take` shifts the pattern and pitch"""
+    video = ffmpeg.input(f'testsrc2=size={width}x{height}:rate=30:duration={seconds}', f='lavfi', ss=take)
+    audio = ffmpeg.input(f'sine=frequency={440 + 110 * take}:sample_rate=48000:duration={seconds}', f='lavfi')
+    output = ffmpeg.output(
+        video, audio, path, vcodec='libx264', preset='medium', crf=23, g=60, pix_fmt='yuv420p',
+        acodec='aac', audio_bitrate='128k', fflags='+bitexact', **{'flags:v': '+bitexact'}
+    )
+    await run_ffmpeg(output, threads=1)
+
+
+async def ensure_corpus(corpus_dir: str, names) -> None:
+    """Generate missing corpus clips, two takes per resolution for merges and concats"""
+    os.makedirs(corpus_dir, exist_ok=True)
+    for name in names:
+        width, height, seconds = CORPUS[name]
+        for take in range(2):
+            path = clip_path(corpus_dir, name, take)
+            if not os.path.exists(path):
+                print(f"Generating {os.path.basename(path)}...", file=sys.stderr)
+                await generate_clip(path, width, height, seconds, take)
+
+
+def _peak_rss_kb(usage) -> int:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+
+
+async def run_operation(operation: str, clip: str, other: str, output_path: str) -> dict:
+    """Run one operation in this process and measure it"""
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    success = await OPERATIONS[operation](clip, other, output_path)
+    wall = time.perf_counter() - start
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    outputs = [output_path] + [f'{output_path}.{index}.mp4' for index in range(1, 3)]
+    size = 0
+    for path in outputs:
+        if os.path.exists(path):
+            size += os.path.getsize(path)
+            os.remove(path)
+    return {
+        'success': bool(success),
+        'wall_seconds': wall,
+        'cpu_user_seconds': (self_after.ru_utime - self_before.ru_utime)
+                            + (children_after.ru_utime - children_before.ru_utime),
+        'cpu_system_seconds': (self_after.ru_stime - self_before.ru_stime)
+                              + (children_after.ru_stime - children_before.ru_stime),
+        # Fresh worker, so the children peak belongs to this operation's ffmpeg processes
+        'peak_rss_kb': max(_peak_rss_kb(children_after), _peak_rss_kb(self_after)),
+        'output_bytes': size,
+    }
+
+
+def run_worker(operation: str, clip: str, other: str, output_path: str) -> dict:
+    """Run one operation in a fresh interpreter so its resource usage is not mixed with others"""
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--worker', operation, clip, other, output_path],
+        capture_output=True, text=True, cwd=REPO_DIR
+    )
+    if result.returncode != 0:
+        return {'success': False, 'error': result.stderr.strip().splitlines()[-1:]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def summarize(runs: list) -> dict:
+    """Median of every metric over the repeated runs"""
+    if not all(run.get('success') for run in runs):
+        return {'success': False, 'runs': runs}
+    summary = {'success': True, 'repeat': len(runs)}
+    for key in ['wall_seconds', 'cpu_user_seconds', 'cpu_system_seconds', 'peak_rss_kb', 'output_bytes']:
+        summary[key] = statistics.median(run[key] for run in runs)
+    summary['cpu_seconds'] = summary['cpu_user_seconds'] + summary['cpu_system_seconds']
+    summary['min_wall_seconds'] = min(run['wall_seconds'] for run in runs)
+    return summary
+
+
+def _command_output(args: list) -> str:
+    try:
+        return subprocess.run(args, capture_output=True, text=True, cwd=REPO_DIR).stdout.strip()
+    except OSError:
+        return ''
+
+
+def environment() -> dict:
+    """What a result depends on besides the code: commit, ffmpeg build and machine"""
+    return {
+        'git_commit': _command_output(['git', 'rev-parse', 'HEAD']),
+        'git_dirty': bool(_command_output(['git', 'status', '--porcelain', '--untracked-files=no'])),
+        'engine_version': ENGINE_VERSION,
+        'ffmpeg': (_command_output(['ffmpeg', '-version']).splitlines() or [''])[0],
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Operations whose median wall or CPU time grew by more than `threshold` (0.1 = 10%)"""
+    regressions = []
+    for key, current in results['results'].items():
+        previous = baseline.get('results', {}).get(key)
+        if not previous or not previous.get('success') or not current.get('success'):
+            continue
+        for metric in ['wall_seconds', 'cpu_seconds']:
+            if previous[metric] and current[metric] > previous[metric] * (1 + threshold):
+                regressions.append(
+                    f"{key} {metric}: {previous[metric]:.2f} -> {current[metric]:.2f} "
+                    f"(+{(current[metric] / previous[metric] - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='only the smallest clip')
+    parser.add_argument('--corpus', default=','.join(CORPUS), help='comma separated clip names')
+    parser.add_argument('--ops', default=','.join(OPERATIONS), help='comma separated operations')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--corpus-dir', default=os.path.join(settings.TEMP_VIDEO_DIR, 'benchmark_corpus'))
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='earlier JSON results to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    parser.add_argument('--worker', nargs=4, metavar=('OP', 'CLIP', 'OTHER', 'OUTPUT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(await run_operation(*args.worker)))
+        return
+
+    names = QUICK_CORPUS if args.quick else args.corpus.split(',')
+    operations = args.ops.split(',')
+    for name in operations:
+        if name not in OPERATIONS:
+            parser.error(f"unknown operation {name}, choose from {', '.join(OPERATIONS)}")
+    await ensure_corpus(args.corpus_dir, names)
+
+    results = {'environment': environment(), 'results': {}}
+    output_path = os.path.join(settings.TEMP_VIDEO_DIR, 'benchmark_output.mp4')
+    for name in names:
+        clip, other = clip_path(args.corpus_dir, name, 0), clip_path(args.corpus_dir, name, 1)
+        for operation in operations:
+            runs = [run_worker(operation, clip, other, output_path) for _ in range(args.repeat)]
+            summary = summarize(runs)
+            results['results'][f'{operation}/{name}'] = summary
+            if summary['success']:
+                print(f"{operation + '/' + name:<28} wall {summary['wall_seconds']:7.2f}s  "
+                      f"cpu {summary['cpu_seconds']:7.2f}s  rss {summary['peak_rss_kb'] / 1024:7.1f} MB  "
+                      f"size {summary['output_bytes'] / 1024 / 1024:7.2f} MB", file=sys.stderr)
+            else:
+                print(f"{operation + '/' + name:<28} FAILED", file=sys.stderr)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        print(f"Compared with {baseline.get('environment', {}).get('git_commit', args.compare)[:12]}:",
+              file=sys.stderr)
+        for line in regressions:
+            print(f"  REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("  no regressions", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,50 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict
+
+
+class RequestScope:
+    """A user's running processing request"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.cancel_requested = False
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancel_requested = True
+        self.task.cancel()
+
+
+# Telegram user ID -> request currently being processed for that user
+_running: Dict[int, RequestScope] = {}
+
+
+@asynccontextmanager
+async def cancellable_request(user_id: int):
+    """
+    Register the current handler as the user's running request.
+    When cancel_request() is called the block is cancelled, which cancels its jobs and
+    kills their ffmpeg processes; the exception is absorbed and `scope.cancelled` is set.
+    """
+    scope = RequestScope(asyncio.current_task())
+    _running[user_id] = scope
+    try:
+        yield scope
+    except asyncio.CancelledError:
+        if not scope.cancel_requested:
+            raise
+        scope.cancelled = True
+        scope.task.uncancel()
+    finally:
+        if _running.get(user_id) is scope:
+            del _running[user_id]
+
+
+def cancel_request(user_id: int) -> bool:
+    """Cancel the user's running request, if any"""
+    scope = _running.get(user_id)
+    if not scope or scope.cancel_requested:
+        return False
+    scope.cancel()
+    return True
@@ -0,0 +1,30 @@
+import os
+from config import settings
+from utils.video_processing import generate_filename, merge_videos, merge_videos_piped
+from utils.job_executor import job_executor
+from utils.result_cache import make_cache_key, get_or_render
+from bot.encode_stats import recording_encode_stats
+
+
+async def render_combination(mode: int, items: list, layout: str, piped: bool = False,
+                             frame_size: tuple = None) -> str:
+    """
+    Combine processed videos given as (path, source key, modifications) tuples for Mode 2 / Mode N,
+    reusing a cached result when available.
+    With `piped` the paths are the originals and modifications are applied in the same pipeline.
+    `frame_size` is the frame the videos were normalized to, if they were.
+    """
+    paths = [path for path, _, _ in items]
+    output_path = os.path.join(settings.PROCESSED_VIDEO_DIR, generate_filename())
+    spec = {'modifications': [modifications for _, _, modifications in items], 'layout': layout}
+    if frame_size:
+        spec['mezzanine'] = list(frame_size)
+    cache_key = make_cache_key([source_key for _, source_key, _ in items], spec)
+
+    if piped:
+        sources = [(path, modifications) for path, _, modifications in items]
+        job, args = merge_videos_piped, (sources, output_path, layout)
+    else:
+        job, args = merge_videos, (paths, output_path, layout)
+    async with recording_encode_stats(mode, job.__name__, paths):
+        return await get_or_render(cache_key, output_path, lambda: job_executor.submit(job, *args))
@@ -0,0 +1,243 @@
+import asyncio
+import os
+import logging
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, List, Optional, Tuple, TypeVar
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter
+from aiogram.types import Message, FSInputFile, InputMediaVideo
+from config import settings
+from database.database import async_session_maker
+from database.crud import get_output_file_id, set_cache_entry_file_id
+from utils.metrics import BYTES_TOTAL, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Uploads in flight across all chats; FSInputFile streams the file with aiofiles
+_upload_slots = asyncio.Semaphore(settings.MAX_CONCURRENT_UPLOADS)
+
+
+def _sent_file_id(sent: Message) -> Optional[str]:
+    """file_id Telegram assigned to a sent video"""
+    if sent.video:
+        return sent.video.file_id
+    if sent.document:
+        return sent.document.file_id
+    return None
+
+
+def _processed_filename(video_path: str) -> Optional[str]:
+    """Name of an output in PROCESSED_VIDEO_DIR, the key its file_id is stored under"""
+    if os.path.dirname(os.path.abspath(video_path)) == os.path.abspath(settings.PROCESSED_VIDEO_DIR):
+        return os.path.basename(video_path)
+    return None
+
+
+async def _cached_file_id(video_path: str) -> Optional[str]:
+    processed_filename = _processed_filename(video_path)
+    if not processed_filename:
+        return None
+    async with async_session_maker() as session:
+        return await get_output_file_id(session, processed_filename)
+
+
+async def _remember_file_id(video_path: str, file_id: Optional[str]):
+    processed_filename = _processed_filename(video_path)
+    if processed_filename and file_id:
+        async with async_session_maker() as session:
+            await set_cache_entry_file_id(session, processed_filename, file_id)
+
+
+async def with_retry(send: Callable[[], Awaitable[T]]) -> T:
+    """
+    Call `send`, waiting out Telegram flood control (RetryAfter)
+    and retrying network errors with exponential backoff
+    """
+    for attempt in range(settings.DELIVERY_RETRIES + 1):
+        try:
+            return await send()
+        except TelegramRetryAfter as e:
+            if attempt == settings.DELIVERY_RETRIES:
+                raise
+            logger.warning(f"Flood control, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+        except TelegramNetworkError as e:
+            if attempt == settings.DELIVERY_RETRIES:
+                raise
+            delay = min(2 ** attempt, 60)
+            logger.warning(f"Upload failed ({e}), retrying in {delay}s")
+            await asyncio.sleep(delay)
+
+
+async def _upload(send: Callable[[], Awaitable[T]], paths: List[str]) -> T:
+    """Send with retries once an upload slot is free; `paths` are the files being uploaded"""
+    async with _upload_slots:
+        with STAGE_SECONDS.time(stage='upload'):
+            sent = await with_retry(send)
+    BYTES_TOTAL.inc(sum(os.path.getsize(path) for path in paths if os.path.exists(path)), direction='out')
+    return sent
+
+
+async def send_video_result(message: Message, video_path: str, caption: str) -> Optional[str]:
+    """
+    Send a processed video to the chat of `message`.
+    Outputs that were delivered before are sent by their Telegram file_id without uploading.
+    Returns the file_id of the sent video.
+    """
+    file_id = await _cached_file_id(video_path)
+    if file_id:
+        try:
+            sent = await with_retry(lambda: message.answer_video(video=file_id, caption=caption))
+            return _sent_file_id(sent)
+        except TelegramBadRequest as e:
+            # file_id is bound to the bot token and may expire; upload again
+            logger.warning(f"Cached file_id rejected, uploading {video_path}: {e}")
+
+    sent = await _upload(lambda: message.answer_video(video=FSInputFile(video_path), caption=caption), [video_path])
+    file_id = _sent_file_id(sent)
+    await _remember_file_id(video_path, file_id)
+    return file_id
+
+
+async def send_video_album(message: Message, results: List[Tuple[str, str]]) -> List[Optional[str]]:
+    """
+    Send (path, caption) results as one media group; a single result is sent as a plain video.
+    Returns the file_id of each sent video.
+    """
+    if len(results) == 1:
+        return [await send_video_result(message, *results[0])]
+
+    file_ids = [await _cached_file_id(path) for path, _ in results]
+    media = [
+        InputMediaVideo(media=file_id or FSInputFile(path), caption=caption)
+        for (path, caption), file_id in zip(results, file_ids)
+    ]
+    try:
+        uploaded = [path for (path, _), file_id in zip(results, file_ids) if not file_id]
+        sent = await _upload(lambda: message.answer_media_group(media), uploaded)
+    except TelegramBadRequest as e:
+        if not any(file_ids):
+            raise
+        # A cached file_id was rejected, send them one by one so only that one is uploaded
+        logger.warning(f"Album with cached file_ids rejected, sending separately: {e}")
+        return [await send_video_result(message, path, caption) for path, caption in results]
+
+    sent_ids = [_sent_file_id(item) for item in sent]
+    for (path, _), file_id in zip(results, sent_ids):
+        await _remember_file_id(path, file_id)
+    return sent_ids
+
+
+class ResultDelivery:
+    """
+    Sends the finished outputs of one request in the background, so the next
+    output is encoded while the previous one uploads. With `album_size` > 1
+    results are collected and sent as media groups of up to that many videos:
+    the first result still goes out on its own right away, and an album that does
+    not fill up is sent once its oldest result has waited `album_wait` seconds.
+    """
+
+    def __init__(self, message: Message, album_size: int = 1, album_wait: Optional[float] = None):
+        self.message = message
+        self.album_size = max(1, min(album_size, 10))
+        self.album_wait = settings.DELIVERY_ALBUM_WAIT if album_wait is None else album_wait
+        self.sent = 0
+        self.failed = 0
+        self._queued = 0
+        self._album: List[tuple] = []
+        self._album_timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def send(self, video_path: str, caption: str,
+             on_sent: Optional[Callable[[Optional[str]], Awaitable]] = None,
+             on_failed: Optional[Callable[[Exception], Awaitable]] = None):
+        """
+        Queue a result for delivery. `on_sent` is awaited with its file_id once it is sent,
+        `on_failed` with the error if it could not be; without it the error is logged.
+        Results of a failed album each report the album's error.
+        """
+        self._queued += 1
+        if self.album_size == 1 or self._queued == 1:
+            self._start(self._send_one(video_path, caption, on_sent, on_failed))
+            return
+        self._album.append((video_path, caption, on_sent, on_failed))
+        if len(self._album) == self.album_size:
+            self._send_album()
+        elif len(self._album) == 1:
+            self._album_timer = asyncio.get_running_loop().call_later(self.album_wait, self._send_album)
+
+    def _start(self, coro: Awaitable):
+        self._tasks.append(asyncio.ensure_future(coro))
+
+    def _send_album(self):
+        if self._album_timer:
+            self._album_timer.cancel()
+            self._album_timer = None
+        album, self._album = self._album, []
+        if album:
+            self._start(self._deliver_album(album))
+
+    async def _send_one(self, video_path: str, caption: str, on_sent, on_failed):
+        try:
+            file_id = await send_video_result(self.message, video_path, caption)
+        except Exception as e:
+            await self._report_failure(video_path, e, on_failed)
+            return
+        self.sent += 1
+        if on_sent:
+            await on_sent(file_id)
+
+    async def _deliver_album(self, album: List[tuple]):
+        try:
+            file_ids = await send_video_album(self.message, [(path, caption) for path, caption, _, _ in album])
+        except Exception as e:
+            for path, _, _, on_failed in album:
+                await self._report_failure(path, e, on_failed)
+            return
+        for (_, _, on_sent, _), file_id in zip(album, file_ids):
+            self.sent += 1
+            if on_sent:
+                await on_sent(file_id)
+
+    async def _report_failure(self, video_path: str, error: Exception, on_failed):
+        self.failed += 1
+        if on_failed:
+            await on_failed(error)
+        else:
+            logger.error(f"Could not deliver {video_path}: {error}")
+
+    async def flush(self):
+        """Send what is left of the last album and wait for every delivery"""
+        self._send_album()
+        tasks, self._tasks = self._tasks, []
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for error in results:
+            if isinstance(error, Exception):
+                logger.error(f"Result delivery failed: {error}")
+
+    async def cancel(self):
+        """Drop queued results and stop the uploads in flight"""
+        if self._album_timer:
+            self._album_timer.cancel()
+            self._album_timer = None
+        self._album = []
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@asynccontextmanager
+async def result_delivery(message: Message, album_size: int = 1, album_wait: Optional[float] = None):
+    """
+    Deliver results in the background while the block keeps encoding.
+    Leaving the block waits for the remaining uploads; if it fails or is cancelled they are dropped.
+    """
+    delivery = ResultDelivery(message, album_size, album_wait)
+    try:
+        yield delivery
+    except BaseException:
+        await delivery.cancel()
+        raise
+    await delivery.flush()
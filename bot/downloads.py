@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Dict, List
+from aiogram import Bot
+from utils.metrics import BYTES_TOTAL, STAGE_SECONDS
+from utils.video_processing import get_video_info
+
+logger = logging.getLogger(__name__)
+
+# Telegram user ID -> path of an upload -> task downloading (and possibly processing) it
+_pending: Dict[int, Dict[str, asyncio.Task]] = {}
+
+
+async def download_video(bot: Bot, file_id: str, path: str) -> Dict:
+    """Download a Telegram video to `path` and probe it. Raises RuntimeError for unreadable files"""
+    with STAGE_SECONDS.time(stage='download'):
+        file = await bot.get_file(file_id)
+        await bot.download_file(file.file_path, path)
+    BYTES_TOTAL.inc(os.path.getsize(path), direction='in')
+    info = await get_video_info(path)
+    if not info:
+        raise RuntimeError("The uploaded file is not a readable video")
+    return info
+
+
+def start_background(user_id: int, path: str, coro: Awaitable) -> asyncio.Task:
+    """
+    Run the work for an upload while the user keeps sending videos.
+    The result is collected with wait_for() once the user presses Done.
+    """
+    task = asyncio.ensure_future(coro)
+    _pending.setdefault(user_id, {})[path] = task
+    return task
+
+
+async def wait_for(user_id: int, path: str) -> Any:
+    """
+    Result of the background work started for an upload, or None if there is none.
+    Re-raises its error; cancelling the waiter cancels the work.
+    """
+    uploads = _pending.get(user_id, {})
+    task = uploads.pop(path, None)
+    if not uploads:
+        _pending.pop(user_id, None)
+    if task is None:
+        return None
+    return await task
+
+
+async def wait_for_all(user_id: int, paths: List[str]) -> List[Any]:
+    """wait_for() every upload in `paths`; if one fails the others are stopped"""
+    tasks = [asyncio.ensure_future(wait_for(user_id, path)) for path in paths]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def _discard(task: asyncio.Task, path: str):
+    if not task.cancelled():
+        # Mark a failure as seen, nobody is going to await it
+        task.exception()
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def cancel_background(user_id: int) -> int:
+    """Stop the user's pending downloads and encodes and delete their uploads"""
+    uploads = _pending.pop(user_id, {})
+    for path, task in uploads.items():
+        task.cancel()
+        # The file may still be written to until the task has unwound
+        task.add_done_callback(lambda task, path=path: _discard(task, path))
+    if uploads:
+        logger.info(f"Cancelled {len(uploads)} background uploads of user {user_id}")
+    return len(uploads)
@@ -0,0 +1,45 @@
+import logging
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from database.database import async_session_maker
+from database.crud import create_encode_stat
+from utils.progress import current_encode_stats, summarize_encode_stats
+from utils.video_processing import get_video_info
+
+logger = logging.getLogger(__name__)
+
+
+async def save_encode_stats(runs: List[dict], mode: int, job: str, input_paths: List[str],
+                            video_id: Optional[int] = None):
+    """Store the combined stats of a job's ffmpeg runs with the resolution and length of its inputs"""
+    infos = [await get_video_info(path) for path in input_paths]
+    first = infos[0] if infos else {}
+    async with async_session_maker() as session:
+        await create_encode_stat(
+            session, mode, job, summarize_encode_stats(runs), video_id=video_id,
+            inputs=len(input_paths),
+            input_width=first.get('width'),
+            input_height=first.get('height'),
+            input_duration=sum(info.get('duration') or 0 for info in infos) or None
+        )
+
+
+@asynccontextmanager
+async def recording_encode_stats(mode: int, job: str, input_paths: List[str], video_id: Optional[int] = None):
+    """
+    Collect the stats of every ffmpeg process the block runs (executor jobs included)
+    and store them as one EncodeStat once it succeeds. Cache hits run nothing and store nothing.
+    """
+    runs = []
+    token = current_encode_stats.set(runs)
+    try:
+        yield runs
+    finally:
+        current_encode_stats.reset(token)
+
+    if runs:
+        try:
+            await save_encode_stats(runs, mode, job, input_paths, video_id)
+        except Exception as e:
+            # Statistics are for capacity planning, never fail a finished job over them
+            logger.warning(f"Could not store encode stats of {job}: {e}")
@@ -177,7 +177,8 @@ async def mode_1_handler(message: Message, state: FSMContext):
             username=message.from_user.username
         )
     
-    await state.update_data(mode='mode1', modifications=[])
+    await state.update_data(mode='mode1', modifications=[], variants=1,
+                            video_paths=[], preview_confirmed=False)
     await state.set_state(VideoProcessingStates.selecting_modifications_mode1)
     
     mode1_text = get_text(user.language, "mode1_configure_filters")
@@ -193,7 +194,7 @@ async def mode_1_handler(message: Message, state: FSMContext):
     await message.answer(
         mode1_text,
         parse_mode="HTML",
-        reply_markup=video_modifications_keyboard()
+        reply_markup=video_modifications_keyboard(variants=True)
     )
 
 
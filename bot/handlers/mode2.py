@@ -8,7 +8,8 @@ from bot.keyboards import (
     video_modifications_keyboard,
     filter_selection_keyboard,
     main_menu_keyboard,
-    done_adding_videos_keyboard
+    done_adding_videos_keyboard,
+    cancel_keyboard
 )
 from database.database import async_session_maker
 from database.crud import (
@@ -16,9 +17,18 @@ from database.crud import (
     create_video, 
     update_video_status,
     check_user_can_process_videos,
-    increment_daily_usage
+    increment_daily_usage,
+    get_videos_by_ids
 )
 from utils.video_processing import *
+from utils.job_executor import job_executor, map_as_completed
+from bot.delivery import result_delivery
+from bot.progress import progress_message
+from bot.cancellation import cancellable_request
+from bot.downloads import download_video, start_background, wait_for_all, cancel_background
+from bot.combinations import render_combination
+from utils.cost_model import estimate_groups, load_coefficients, plan_combinations, video_info, work_ledger
+from utils.progress import format_eta
 from config import settings
 import os
 import json
@@ -33,7 +43,7 @@ async def handle_speed_modification_video1(callback: CallbackQuery, state: FSMCo
     await callback.message.edit_text(
         "⚡ <b>Change Speed (Group 1)</b>\n\n"
         "Enter the speed multiplier (e.g., 1.5 for 1.5x speed, 0.5 for half speed):\n"
-        "Range: 0.5 to 2.0",
+        f"Range: {MIN_SPEED} to {MAX_SPEED}",
         parse_mode="HTML"
     )
     await state.update_data(modification_context='video1')
@@ -47,7 +57,7 @@ async def handle_speed_modification_video2(callback: CallbackQuery, state: FSMCo
     await callback.message.edit_text(
         "⚡ <b>Change Speed (Group 2)</b>\n\n"
         "Enter the speed multiplier (e.g., 1.5 for 1.5x speed, 0.5 for half speed):\n"
-        "Range: 0.5 to 2.0",
+        f"Range: {MIN_SPEED} to {MAX_SPEED}",
         parse_mode="HTML"
     )
     await state.update_data(modification_context='video2')
@@ -60,8 +70,8 @@ async def process_speed_input_mode2(message: Message, state: FSMContext):
     """Process speed input for Mode 2"""
     try:
         speed = float(message.text)
-        if speed < 0.5 or speed > 2.0:
-            await message.answer("❌ Speed must be between 0.5 and 2.0")
+        if speed < MIN_SPEED or speed > MAX_SPEED:
+            await message.answer(f"❌ Speed must be between {MIN_SPEED} and {MAX_SPEED}")
             return
         
         data = await state.get_data()
@@ -234,7 +244,7 @@ async def finish_modifications_video1(callback: CallbackQuery, state: FSMContext
     )
     await callback.answer()
     
-    await state.update_data(video_paths1=[], video_ids1=[])
+    await state.update_data(video_paths1=[], video_ids1=[], video_unique_ids1=[])
     await state.set_state(VideoProcessingStates.waiting_for_videos_group1)
     
     # Send the done button
@@ -255,12 +265,10 @@ async def handle_videos_group1(message: Message, state: FSMContext):
         )
         return
     
-    # Download video
-    file = await message.bot.get_file(video.file_id)
+    # Download in the background so the next upload is not held up by this one
     filename = generate_filename()
     video_path = os.path.join(settings.TEMP_VIDEO_DIR, filename)
-    
-    await message.bot.download_file(file.file_path, video_path)
+    start_background(message.from_user.id, video_path, download_video(message.bot, video.file_id, video_path))
     
     # Save video to database
     async with async_session_maker() as session:
@@ -275,19 +283,27 @@ async def handle_videos_group1(message: Message, state: FSMContext):
             user_id=user.id,
             file_id=video.file_id,
             mode=2,
-            original_filename=filename
+            original_filename=filename,
+            file_unique_id=video.file_unique_id,
+            file_size=video.file_size,
+            duration=video.duration,
+            width=video.width,
+            height=video.height
         )
         
         data = await state.get_data()
         video_paths1 = data.get('video_paths1', [])
         video_ids1 = data.get('video_ids1', [])
+        video_unique_ids1 = data.get('video_unique_ids1', [])
         
         video_paths1.append(video_path)
         video_ids1.append(db_video.id)
+        video_unique_ids1.append(video.file_unique_id)
         
         await state.update_data(
             video_paths1=video_paths1,
-            video_ids1=video_ids1
+            video_ids1=video_ids1,
+            video_unique_ids1=video_unique_ids1
         )
     
     await message.answer(
@@ -340,7 +356,7 @@ async def finish_modifications_video2(callback: CallbackQuery, state: FSMContext
     )
     await callback.answer()
     
-    await state.update_data(video_paths2=[], video_ids2=[])
+    await state.update_data(video_paths2=[], video_ids2=[], video_unique_ids2=[])
     await state.set_state(VideoProcessingStates.waiting_for_videos_group2)
     
     # Send the done button
@@ -361,12 +377,10 @@ async def handle_videos_group2(message: Message, state: FSMContext):
         )
         return
     
-    # Download video
-    file = await message.bot.get_file(video.file_id)
+    # Download in the background so the next upload is not held up by this one
     filename = generate_filename()
     video_path = os.path.join(settings.TEMP_VIDEO_DIR, filename)
-    
-    await message.bot.download_file(file.file_path, video_path)
+    start_background(message.from_user.id, video_path, download_video(message.bot, video.file_id, video_path))
     
     # Save video to database
     async with async_session_maker() as session:
@@ -381,19 +395,27 @@ async def handle_videos_group2(message: Message, state: FSMContext):
             user_id=user.id,
             file_id=video.file_id,
             mode=2,
-            original_filename=filename
+            original_filename=filename,
+            file_unique_id=video.file_unique_id,
+            file_size=video.file_size,
+            duration=video.duration,
+            width=video.width,
+            height=video.height
         )
         
         data = await state.get_data()
         video_paths2 = data.get('video_paths2', [])
         video_ids2 = data.get('video_ids2', [])
+        video_unique_ids2 = data.get('video_unique_ids2', [])
         
         video_paths2.append(video_path)
         video_ids2.append(db_video.id)
+        video_unique_ids2.append(video.file_unique_id)
         
         await state.update_data(
             video_paths2=video_paths2,
-            video_ids2=video_ids2
+            video_ids2=video_ids2,
+            video_unique_ids2=video_unique_ids2
         )
     
     await message.answer(
@@ -458,6 +480,8 @@ async def handle_merge_layout_mode2(callback: CallbackQuery, state: FSMContext):
     video_ids2 = data.get('video_ids2', [])
     modifications1 = data.get('modifications1', [])
     modifications2 = data.get('modifications2', [])
+    unique_ids1 = data.get('video_unique_ids1', [None] * len(video_paths1))
+    unique_ids2 = data.get('video_unique_ids2', [None] * len(video_paths2))
     merge_strategy = data.get('merge_strategy', 'first_with_first')
     
     # Calculate total number of output videos based on merge strategy
@@ -476,11 +500,21 @@ async def handle_merge_layout_mode2(callback: CallbackQuery, state: FSMContext):
             username=callback.from_user.username
         )
         
+        videos = await get_videos_by_ids(session, video_ids1 + video_ids2)
+        groups = [
+            ([video_info(videos[video_id]) for video_id in video_ids if video_id in videos], modifications)
+            for video_ids, modifications in ((video_ids1, modifications1), (video_ids2, modifications2))
+        ]
+        cost = estimate_groups(groups, merge_strategy, layout, await load_coefficients())
+        planned = len(plan_combinations(merge_strategy, [len(infos) for infos, _ in groups]))
         can_process, error_message = await check_user_can_process_videos(
-            session, user.id, total_output_videos
+            session, user.id, total_output_videos, cost
         )
+        if can_process:
+            can_process, error_message = work_ledger.check(cost)
         
         if not can_process:
+            cancel_background(callback.from_user.id)
             await callback.message.edit_text(
                 f"❌ {error_message}\n\n"
                 "Please try again later or upgrade your plan.",
@@ -491,124 +525,90 @@ async def handle_merge_layout_mode2(callback: CallbackQuery, state: FSMContext):
     
     await callback.message.edit_text(
         "⏳ Processing and merging your videos... Please wait.\n\n"
-        "This may take a few minutes."
+        f"Estimated time: {format_eta(work_ledger.eta(cost))}"
     )
     await callback.answer()
     
+    processed_paths1, processed_paths2 = [], []
+    merged_count = 0
+    
     try:
-        # First, apply modifications to all videos in both groups
-        processed_paths1 = []
-        for idx, video_path in enumerate(video_paths1):
-            current_path = video_path
+        async with work_ledger.admit(cost), cancellable_request(callback.from_user.id) as request, progress_message(
+            callback.message, "⏳ Processing and merging your videos...", "✅ Processing finished.", cancel_keyboard()
+        ) as progress, result_delivery(callback.message) as delivery:
+            progress.set_stage("📥 Finishing downloads")
+            await wait_for_all(callback.from_user.id, video_paths1 + video_paths2)
             
-            for i, mod in enumerate(modifications1):
-                output_path = os.path.join(settings.TEMP_VIDEO_DIR, f"temp_g1_{idx}_{i}_{generate_filename()}")
-                
-                if mod['type'] == 'speed':
-                    await change_video_speed(current_path, output_path, mod['value'])
-                elif mod['type'] == 'filter':
-                    await apply_filter(current_path, output_path, mod['value'])
-                elif mod['type'] == 'scale':
-                    await scale_video(current_path, output_path, mod['width'], mod['height'])
-                elif mod['type'] == 'rotate':
-                    await rotate_video(current_path, output_path, mod['angle'])
-                elif mod['type'] == 'text':
-                    await add_text_to_video(current_path, output_path, mod['value'], mod['x'], mod['y'])
-                
-                if current_path != video_path and os.path.exists(current_path):
-                    os.remove(current_path)
-                
-                current_path = output_path
+            # First, apply modifications to all videos in both groups. Segments that will be
+            # concatenated are normalized in the same encode so every concat is a remux
+            mezzanine = merge_strategy == 'sequential' or layout == 'sequential'
+            # Videos used in a single side-by-side merge are modified inside the merge pipeline
+            piped = settings.PIPED_STAGES_ENABLED and merge_strategy == 'first_with_first' and not mezzanine
+            # Segments share a frame in the orientation most of the videos have
+            size = await choose_mezzanine_size(
+                [(video_paths1, modifications1), (video_paths2, modifications2)]
+            ) if mezzanine else None
+            if piped:
+                processed_paths1, processed_paths2 = list(video_paths1), list(video_paths2)
+            else:
+                progress.set_stage("🎬 Applying modifications")
+                processed_paths1 = await apply_modifications_to_group(
+                    video_paths1, modifications1, prefix="temp_g1", mezzanine=mezzanine, frame_size=size
+                )
+                processed_paths2 = await apply_modifications_to_group(
+                    video_paths2, modifications2, prefix="temp_g2", mezzanine=mezzanine, frame_size=size
+                )
             
-            processed_paths1.append(current_path)
-        
-        processed_paths2 = []
-        for idx, video_path in enumerate(video_paths2):
-            current_path = video_path
+            # Every processed video as (path, source key, group modifications)
+            items1 = [(path, unique_id, modifications1) for path, unique_id in zip(processed_paths1, unique_ids1)]
+            items2 = [(path, unique_id, modifications2) for path, unique_id in zip(processed_paths2, unique_ids2)]
             
-            for i, mod in enumerate(modifications2):
-                output_path = os.path.join(settings.TEMP_VIDEO_DIR, f"temp_g2_{idx}_{i}_{generate_filename()}")
-                
-                if mod['type'] == 'speed':
-                    await change_video_speed(current_path, output_path, mod['value'])
-                elif mod['type'] == 'filter':
-                    await apply_filter(current_path, output_path, mod['value'])
-                elif mod['type'] == 'scale':
-                    await scale_video(current_path, output_path, mod['width'], mod['height'])
-                elif mod['type'] == 'rotate':
-                    await rotate_video(current_path, output_path, mod['angle'])
-                elif mod['type'] == 'text':
-                    await add_text_to_video(current_path, output_path, mod['value'], mod['x'], mod['y'])
-                
-                if current_path != video_path and os.path.exists(current_path):
-                    os.remove(current_path)
-                
-                current_path = output_path
+            # Now merge based on strategy
+            progress.set_stage("🔗 Merging")
             
-            processed_paths2.append(current_path)
-        
-        # Now merge based on strategy
-        merged_count = 0
-        
-        if merge_strategy == 'first_with_first':
-            # Pair first with first, second with second, etc.
-            pairs = min(len(processed_paths1), len(processed_paths2))
-            for i in range(pairs):
-                final_filename = generate_filename()
-                final_path = os.path.join(settings.PROCESSED_VIDEO_DIR, final_filename)
+            if merge_strategy == 'first_with_first':
+                # Pair first with first, second with second, etc.
+                pairs = min(len(items1), len(items2))
+                for i in range(pairs):
+                    final_path = await render_combination(2, [items1[i], items2[i]], layout, piped, size)
+                    
+                    # Send merged video while the next pair is rendered
+                    delivery.send(final_path, f"✅ Merged video {i + 1}/{pairs} is ready!")
+            
+            elif merge_strategy == 'all_with_all':
+                # Cartesian product - every video from group 1 with every video from group 2,
+                # rendered several at a time and sent as soon as each is ready
+                pairs = ((i, j) for i in range(len(items1)) for j in range(len(items2)))
                 
-                if layout == 'horizontal':
-                    await merge_videos(processed_paths1[i], processed_paths2[i], final_path, 'horizontal')
-                elif layout == 'vertical':
-                    await merge_videos(processed_paths1[i], processed_paths2[i], final_path, 'vertical')
-                elif layout == 'sequential':
-                    await concatenate_videos([processed_paths1[i], processed_paths2[i]], final_path)
+                async for (i, j), final_path in map_as_completed(
+                    lambda pair: render_combination(2, [items1[pair[0]], items2[pair[1]]], layout, frame_size=size),
+                    pairs,
+                    job_executor.max_workers
+                ):
+                    # Send merged video
+                    delivery.send(final_path, f"✅ Merged: G1[{i+1}] + G2[{j+1}]")
+            
+            elif merge_strategy == 'sequential':
+                # All from group 1, then all from group 2
+                final_path = await render_combination(2, items1 + items2, 'sequential', frame_size=size)
                 
                 # Send merged video
-                with open(final_path, 'rb') as video_file:
-                    await callback.message.answer_video(
-                        video=video_file,
-                        caption=f"✅ Merged video {i + 1}/{pairs} is ready!"
-                    )
-                merged_count += 1
-        
-        elif merge_strategy == 'all_with_all':
-            # Cartesian product - every video from group 1 with every video from group 2
-            for i, path1 in enumerate(processed_paths1):
-                for j, path2 in enumerate(processed_paths2):
-                    final_filename = generate_filename()
-                    final_path = os.path.join(settings.PROCESSED_VIDEO_DIR, final_filename)
-                    
-                    if layout == 'horizontal':
-                        await merge_videos(path1, path2, final_path, 'horizontal')
-                    elif layout == 'vertical':
-                        await merge_videos(path1, path2, final_path, 'vertical')
-                    elif layout == 'sequential':
-                        await concatenate_videos([path1, path2], final_path)
-                    
-                    # Send merged video
-                    with open(final_path, 'rb') as video_file:
-                        await callback.message.answer_video(
-                            video=video_file,
-                            caption=f"✅ Merged: G1[{i+1}] + G2[{j+1}]"
-                        )
-                    merged_count += 1
+                delivery.send(final_path, f"✅ All videos merged sequentially!")
         
-        elif merge_strategy == 'sequential':
-            # All from group 1, then all from group 2
-            final_filename = generate_filename()
-            final_path = os.path.join(settings.PROCESSED_VIDEO_DIR, final_filename)
+        merged_count = delivery.sent
+        if request.cancelled:
+            # Record the videos as cancelled and drop every temporary file
+            async with async_session_maker() as session:
+                for video_id in video_ids1 + video_ids2:
+                    await update_video_status(session, video_id, "cancelled")
+                if merged_count:
+                    user = await get_or_create_user(session, telegram_id=callback.from_user.id)
+                    await increment_daily_usage(session, user.id, merged_count, cost * merged_count / max(planned, 1))
             
-            all_videos = processed_paths1 + processed_paths2
-            await concatenate_videos(all_videos, final_path)
-            
-            # Send merged video
-            with open(final_path, 'rb') as video_file:
-                await callback.message.answer_video(
-                    video=video_file,
-                    caption=f"✅ All videos merged sequentially!"
-                )
-            merged_count = 1
+            for path in video_paths1 + video_paths2 + processed_paths1 + processed_paths2:
+                if os.path.exists(path):
+                    os.remove(path)
+            return
         
         # Update database
         async with async_session_maker() as session:
@@ -639,7 +639,7 @@ async def handle_merge_layout_mode2(callback: CallbackQuery, state: FSMContext):
                 telegram_id=callback.from_user.id,
                 username=callback.from_user.username
             )
-            await increment_daily_usage(session, user.id, merged_count)
+            await increment_daily_usage(session, user.id, merged_count, cost * merged_count / max(planned, 1))
         
         await callback.message.answer(
             f"🎉 Processing complete!\n\n"
@@ -10,7 +10,8 @@ from bot.keyboards import (
     video_modifications_keyboard,
     filter_selection_keyboard,
     main_menu_keyboard,
-    done_adding_videos_keyboard
+    done_adding_videos_keyboard,
+    cancel_keyboard
 )
 from database.database import async_session_maker
 from database.crud import (
@@ -18,9 +19,18 @@ from database.crud import (
     create_video, 
     update_video_status,
     check_user_can_process_videos,
-    increment_daily_usage
+    increment_daily_usage,
+    get_videos_by_ids
 )
 from utils.video_processing import *
+from utils.job_executor import job_executor, map_as_completed
+from bot.delivery import result_delivery
+from bot.progress import progress_message
+from bot.cancellation import cancellable_request
+from bot.downloads import download_video, start_background, wait_for_all, cancel_background
+from bot.combinations import render_combination
+from utils.cost_model import estimate_groups, load_coefficients, plan_combinations, video_info, work_ledger
+from utils.progress import format_eta
 from config import settings
 import os
 import json
@@ -60,7 +70,7 @@ async def handle_speed_modification_group(callback: CallbackQuery, state: FSMCon
     await callback.message.edit_text(
         f"⚡ <b>Change Speed (Group {current_group})</b>\n\n"
         "Enter the speed multiplier (e.g., 1.5 for 1.5x speed, 0.5 for half speed):\n"
-        "Range: 0.5 to 2.0",
+        f"Range: {MIN_SPEED} to {MAX_SPEED}",
         parse_mode="HTML"
     )
     await state.set_state(VideoProcessingStates.waiting_for_speed_input)
@@ -121,8 +131,8 @@ async def process_speed_input_moden(message: Message, state: FSMContext):
     """Process speed input for Mode N"""
     try:
         speed = float(message.text)
-        if speed < 0.5 or speed > 2.0:
-            await message.answer("❌ Speed must be between 0.5 and 2.0")
+        if speed < MIN_SPEED or speed > MAX_SPEED:
+            await message.answer(f"❌ Speed must be between {MIN_SPEED} and {MAX_SPEED}")
             return
         
         data = await state.get_data()
@@ -187,7 +197,8 @@ async def finish_modifications_group(callback: CallbackQuery, state: FSMContext)
     groups_data[f'group_{current_group}'] = {
         'modifications': modifications,
         'video_paths': [],
-        'video_ids': []
+        'video_ids': [],
+        'video_unique_ids': []
     }
     await state.update_data(groups_data=groups_data, modifications=[])
     await state.set_state(VideoProcessingStates.waiting_for_videos_group)
@@ -210,12 +221,10 @@ async def handle_videos_group(message: Message, state: FSMContext):
         )
         return
     
-    # Download video
-    file = await message.bot.get_file(video.file_id)
+    # Download in the background so the next upload is not held up by this one
     filename = generate_filename()
     video_path = os.path.join(settings.TEMP_VIDEO_DIR, filename)
-    
-    await message.bot.download_file(file.file_path, video_path)
+    start_background(message.from_user.id, video_path, download_video(message.bot, video.file_id, video_path))
     
     # Save video to database
     async with async_session_maker() as session:
@@ -230,7 +239,12 @@ async def handle_videos_group(message: Message, state: FSMContext):
             user_id=user.id,
             file_id=video.file_id,
             mode=3,  # Mode N
-            original_filename=filename
+            original_filename=filename,
+            file_unique_id=video.file_unique_id,
+            file_size=video.file_size,
+            duration=video.duration,
+            width=video.width,
+            height=video.height
         )
         
         data = await state.get_data()
@@ -239,10 +253,11 @@ async def handle_videos_group(message: Message, state: FSMContext):
         
         group_key = f'group_{current_group}'
         if group_key not in groups_data:
-            groups_data[group_key] = {'modifications': [], 'video_paths': [], 'video_ids': []}
+            groups_data[group_key] = {'modifications': [], 'video_paths': [], 'video_ids': [], 'video_unique_ids': []}
         
         groups_data[group_key]['video_paths'].append(video_path)
         groups_data[group_key]['video_ids'].append(db_video.id)
+        groups_data[group_key].setdefault('video_unique_ids', []).append(video.file_unique_id)
         
         await state.update_data(groups_data=groups_data)
         
@@ -316,10 +331,10 @@ async def handle_combine_strategy(callback: CallbackQuery, state: FSMContext):
     )
     await callback.answer()
     
-    await state.set_state(VideoProcessingStates.selecting_merge_layout)
+    await state.set_state(VideoProcessingStates.selecting_combine_layout)
 
 
-@router.callback_query(VideoProcessingStates.selecting_merge_layout, F.data.startswith("merge_"))
+@router.callback_query(VideoProcessingStates.selecting_combine_layout, F.data.startswith("merge_"))
 async def handle_merge_layout_moden(callback: CallbackQuery, state: FSMContext):
     """Handle merge layout selection and process videos for mode N"""
     layout = callback.data.replace("merge_", "")
@@ -343,7 +358,7 @@ async def handle_merge_layout_moden(callback: CallbackQuery, state: FSMContext):
         # Calculate Cartesian product
         from functools import reduce
         import operator
-        total_output_videos = reduce(operator.mul, video_counts, 1)
+        total_output_videos = min(reduce(operator.mul, video_counts, 1), settings.MAX_CARTESIAN_COMBINATIONS)
     else:
         total_output_videos = min(video_counts) if video_counts else 0
     
@@ -355,11 +370,31 @@ async def handle_merge_layout_moden(callback: CallbackQuery, state: FSMContext):
             username=callback.from_user.username
         )
         
+        group_ids = [
+            groups_data.get(f'group_{i}', {}).get('video_ids', []) for i in range(1, num_groups + 1)
+        ]
+        videos = await get_videos_by_ids(session, [video_id for video_ids in group_ids for video_id in video_ids])
+        groups = [
+            (
+                [video_info(videos[video_id]) for video_id in video_ids if video_id in videos],
+                groups_data.get(f'group_{i}', {}).get('modifications', [])
+            )
+            for i, video_ids in enumerate(group_ids, start=1)
+        ]
+        cost = estimate_groups(
+            groups, combine_strategy, layout, await load_coefficients(), settings.MAX_CARTESIAN_COMBINATIONS
+        )
+        planned = len(plan_combinations(
+            combine_strategy, [len(infos) for infos, _ in groups], settings.MAX_CARTESIAN_COMBINATIONS
+        ))
         can_process, error_message = await check_user_can_process_videos(
-            session, user.id, total_output_videos
+            session, user.id, total_output_videos, cost
         )
+        if can_process:
+            can_process, error_message = work_ledger.check(cost)
         
         if not can_process:
+            cancel_background(callback.from_user.id)
             await callback.message.edit_text(
                 f"❌ {error_message}\n\n"
                 "Please try again later or upgrade your plan.",
@@ -370,151 +405,120 @@ async def handle_merge_layout_moden(callback: CallbackQuery, state: FSMContext):
     
     await callback.message.edit_text(
         "⏳ Processing and combining your videos... Please wait.\n\n"
-        "This may take several minutes."
+        f"Estimated time: {format_eta(work_ledger.eta(cost))}"
     )
     await callback.answer()
     
+    combined_count = 0
+    all_processed = {}
+    all_ids = [video_id for video_ids in group_ids for video_id in video_ids]
+    
     try:
-        # First, apply modifications to all videos in all groups
-        all_processed = {}
-        all_ids = []
-        
-        for i in range(1, num_groups + 1):
-            group_key = f'group_{i}'
-            group_info = groups_data.get(group_key, {})
-            video_paths = group_info.get('video_paths', [])
-            modifications = group_info.get('modifications', [])
-            video_ids = group_info.get('video_ids', [])
+        async with work_ledger.admit(cost), cancellable_request(callback.from_user.id) as request, progress_message(
+            callback.message, "⏳ Processing and combining your videos...", "✅ Processing finished.", cancel_keyboard()
+        ) as progress, result_delivery(callback.message, settings.DELIVERY_ALBUM_SIZE) as delivery:
+            progress.set_stage("📥 Finishing downloads")
+            await wait_for_all(callback.from_user.id, [
+                path
+                for i in range(1, num_groups + 1)
+                for path in groups_data.get(f'group_{i}', {}).get('video_paths', [])
+            ])
             
-            all_ids.extend(video_ids)
-            processed_paths = []
+            # First, apply modifications to all videos in all groups. Segments that will be
+            # concatenated are normalized in the same encode so every concat is a remux
+            mezzanine = combine_strategy == 'sequential' or layout == 'sequential'
+            # Videos used in a single side-by-side merge are modified inside the merge pipeline
+            piped = settings.PIPED_STAGES_ENABLED and combine_strategy == 'first_with_first' and not mezzanine
+            # Segments share a frame in the orientation most of the videos have
+            size = await choose_mezzanine_size([
+                (groups_data.get(f'group_{i}', {}).get('video_paths', []),
+                 groups_data.get(f'group_{i}', {}).get('modifications', []))
+                for i in range(1, num_groups + 1)
+            ]) if mezzanine else None
             
-            for idx, video_path in enumerate(video_paths):
-                current_path = video_path
-                
-                for j, mod in enumerate(modifications):
-                    output_path = os.path.join(settings.TEMP_VIDEO_DIR, f"temp_g{i}_{idx}_{j}_{generate_filename()}")
-                    
-                    if mod['type'] == 'speed':
-                        await change_video_speed(current_path, output_path, mod['value'])
-                    elif mod['type'] == 'filter':
-                        await apply_filter(current_path, output_path, mod['value'])
-                    elif mod['type'] == 'scale':
-                        await scale_video(current_path, output_path, mod['width'], mod['height'])
-                    elif mod['type'] == 'rotate':
-                        await rotate_video(current_path, output_path, mod['angle'])
-                    elif mod['type'] == 'text':
-                        await add_text_to_video(current_path, output_path, mod['value'], mod['x'], mod['y'])
-                    
-                    if current_path != video_path and os.path.exists(current_path):
-                        os.remove(current_path)
-                    
-                    current_path = output_path
+            for i in range(1, num_groups + 1):
+                group_key = f'group_{i}'
+                group_info = groups_data.get(group_key, {})
+                video_paths = group_info.get('video_paths', [])
+                modifications = group_info.get('modifications', [])
                 
-                processed_paths.append(current_path)
+                if piped:
+                    all_processed[group_key] = list(video_paths)
+                    continue
+                progress.set_stage(f"🎬 Group {i}/{num_groups}")
+                all_processed[group_key] = await apply_modifications_to_group(
+                    video_paths, modifications, prefix=f"temp_g{i}", mezzanine=mezzanine, frame_size=size
+                )
             
-            all_processed[group_key] = processed_paths
-        
-        # Now combine based on strategy
-        combined_count = 0
-        
-        if combine_strategy == 'sequential':
-            # Concatenate all videos sequentially: all from group 1, then group 2, etc.
-            all_videos = []
+            # Every processed video as (path, source key, group modifications)
+            group_items = []
             for i in range(1, num_groups + 1):
-                all_videos.extend(all_processed.get(f'group_{i}', []))
+                group_info = groups_data.get(f'group_{i}', {})
+                processed_paths = all_processed.get(f'group_{i}', [])
+                unique_ids = group_info.get('video_unique_ids', [None] * len(processed_paths))
+                modifications = group_info.get('modifications', [])
+                group_items.append([(path, unique_id, modifications) for path, unique_id in zip(processed_paths, unique_ids)])
             
-            if all_videos:
-                final_filename = generate_filename()
-                final_path = os.path.join(settings.PROCESSED_VIDEO_DIR, final_filename)
-                await concatenate_videos(all_videos, final_path)
-                
-                with open(final_path, 'rb') as video_file:
-                    await callback.message.answer_video(
-                        video=video_file,
-                        caption=f"✅ All videos merged sequentially!"
-                    )
-                combined_count = 1
-        
-        elif combine_strategy == 'first_with_first':
-            # Take first video from each group and combine, then second from each group, etc.
-            max_videos = max(len(all_processed.get(f'group_{i}', [])) for i in range(1, num_groups + 1))
+            # Now combine based on strategy
+            progress.set_stage("🔗 Combining")
             
-            for vid_idx in range(max_videos):
-                videos_to_merge = []
-                for i in range(1, num_groups + 1):
-                    group_videos = all_processed.get(f'group_{i}', [])
-                    if vid_idx < len(group_videos):
-                        videos_to_merge.append(group_videos[vid_idx])
+            if combine_strategy == 'sequential':
+                # Concatenate all videos sequentially: all from group 1, then group 2, etc.
+                all_videos = [item for items in group_items for item in items]
                 
-                if len(videos_to_merge) >= 2:
-                    final_filename = generate_filename()
-                    final_path = os.path.join(settings.PROCESSED_VIDEO_DIR, final_filename)
+                if all_videos:
+                    final_path = await render_combination(3, all_videos, 'sequential', frame_size=size)
                     
-                    if layout == 'sequential':
-                        await concatenate_videos(videos_to_merge, final_path)
-                    else:
-                        # For horizontal/vertical, merge first two, then add third, etc.
-                        temp_path = videos_to_merge[0]
-                        for j in range(1, len(videos_to_merge)):
-                            if j == len(videos_to_merge) - 1:
-                                output = final_path
-                            else:
-                                output = os.path.join(settings.TEMP_VIDEO_DIR, f"merge_temp_{j}_{generate_filename()}")
-                            
-                            if layout == 'horizontal':
-                                await merge_videos(temp_path, videos_to_merge[j], output, 'horizontal')
-                            elif layout == 'vertical':
-                                await merge_videos(temp_path, videos_to_merge[j], output, 'vertical')
-                            
-                            if temp_path != videos_to_merge[0] and os.path.exists(temp_path):
-                                os.remove(temp_path)
-                            temp_path = output
-                    
-                    with open(final_path, 'rb') as video_file:
-                        await callback.message.answer_video(
-                            video=video_file,
-                            caption=f"✅ Combined video {vid_idx + 1}/{max_videos}"
-                        )
-                    combined_count += 1
-        
-        elif combine_strategy == 'all_with_all':
-            # Cartesian product of all groups
-            import itertools
+                    delivery.send(final_path, f"✅ All videos merged sequentially!")
             
-            group_lists = [all_processed.get(f'group_{i}', []) for i in range(1, num_groups + 1)]
-            combinations = list(itertools.product(*group_lists))
-            
-            for combo_idx, combo in enumerate(combinations[:settings.MAX_CARTESIAN_COMBINATIONS]):
-                final_filename = generate_filename()
-                final_path = os.path.join(settings.PROCESSED_VIDEO_DIR, final_filename)
+            elif combine_strategy == 'first_with_first':
+                # Take first video from each group and combine, then second from each group, etc.
+                max_videos = max(len(items) for items in group_items)
                 
-                if layout == 'sequential':
-                    await concatenate_videos(list(combo), final_path)
-                else:
-                    # For horizontal/vertical, merge progressively
-                    temp_path = combo[0]
-                    for j in range(1, len(combo)):
-                        if j == len(combo) - 1:
-                            output = final_path
-                        else:
-                            output = os.path.join(settings.TEMP_VIDEO_DIR, f"combo_{combo_idx}_{j}_{generate_filename()}")
-                        
-                        if layout == 'horizontal':
-                            await merge_videos(temp_path, combo[j], output, 'horizontal')
-                        elif layout == 'vertical':
-                            await merge_videos(temp_path, combo[j], output, 'vertical')
+                for vid_idx in range(max_videos):
+                    videos_to_merge = [items[vid_idx] for items in group_items if vid_idx < len(items)]
+                    
+                    if len(videos_to_merge) >= 2:
+                        final_path = await render_combination(3, videos_to_merge, layout, piped, size)
                         
-                        if temp_path != combo[0] and os.path.exists(temp_path):
-                            os.remove(temp_path)
-                        temp_path = output
+                        delivery.send(final_path, f"✅ Combined video {vid_idx + 1}/{max_videos}")
+            
+            elif combine_strategy == 'all_with_all':
+                # Cartesian product of all groups, generated lazily and rendered several at a time;
+                # finished combinations are sent in albums while the rest keep rendering
+                import itertools
+                
+                combinations = enumerate(itertools.islice(
+                    itertools.product(*group_items), settings.MAX_CARTESIAN_COMBINATIONS
+                ))
                 
-                with open(final_path, 'rb') as video_file:
-                    await callback.message.answer_video(
-                        video=video_file,
-                        caption=f"✅ Combination {combo_idx + 1}"
-                    )
-                combined_count += 1
+                async for (combo_idx, _), final_path in map_as_completed(
+                    lambda indexed: render_combination(3, list(indexed[1]), layout, frame_size=size),
+                    combinations,
+                    job_executor.max_workers
+                ):
+                    delivery.send(final_path, f"✅ Combination {combo_idx + 1}")
+        
+        combined_count = delivery.sent
+        if request.cancelled:
+            # Record the videos as cancelled and drop every temporary file
+            async with async_session_maker() as session:
+                for video_id in all_ids:
+                    await update_video_status(session, video_id, "cancelled")
+                if combined_count:
+                    user = await get_or_create_user(session, telegram_id=callback.from_user.id)
+                    await increment_daily_usage(session, user.id, combined_count, cost * combined_count / max(planned, 1))
+            
+            for group_key in all_processed:
+                for path in all_processed[group_key]:
+                    if os.path.exists(path):
+                        os.remove(path)
+            
+            for i in range(1, num_groups + 1):
+                for path in groups_data.get(f'group_{i}', {}).get('video_paths', []):
+                    if os.path.exists(path):
+                        os.remove(path)
+            return
         
         # Update database
         async with async_session_maker() as session:
@@ -545,7 +549,7 @@ async def handle_merge_layout_moden(callback: CallbackQuery, state: FSMContext):
                 telegram_id=callback.from_user.id,
                 username=callback.from_user.username
             )
-            await increment_daily_usage(session, user.id, combined_count)
+            await increment_daily_usage(session, user.id, combined_count, cost * combined_count / max(planned, 1))
         
         await callback.message.answer(
             f"🎉 Processing complete!\n\n"
@@ -564,5 +568,15 @@ async def handle_merge_layout_moden(callback: CallbackQuery, state: FSMContext):
         async with async_session_maker() as session:
             for video_id in all_ids:
                 await update_video_status(session, video_id, "failed")
+        
+        cancel_background(callback.from_user.id)
+        for group_key in all_processed:
+            for path in all_processed[group_key]:
+                if os.path.exists(path):
+                    os.remove(path)
+        for i in range(1, num_groups + 1):
+            for path in groups_data.get(f'group_{i}', {}).get('video_paths', []):
+                if os.path.exists(path):
+                    os.remove(path)
     
     await state.clear()
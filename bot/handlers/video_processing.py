@@ -1,12 +1,14 @@
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, FSInputFile
 from aiogram.fsm.context import FSMContext
 from bot.states import VideoProcessingStates
 from bot.keyboards import (
     video_modifications_keyboard,
     filter_selection_keyboard,
     main_menu_keyboard,
-    done_adding_videos_keyboard
+    done_adding_videos_keyboard,
+    preview_keyboard,
+    cancel_keyboard
 )
 from database.database import async_session_maker
 from database.crud import (
@@ -14,12 +16,30 @@ from database.crud import (
     create_video, 
     update_video_status,
     check_user_can_process_videos,
-    increment_daily_usage
+    increment_daily_usage,
+    set_video_output_file_id,
+    set_video_uniqueness_score,
+    get_videos_by_ids
 )
 from utils.video_processing import *
+from utils.job_executor import job_executor
+from utils.result_cache import make_cache_key, get_or_render
+from utils.uniqueness import generate_variants_to_target, measure_outputs
+from bot.delivery import result_delivery, with_retry
+from bot.progress import progress_message
+from bot.cancellation import cancellable_request, cancel_request
+from bot.downloads import download_video, start_background, wait_for, cancel_background
+from bot.encode_stats import recording_encode_stats
+from utils.cost_model import estimate_videos, load_coefficients, video_info, work_ledger
+from utils.progress import format_eta
 from config import settings
 import os
 import json
+import random
+import logging
+from functools import partial
+
+logger = logging.getLogger(__name__)
 
 router = Router()
 
@@ -31,7 +51,7 @@ async def handle_speed_modification_mode1(callback: CallbackQuery, state: FSMCon
     await callback.message.edit_text(
         "⚡ <b>Change Speed</b>\n\n"
         "Enter the speed multiplier (e.g., 1.5 for 1.5x speed, 0.5 for half speed):\n"
-        "Range: 0.5 to 2.0",
+        f"Range: {MIN_SPEED} to {MAX_SPEED}",
         parse_mode="HTML"
     )
     await state.set_state(VideoProcessingStates.waiting_for_speed_input)
@@ -43,8 +63,8 @@ async def process_speed_input(message: Message, state: FSMContext):
     """Process speed input"""
     try:
         speed = float(message.text)
-        if speed < 0.5 or speed > 2.0:
-            await message.answer("❌ Speed must be between 0.5 and 2.0")
+        if speed < MIN_SPEED or speed > MAX_SPEED:
+            await message.answer(f"❌ Speed must be between {MIN_SPEED} and {MAX_SPEED}")
             return
         
         data = await state.get_data()
@@ -55,7 +75,7 @@ async def process_speed_input(message: Message, state: FSMContext):
         await message.answer(
             f"✅ Speed set to {speed}x\n\n"
             "Select more modifications or click Done:",
-            reply_markup=video_modifications_keyboard()
+            reply_markup=video_modifications_keyboard(variants=True)
         )
         await state.set_state(VideoProcessingStates.selecting_modifications_mode1)
     except ValueError:
@@ -87,7 +107,7 @@ async def apply_filter_selection_mode1(callback: CallbackQuery, state: FSMContex
     await callback.message.edit_text(
         f"✅ Filter '{filter_name}' added!\n\n"
         "Select more modifications or click Done:",
-        reply_markup=video_modifications_keyboard()
+        reply_markup=video_modifications_keyboard(variants=True)
     )
     await callback.answer()
 
@@ -128,7 +148,7 @@ async def process_scale_input(message: Message, state: FSMContext):
         await message.answer(
             f"✅ Scale set to {width}x{height}\n\n"
             "Select more modifications or click Done:",
-            reply_markup=video_modifications_keyboard()
+            reply_markup=video_modifications_keyboard(variants=True)
         )
         await state.set_state(VideoProcessingStates.selecting_modifications_mode1)
     except ValueError:
@@ -168,7 +188,7 @@ async def process_rotate_input(message: Message, state: FSMContext):
         await message.answer(
             f"✅ Rotation set to {angle}°\n\n"
             "Select more modifications or click Done:",
-            reply_markup=video_modifications_keyboard()
+            reply_markup=video_modifications_keyboard(variants=True)
         )
         await state.set_state(VideoProcessingStates.selecting_modifications_mode1)
     except ValueError:
@@ -200,7 +220,45 @@ async def process_text_input(message: Message, state: FSMContext):
     await message.answer(
         f"✅ Text added: '{text}'\n\n"
         "Select more modifications or click Done:",
-        reply_markup=video_modifications_keyboard()
+        reply_markup=video_modifications_keyboard(variants=True)
+    )
+    await state.set_state(VideoProcessingStates.selecting_modifications_mode1)
+
+
+@router.callback_query(VideoProcessingStates.selecting_modifications_mode1, F.data == "mod_variants")
+async def handle_variants_mode1(callback: CallbackQuery, state: FSMContext):
+    """Ask how many unique copies to make of every video"""
+    await callback.message.edit_text(
+        "🎲 <b>Unique Copies</b>\n\n"
+        f"How many unique copies of each video do you need? (2 to {settings.MAX_VARIANTS})\n"
+        "Every copy gets its own slight crop, color, grain, speed and metadata changes.\n\n"
+        "To repeat an earlier set, add its seed: <code>5 123456</code>",
+        parse_mode="HTML"
+    )
+    await state.set_state(VideoProcessingStates.waiting_for_variants_input)
+    await callback.answer()
+
+
+@router.message(VideoProcessingStates.waiting_for_variants_input)
+async def process_variants_input(message: Message, state: FSMContext):
+    """Process the number of unique copies and an optional seed"""
+    try:
+        parts = (message.text or "").split()
+        count = int(parts[0])
+        seed = int(parts[1]) if len(parts) > 1 else random.randint(100000, 999999)
+    except (ValueError, IndexError):
+        await message.answer("❌ Invalid input. Please enter a number, optionally followed by a seed.")
+        return
+    
+    if count < 2 or count > settings.MAX_VARIANTS:
+        await message.answer(f"❌ Number of copies must be between 2 and {settings.MAX_VARIANTS}")
+        return
+    
+    await state.update_data(variants=count, variant_seed=seed)
+    await message.answer(
+        f"✅ {count} unique copies per video (seed {seed})\n\n"
+        "Select more modifications or click Done:",
+        reply_markup=video_modifications_keyboard(variants=True)
     )
     await state.set_state(VideoProcessingStates.selecting_modifications_mode1)
 
@@ -212,6 +270,9 @@ async def finish_modifications_mode1(callback: CallbackQuery, state: FSMContext)
     modifications = data.get('modifications', [])
     
     mod_summary = "\n".join([f"• {mod['type'].title()}" for mod in modifications])
+    if data.get('variants', 1) > 1:
+        mod_summary += f"\n• {data['variants']} unique copies (seed {data['variant_seed']})"
+    mod_summary = mod_summary.strip()
     if not mod_summary:
         mod_summary = "No modifications selected"
     
@@ -225,7 +286,12 @@ async def finish_modifications_mode1(callback: CallbackQuery, state: FSMContext)
     )
     await callback.answer()
     
-    await state.update_data(video_paths=[], video_ids=[])
+    if data.get('video_paths'):
+        # Modifications were changed after a preview: preview the new chain on the same upload
+        await _send_preview(callback.message, state)
+        return
+    
+    await state.update_data(video_paths=[], video_ids=[], video_unique_ids=[])
     await state.set_state(VideoProcessingStates.waiting_for_videos_mode1)
     
     # Send the done button
@@ -235,6 +301,175 @@ async def finish_modifications_mode1(callback: CallbackQuery, state: FSMContext)
     )
 
 
+async def _render_video(video_path: str, unique_id: str, modifications: list,
+                        variants: int = 1, seed: int = 0, video_id: int = None) -> tuple:
+    """
+    Render the outputs of one upload: a single processed video or `variants` unique copies.
+    Returns the output paths and, when the copies were tuned to the uniqueness target,
+    their scores (else an empty list). The ffmpeg stats of the encode are stored for the Video `video_id`.
+    """
+    if variants > 1:
+        # All copies come from one decode of the input
+        output_paths = [os.path.join(settings.PROCESSED_VIDEO_DIR, generate_filename()) for _ in range(variants)]
+        tuned = settings.UNIQUENESS_ANALYSIS_ENABLED and settings.UNIQUENESS_TARGET > 0
+        job = generate_variants_to_target if tuned else generate_variants
+        async with recording_encode_stats(1, job.__name__, [video_path], video_id):
+            result = await job_executor.submit(job, video_path, output_paths, seed, modifications)
+        if not (result[0] if tuned else result):
+            raise RuntimeError("Video processing failed")
+        return output_paths, result[1] if tuned else []
+    
+    # Process video with all modifications in a single ffmpeg pass,
+    # or reuse the output of an identical earlier job
+    output_path = os.path.join(settings.PROCESSED_VIDEO_DIR, generate_filename())
+    async with recording_encode_stats(1, 'apply_modifications', [video_path], video_id):
+        return [await get_or_render(
+            make_cache_key([unique_id], modifications),
+            output_path,
+            lambda: job_executor.submit(apply_modifications, video_path, output_path, modifications)
+        )], []
+
+
+async def _measure_uniqueness(video_path: str, output_paths: list) -> list:
+    """Uniqueness score of each output, or an empty list if analysis is off or fails"""
+    if not settings.UNIQUENESS_ANALYSIS_ENABLED:
+        return []
+    try:
+        return await measure_outputs(video_path, output_paths)
+    except Exception as e:
+        # The score is informational, never fail a finished video over it
+        logger.warning(f"Uniqueness analysis failed for {video_path}: {e}")
+        return []
+
+
+async def _prepare_video(bot, file_id: str, video_path: str, unique_id: str,
+                         modifications: list, variants: int, seed: int, eager: bool, video_id: int = None,
+                         cpu_seconds: float = 0.0):
+    """
+    Download an upload and, with `eager`, render it; returns _render_video()'s result or None.
+    The estimated `cpu_seconds` of the render count in the backlog until it ends.
+    """
+    async with work_ledger.admit(cpu_seconds if eager else 0.0):
+        await download_video(bot, file_id, video_path)
+        if not eager:
+            return None
+        return await _render_video(video_path, unique_id, modifications, variants, seed, video_id)
+
+
+async def _render_admitted(cpu_seconds: float, *args) -> tuple:
+    """_render_video() counting its estimated `cpu_seconds` in the backlog"""
+    async with work_ledger.admit(cpu_seconds):
+        return await _render_video(*args)
+
+
+async def _admit_eager(session, user_id: int, video_count: int, cpu_seconds: float,
+                       eager_cpu_seconds: float) -> bool:
+    """
+    Whether an upload may be encoded before Done: the order so far (`video_count` outputs,
+    `eager_cpu_seconds` admitted earlier plus `cpu_seconds`) must fit the plan and the backlog
+    """
+    can_process = (await check_user_can_process_videos(
+        session, user_id, video_count, eager_cpu_seconds + cpu_seconds
+    ))[0]
+    return can_process and work_ledger.check(cpu_seconds, eager_cpu_seconds)[0]
+
+
+async def _charge_eager(telegram_id: int, data: dict):
+    """Charge the compute budget for encodes started before the order was dropped"""
+    if data.get('eager_cpu_seconds'):
+        async with async_session_maker() as session:
+            user = await get_or_create_user(session, telegram_id=telegram_id)
+            await increment_daily_usage(session, user.id, 0, data['eager_cpu_seconds'])
+
+
+async def _send_preview(message: Message, state: FSMContext):
+    """Render the configured chain on the first upload and ask the user to confirm it"""
+    await state.set_state(VideoProcessingStates.confirming_preview_mode1)
+    data = await state.get_data()
+    variant_seed = data.get('variant_seed') if data.get('variants', 1) > 1 else None
+    preview_path = os.path.join(settings.TEMP_VIDEO_DIR, f"preview_{generate_filename()}")
+    status = await message.answer("⏳ Rendering a preview...")
+    try:
+        if not await render_preview(data['video_paths'][0], preview_path,
+                                    data.get('modifications', []), variant_seed):
+            raise RuntimeError("Preview rendering failed")
+        await with_retry(lambda: message.answer_video(
+            video=FSInputFile(preview_path),
+            caption=f"👁 {settings.PREVIEW_SECONDS:g}-second low-resolution preview of your modifications.\n"
+                    "Continue to process your videos in full quality, or change the modifications.",
+            reply_markup=preview_keyboard()
+        ))
+    except Exception as e:
+        await message.answer(
+            f"❌ Could not render a preview: {str(e)}\n\n"
+            "You can continue anyway or change the modifications.",
+            reply_markup=preview_keyboard()
+        )
+    finally:
+        if os.path.exists(preview_path):
+            os.remove(preview_path)
+        await status.delete()
+
+
+@router.message(VideoProcessingStates.confirming_preview_mode1, F.video)
+async def handle_video_during_preview(message: Message, state: FSMContext):
+    """More uploads have to wait until the preview is confirmed"""
+    await message.answer("👁 Please confirm or change the preview first, then send this video again.")
+
+
+@router.callback_query(VideoProcessingStates.confirming_preview_mode1, F.data == "preview_ok")
+async def confirm_preview_mode1(callback: CallbackQuery, state: FSMContext):
+    """Accept the previewed modifications and start encoding the previewed upload"""
+    await callback.answer()
+    await callback.message.edit_reply_markup(reply_markup=None)
+    await state.update_data(preview_confirmed=True)
+    await state.set_state(VideoProcessingStates.waiting_for_videos_mode1)
+    
+    data = await state.get_data()
+    video_path = data['video_paths'][0]
+    variants = data.get('variants', 1)
+    if settings.EAGER_ENCODING_ENABLED:
+        async with async_session_maker() as session:
+            user = await get_or_create_user(
+                session,
+                telegram_id=callback.from_user.id,
+                username=callback.from_user.username
+            )
+            videos = await get_videos_by_ids(session, data['video_ids'][:1])
+            cost = estimate_videos(
+                [video_info(video) for video in videos.values()],
+                data.get('modifications', []), await load_coefficients(), variants
+            )
+            eager = await _admit_eager(session, user.id, variants, cost, 0.0)
+        if eager:
+            await state.update_data(eager_cpu_seconds=cost)
+            start_background(
+                callback.from_user.id,
+                video_path,
+                _render_admitted(cost, video_path, data['video_unique_ids'][0], data.get('modifications', []),
+                                 variants, data.get('variant_seed', 0), data['video_ids'][0])
+            )
+    
+    await callback.message.answer(
+        "✅ Modifications confirmed!\n\n"
+        "Send more videos or click 'Done' to start processing.",
+        reply_markup=done_adding_videos_keyboard()
+    )
+
+
+@router.callback_query(VideoProcessingStates.confirming_preview_mode1, F.data == "preview_change")
+async def change_after_preview_mode1(callback: CallbackQuery, state: FSMContext):
+    """Start the modification setup over, keeping the uploaded video for the next preview"""
+    await callback.answer()
+    await callback.message.edit_reply_markup(reply_markup=None)
+    await state.update_data(modifications=[], variants=1)
+    await state.set_state(VideoProcessingStates.selecting_modifications_mode1)
+    await callback.message.answer(
+        "✏️ Select the modifications again:",
+        reply_markup=video_modifications_keyboard(variants=True)
+    )
+
+
 @router.message(VideoProcessingStates.waiting_for_videos_mode1, F.video)
 async def handle_videos_mode1(message: Message, state: FSMContext):
     """Handle video uploads for mode 1"""
@@ -247,13 +482,9 @@ async def handle_videos_mode1(message: Message, state: FSMContext):
         )
         return
     
-    # Download video
-    file = await message.bot.get_file(video.file_id)
     filename = generate_filename()
     video_path = os.path.join(settings.TEMP_VIDEO_DIR, filename)
     
-    await message.bot.download_file(file.file_path, video_path)
-    
     # Save video to database
     async with async_session_maker() as session:
         user = await get_or_create_user(
@@ -267,22 +498,68 @@ async def handle_videos_mode1(message: Message, state: FSMContext):
             user_id=user.id,
             file_id=video.file_id,
             mode=1,
-            original_filename=filename
+            original_filename=filename,
+            file_unique_id=video.file_unique_id,
+            file_size=video.file_size,
+            duration=video.duration,
+            width=video.width,
+            height=video.height
         )
         
         data = await state.get_data()
         video_paths = data.get('video_paths', [])
         video_ids = data.get('video_ids', [])
+        video_unique_ids = data.get('video_unique_ids', [])
         
         video_paths.append(video_path)
         video_ids.append(db_video.id)
+        video_unique_ids.append(video.file_unique_id)
         
         video_count = len(video_paths)
         
         await state.update_data(
             video_paths=video_paths,
-            video_ids=video_ids
+            video_ids=video_ids,
+            video_unique_ids=video_unique_ids
         )
+        
+        # Encode right away while the user is still uploading, if the limit allows it
+        # and the modifications were confirmed on a preview
+        variants = data.get('variants', 1)
+        previewing = settings.PREVIEW_ENABLED and not data.get('preview_confirmed')
+        eager = settings.EAGER_ENCODING_ENABLED and not previewing
+        if eager:
+            cost = estimate_videos(
+                [video_info(video)], data.get('modifications', []), await load_coefficients(), variants
+            )
+            eager_cpu_seconds = data.get('eager_cpu_seconds', 0.0)
+            eager = await _admit_eager(session, user.id, video_count * variants, cost, eager_cpu_seconds)
+            if eager:
+                await state.update_data(eager_cpu_seconds=eager_cpu_seconds + cost)
+    
+    if previewing and video_count == 1:
+        # Nothing is encoded in full quality until the preview of the first upload is confirmed
+        await state.set_state(VideoProcessingStates.confirming_preview_mode1)
+        try:
+            await download_video(message.bot, video.file_id, video_path)
+        except Exception as e:
+            await message.answer(f"❌ Error downloading video: {str(e)}\n\nPlease send it again.")
+            await state.update_data(video_paths=[], video_ids=[], video_unique_ids=[])
+            await state.set_state(VideoProcessingStates.waiting_for_videos_mode1)
+            async with async_session_maker() as session:
+                await update_video_status(session, db_video.id, "failed")
+            return
+        await _send_preview(message, state)
+        return
+    
+    # Download in the background so the next upload is not held up by this one
+    start_background(
+        message.from_user.id,
+        video_path,
+        _prepare_video(message.bot, video.file_id, video_path, video.file_unique_id,
+                       data.get('modifications', []), variants, data.get('variant_seed', 0), eager, db_video.id,
+                       cost if eager else 0.0)
+    )
     
     await message.answer(
         f"✅ Video {video_count} received!\n\n"
@@ -299,7 +576,12 @@ async def process_all_videos_mode1(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     video_paths = data.get('video_paths', [])
     video_ids = data.get('video_ids', [])
+    video_unique_ids = data.get('video_unique_ids', [None] * len(video_paths))
     modifications = data.get('modifications', [])
+    variants = data.get('variants', 1)
+    variant_seed = data.get('variant_seed', 0)
+    # Estimated work of the uploads already encoding in the background, admitted on upload
+    eager_cpu_seconds = data.get('eager_cpu_seconds', 0.0)
     
     if not video_paths:
         await callback.message.answer(
@@ -317,11 +599,22 @@ async def process_all_videos_mode1(callback: CallbackQuery, state: FSMContext):
             username=callback.from_user.username
         )
         
+        videos = await get_videos_by_ids(session, video_ids)
+        cost = estimate_videos(
+            [video_info(videos[video_id]) for video_id in video_ids if video_id in videos],
+            modifications, await load_coefficients(), variants
+        )
         can_process, error_message = await check_user_can_process_videos(
-            session, user.id, len(video_paths)
+            session, user.id, len(video_paths) * variants, cost
         )
+        if can_process:
+            can_process, error_message = work_ledger.check(
+                max(cost - eager_cpu_seconds, 0.0), eager_cpu_seconds
+            )
         
         if not can_process:
+            cancel_background(callback.from_user.id)
+            await _charge_eager(callback.from_user.id, data)
             await callback.message.answer(
                 f"❌ {error_message}\n\n"
                 "Please try again later or upgrade your plan.",
@@ -330,78 +623,106 @@ async def process_all_videos_mode1(callback: CallbackQuery, state: FSMContext):
             await state.clear()
             return
     
-    await callback.message.edit_text("⏳ Processing your videos... Please wait.")
+    # From here on the order is charged for what it delivers, the eager encodes included
+    await state.update_data(eager_cpu_seconds=0.0)
+    
+    await callback.message.edit_text(
+        f"⏳ Processing your videos... Please wait.\n\n"
+        f"Estimated time: {format_eta(work_ledger.eta(cost))}"
+    )
     
     processed_count = 0
     failed_count = 0
+    finished_ids = []
     
-    for idx, (video_path, video_id) in enumerate(zip(video_paths, video_ids)):
-        try:
-            # Process video with modifications
-            current_path = video_path
-            
-            for i, mod in enumerate(modifications):
-                output_path = os.path.join(settings.TEMP_VIDEO_DIR, f"temp_{idx}_{i}_{generate_filename()}")
+    async def delivered(video_id, output_file_id):
+        nonlocal processed_count
+        processed_count += 1
+        if video_id and output_file_id:
+            async with async_session_maker() as session:
+                await set_video_output_file_id(session, video_id, output_file_id)
+    
+    async def delivery_failed(idx, video_id, error):
+        nonlocal failed_count
+        failed_count += 1
+        await callback.message.answer(f"❌ Error sending video {idx + 1}: {str(error)}")
+        async with async_session_maker() as session:
+            await update_video_status(session, video_id, "failed")
+    
+    async with work_ledger.admit(max(cost - eager_cpu_seconds, 0.0)), cancellable_request(callback.from_user.id) as request, progress_message(
+        callback.message, "⏳ Processing your videos...", "✅ Processing finished.", cancel_keyboard()
+    ) as progress, result_delivery(callback.message) as delivery:
+        for idx, (video_path, video_id, unique_id) in enumerate(zip(video_paths, video_ids, video_unique_ids)):
+            progress.set_stage(f"🎬 Video {idx + 1}/{len(video_paths)}")
+            try:
+                # Wait for the download, or for the encode started during the upload
+                rendered = await wait_for(callback.from_user.id, video_path)
+                if rendered is None:
+                    rendered = await _render_video(
+                        video_path, unique_id, modifications, variants, variant_seed, video_id
+                    )
+                final_paths, scores = rendered
                 
-                if mod['type'] == 'speed':
-                    await change_video_speed(current_path, output_path, mod['value'])
-                elif mod['type'] == 'filter':
-                    await apply_filter(current_path, output_path, mod['value'])
-                elif mod['type'] == 'scale':
-                    await scale_video(current_path, output_path, mod['width'], mod['height'])
-                elif mod['type'] == 'rotate':
-                    await rotate_video(current_path, output_path, mod['angle'])
-                elif mod['type'] == 'text':
-                    await add_text_to_video(current_path, output_path, mod['value'], mod['x'], mod['y'])
+                # Copies tuned to the uniqueness target were scored while rendering
+                if not scores:
+                    scores = await _measure_uniqueness(video_path, final_paths)
                 
-                # Clean up previous temp file
-                if current_path != video_path and os.path.exists(current_path):
-                    os.remove(current_path)
+                # Update database
+                applied = modifications
+                if variants > 1:
+                    applied = {'modifications': modifications, 'variants': variants, 'seed': variant_seed}
+                async with async_session_maker() as session:
+                    await update_video_status(
+                        session,
+                        video_id,
+                        "completed",
+                        processed_filename=os.path.basename(final_paths[0]),
+                        modifications=json.dumps(applied)
+                    )
+                    if scores:
+                        await set_video_uniqueness_score(session, video_id, min(scores))
                 
-                current_path = output_path
-            
-            # Save final video
-            final_filename = generate_filename()
-            final_path = os.path.join(settings.PROCESSED_VIDEO_DIR, final_filename)
-            
-            if current_path != video_path:
-                os.rename(current_path, final_path)
-            else:
-                import shutil
-                shutil.copy(video_path, final_path)
-            
-            # Update database
-            async with async_session_maker() as session:
-                await update_video_status(
-                    session,
-                    video_id,
-                    "completed",
-                    processed_filename=final_filename,
-                    modifications=json.dumps(modifications)
-                )
-            
-            # Send processed video
-            with open(final_path, 'rb') as video_file:
-                await callback.message.answer_video(
-                    video=video_file,
-                    caption=f"✅ Video {idx + 1}/{len(video_paths)} is ready!"
+                # Send processed videos in the background while the next one encodes
+                for copy_idx, final_path in enumerate(final_paths):
+                    caption = f"✅ Video {idx + 1}/{len(video_paths)} is ready!"
+                    if variants > 1:
+                        caption = f"✅ Video {idx + 1}/{len(video_paths)}, copy {copy_idx + 1}/{variants} is ready!"
+                    if scores:
+                        caption += f"\n🔍 Uniqueness: {scores[copy_idx]:.0%}"
+                    delivery.send(
+                        final_path,
+                        caption,
+                        # The Video row keeps the file_id of its processed_filename only
+                        on_sent=partial(delivered, video_id if copy_idx == 0 else None),
+                        on_failed=partial(delivery_failed, idx, video_id)
+                    )
+                
+                # Clean up
+                if os.path.exists(video_path):
+                    os.remove(video_path)
+                
+                finished_ids.append(video_id)
+                
+            except Exception as e:
+                failed_count += 1
+                await callback.message.answer(
+                    f"❌ Error processing video {idx + 1}: {str(e)}"
                 )
-            
-            # Clean up
-            if os.path.exists(video_path):
-                os.remove(video_path)
-            
-            processed_count += 1
-            
-        except Exception as e:
-            failed_count += 1
-            await callback.message.answer(
-                f"❌ Error processing video {idx + 1}: {str(e)}"
-            )
-            
-            # Update database
-            async with async_session_maker() as session:
-                await update_video_status(session, video_id, "failed")
+                
+                # Update database
+                async with async_session_maker() as session:
+                    await update_video_status(session, video_id, "failed")
+                finished_ids.append(video_id)
+    
+    if request.cancelled:
+        # Drop the uploads that were not processed and record them as cancelled
+        cancel_background(callback.from_user.id)
+        async with async_session_maker() as session:
+            for video_path, video_id in zip(video_paths, video_ids):
+                if video_id not in finished_ids:
+                    await update_video_status(session, video_id, "cancelled")
+                if os.path.exists(video_path):
+                    os.remove(video_path)
     
     # Increment daily usage for successfully processed videos
     if processed_count > 0:
@@ -411,7 +732,13 @@ async def process_all_videos_mode1(callback: CallbackQuery, state: FSMContext):
                 telegram_id=callback.from_user.id,
                 username=callback.from_user.username
             )
-            await increment_daily_usage(session, user.id, processed_count)
+            # Charge the compute budget for the delivered share of the request
+            await increment_daily_usage(
+                session, user.id, processed_count, cost * processed_count / (len(video_paths) * variants)
+            )
+    
+    if request.cancelled:
+        return
     
     await callback.message.answer(
         f"🎉 Processing complete!\n\n"
@@ -426,11 +753,28 @@ async def process_all_videos_mode1(callback: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == "cancel")
 async def cancel_processing(callback: CallbackQuery, state: FSMContext):
-    """Cancel processing"""
+    """Cancel processing, stopping any encodes already running for this user"""
+    cancel_request(callback.from_user.id)
+    if cancel_background(callback.from_user.id):
+        await _charge_eager(callback.from_user.id, await state.get_data())
+    if await state.get_state() in (VideoProcessingStates.confirming_preview_mode1.state,
+                                   VideoProcessingStates.selecting_modifications_mode1.state):
+        # An upload kept for the preview is not owned by any background task
+        data = await state.get_data()
+        async with async_session_maker() as session:
+            for video_path, video_id in zip(data.get('video_paths', []), data.get('video_ids', [])):
+                await update_video_status(session, video_id, "cancelled")
+                if os.path.exists(video_path):
+                    os.remove(video_path)
     await state.clear()
-    await callback.message.edit_text(
-        "❌ Cancelled. Use the menu to start over.",
-    )
+    if callback.message.text:
+        await callback.message.edit_text(
+            "❌ Cancelled. Use the menu to start over.",
+        )
+    else:
+        # Cancelled from the preview video
+        await callback.message.edit_reply_markup(reply_markup=None)
+        await callback.message.answer("❌ Cancelled. Use the menu to start over.")
     await callback.answer()
 
 
@@ -439,6 +783,6 @@ async def back_to_modifications(callback: CallbackQuery, state: FSMContext):
     """Go back to modifications menu"""
     await callback.message.edit_text(
         "Select modifications:",
-        reply_markup=video_modifications_keyboard()
+        reply_markup=video_modifications_keyboard(variants=True)
     )
     await callback.answer()
@@ -36,8 +36,8 @@ def mode_selection_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-def video_modifications_keyboard() -> InlineKeyboardMarkup:
-    """Video modification options keyboard"""
+def video_modifications_keyboard(variants: bool = False) -> InlineKeyboardMarkup:
+    """Video modification options keyboard; `variants` adds the unique copies option"""
     keyboard = [
         [InlineKeyboardButton(text="⚡ Change Speed", callback_data="mod_speed")],
         [InlineKeyboardButton(text="📐 Scale/Resize", callback_data="mod_scale")],
@@ -46,6 +46,10 @@ def video_modifications_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="🔄 Rotate", callback_data="mod_rotate")],
         [InlineKeyboardButton(text="📝 Add Text", callback_data="mod_text")],
         [InlineKeyboardButton(text="⏱️ Trim/Cut", callback_data="mod_trim")],
+    ]
+    if variants:
+        keyboard.append([InlineKeyboardButton(text="🎲 Unique Copies", callback_data="mod_variants")])
+    keyboard += [
         [InlineKeyboardButton(text="✅ Done", callback_data="mod_done")],
         [InlineKeyboardButton(text="❌ Cancel", callback_data="cancel")]
     ]
@@ -75,6 +79,7 @@ def merge_layout_keyboard() -> InlineKeyboardMarkup:
     keyboard = [
         [InlineKeyboardButton(text="➡️ Horizontal (Side by Side)", callback_data="merge_horizontal")],
         [InlineKeyboardButton(text="⬇️ Vertical (Top to Bottom)", callback_data="merge_vertical")],
+        [InlineKeyboardButton(text="🔲 Grid", callback_data="merge_grid")],
         [InlineKeyboardButton(text="▶️ Sequential (One after Another)", callback_data="merge_sequential")],
         [InlineKeyboardButton(text="❌ Cancel", callback_data="cancel")]
     ]
@@ -101,6 +106,16 @@ def done_adding_videos_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+def preview_keyboard() -> InlineKeyboardMarkup:
+    """Confirm or reject the preview of the configured modifications"""
+    keyboard = [
+        [InlineKeyboardButton(text="✅ Looks good - Continue", callback_data="preview_ok")],
+        [InlineKeyboardButton(text="✏️ Change Modifications", callback_data="preview_change")],
+        [InlineKeyboardButton(text="❌ Cancel", callback_data="cancel")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
 def num_groups_keyboard() -> InlineKeyboardMarkup:
     """Select number of video groups for Mode N"""
     keyboard = [
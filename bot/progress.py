@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup, Message
+from config import settings
+from utils.progress import ProgressStream, current_progress, format_eta
+
+logger = logging.getLogger(__name__)
+
+
+def format_progress(title: str, update: Dict) -> str:
+    """Progress message text with a bar, percentage, ETA and speed"""
+    percent = min(100.0, update['percent'])
+    filled = int(percent / 10)
+    lines = [title, ""]
+    if update.get('stage'):
+        lines.append(update['stage'])
+    lines.append(f"{'▓' * filled}{'░' * (10 - filled)} {percent:.0f}%")
+    details = f"⏱ ETA {format_eta(update.get('eta'))}"
+    if update.get('speed'):
+        details += f" · {update['speed']:.1f}x"
+    lines.append(details)
+    return "\n".join(lines)
+
+
+async def report_progress(message: Message, stream: ProgressStream, title: str,
+                          reply_markup: Optional[InlineKeyboardMarkup] = None):
+    """Edit `message` with the stream's progress, coalesced to one edit per PROGRESS_UPDATE_INTERVAL"""
+    last_text = None
+    async for update in stream.updates(settings.PROGRESS_UPDATE_INTERVAL):
+        text = format_progress(title, update)
+        if text == last_text:
+            continue
+        try:
+            await message.edit_text(text, reply_markup=reply_markup)
+            last_text = text
+        except TelegramRetryAfter as e:
+            # Flood control: skip updates until Telegram allows edits again
+            await asyncio.sleep(e.retry_after)
+        except TelegramBadRequest as e:
+            logger.debug(f"Progress edit skipped: {e}")
+
+
+@asynccontextmanager
+async def progress_message(message: Message, title: str, done_text: Optional[str] = None,
+                           reply_markup: Optional[InlineKeyboardMarkup] = None):
+    """
+    Report the progress of every ffmpeg job started inside the block by editing `message`.
+    Yields the ProgressStream so callers can set a stage label.
+    On success the message is replaced with `done_text`, if given.
+    """
+    stream = ProgressStream()
+    token = current_progress.set(stream)
+    reporter = asyncio.create_task(report_progress(message, stream, title, reply_markup))
+    try:
+        yield stream
+    finally:
+        current_progress.reset(token)
+        stream.close()
+        reporter.cancel()
+        await asyncio.gather(reporter, return_exceptions=True)
+    
+    if done_text:
+        try:
+            await message.edit_text(done_text)
+        except (TelegramBadRequest, TelegramRetryAfter):
+            pass
@@ -11,6 +11,7 @@ class VideoProcessingStates(StatesGroup):
     # Mode 1: Single video - NEW FLOW (filters first, then multiple videos)
     selecting_modifications_mode1 = State()
     waiting_for_videos_mode1 = State()
+    confirming_preview_mode1 = State()
     
     # Mode 2: Two video groups - NEW FLOW (filters per group, then multiple videos per group)
     selecting_modifications_video1 = State()
@@ -25,6 +26,7 @@ class VideoProcessingStates(StatesGroup):
     selecting_modifications_group = State()
     waiting_for_videos_group = State()
     selecting_combine_strategy = State()
+    selecting_combine_layout = State()
     
     # Common states
     processing = State()
@@ -34,3 +36,4 @@ class VideoProcessingStates(StatesGroup):
     waiting_for_crop_input = State()
     waiting_for_rotate_input = State()
     waiting_for_trim_input = State()
+    waiting_for_variants_input = State()
@@ -1,11 +1,15 @@
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.fsm.storage.memory import MemoryStorage
 from config import settings
 from database.database import init_db
 from bot.handlers import basic, video_processing, mode2, moden
 from bot.states import VideoProcessingStates
+from utils.job_executor import job_executor
+from utils.metrics import register_executor, start_exporter
 
 # Configure logging
 logging.basicConfig(
@@ -15,29 +19,56 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def create_bot() -> Bot:
+    """Bot talking to api.telegram.org or to the server in TELEGRAM_API_URL"""
+    if settings.TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(settings.TELEGRAM_API_URL.rstrip('/')))
+        return Bot(token=settings.BOT_TOKEN, session=session)
+    return Bot(token=settings.BOT_TOKEN)
+
+
+def create_dispatcher() -> Dispatcher:
+    """Dispatcher with every handler router registered"""
+    storage = MemoryStorage()
+    dp = Dispatcher(storage=storage)
+    
+    # Register routers (order matters - more specific first)
+    dp.include_router(basic.router)
+    dp.include_router(mode2.router)
+    dp.include_router(moden.router)
+    dp.include_router(video_processing.router)
+    return dp
+
+
 async def main():
     """Main bot function"""
     # Initialize bot and dispatcher
-    bot = Bot(token=settings.BOT_TOKEN)
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
+    bot = create_bot()
+    dp = create_dispatcher()
     
     # Initialize database
     logger.info("Initializing database...")
     await init_db()
     logger.info("Database initialized successfully")
     
-    # Register routers (order matters - more specific first)
-    dp.include_router(basic.router)
-    dp.include_router(mode2.router)
-    dp.include_router(moden.router)
-    dp.include_router(video_processing.router)
+    # Start video job workers
+    register_executor(job_executor)
+    await job_executor.start()
+    logger.info(f"Job executor started with {job_executor.max_workers} worker(s)")
+    
+    exporter = None
+    if settings.METRICS_PORT:
+        exporter = await start_exporter(settings.METRICS_PORT)
+        logger.info(f"Metrics exporter listening on port {settings.METRICS_PORT}")
     
     # Start polling
     logger.info("Bot started successfully")
     try:
         await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     finally:
+        await job_executor.stop()
+        if exporter:
+            await exporter.cleanup()
         await bot.session.close()
 
 
@@ -7,6 +7,8 @@ class Settings(BaseSettings):
     # Telegram Bot
     BOT_TOKEN: str = ""
     ADMIN_IDS: str = ""
+    TELEGRAM_API_URL: str = ""  # Bot API server base URL (local Bot API server, load-test fake); empty = api.telegram.org
+    METRICS_PORT: int = 0  # Port of the bot's Prometheus /metrics exporter, 0 = off
     
     # Database
     DATABASE_URL: str = "sqlite+aiosqlite:///./bot_database.db"
@@ -36,6 +38,42 @@ class Settings(BaseSettings):
     TEMP_VIDEO_DIR: str = "./temp_videos"
     PROCESSED_VIDEO_DIR: str = "./processed_videos"
     MAX_CARTESIAN_COMBINATIONS: int = 100  # Limit for all-with-all strategy in Mode N
+    MAX_CONCURRENT_JOBS: int = 0  # Concurrent ffmpeg jobs, 0 = derived from CPU cores
+    JOB_QUEUE_SIZE: int = 100  # Jobs waiting for a free worker before submitters block
+    STREAM_COPY_ENABLED: bool = True  # Remux with -c copy when no re-encode is required
+    RESULT_CACHE_ENABLED: bool = True  # Reuse outputs for identical inputs and modifications
+    RESULT_CACHE_MAX_SIZE_MB: int = 2048
+    RESULT_CACHE_MAX_ENTRIES: int = 1000
+    MEZZANINE_WIDTH: int = 1280  # Common profile segments are normalized to before sequential concat
+    MEZZANINE_HEIGHT: int = 720  # The frame is turned to portrait when most inputs are vertical
+    MEZZANINE_FPS: int = 30
+    MEZZANINE_GOP: int = 60  # Frames between keyframes
+    SEGMENT_ENCODING_ENABLED: bool = True  # Encode long videos as parallel keyframe-aligned chunks
+    SEGMENT_MIN_DURATION: int = 120  # Seconds; shorter videos are encoded in one piece
+    SEGMENT_DURATION: int = 20  # Target chunk length in seconds
+    SEGMENT_WORKERS: int = 0  # Chunks encoded at once, 0 = derived from CPU cores
+    PROGRESS_UPDATE_INTERVAL: float = 3.0  # Seconds between progress message edits (Telegram flood limits)
+    FFMPEG_THREADS: int = 0  # Threads per job, 0 = host cores split between running jobs
+    FFMPEG_NICE: int = 10  # OS priority offset for ffmpeg so the bot and API stay responsive
+    PIPED_STAGES_ENABLED: bool = True  # Connect modify and merge stages through pipes instead of temp files
+    EAGER_ENCODING_ENABLED: bool = True  # Mode 1: start encoding each upload before the user presses Done
+    MAX_CONCURRENT_UPLOADS: int = 3  # Result uploads to Telegram in flight at once, across all users
+    DELIVERY_RETRIES: int = 5  # Retries of a result upload after flood control or network errors
+    DELIVERY_ALBUM_SIZE: int = 10  # Mode N results per media-group album (1 = send one by one, max 10)
+    DELIVERY_ALBUM_WAIT: float = 5.0  # Seconds a result waits for its album to fill before a partial album is sent
+    PROBE_CACHE_SIZE: int = 256  # ffprobe results kept in memory, keyed by path, mtime and size
+    MAX_VARIANTS: int = 10  # Mode 1: most unique copies of one video (all encoded by one ffmpeg process)
+    UNIQUENESS_ANALYSIS_ENABLED: bool = True  # Score how much each output differs from its source
+    UNIQUENESS_SAMPLE_FRAMES: int = 16  # Frames compared per video
+    UNIQUENESS_TARGET: float = 0.0  # Mode 1 copies: raise the jitter until every copy scores this (0 = off)
+    UNIQUENESS_TUNE_ROUNDS: int = 3  # Most encodes of a copy set while tuning towards the target
+    PREVIEW_ENABLED: bool = True  # Mode 1: confirm a short preview of the chain before the full encode
+    PREVIEW_SECONDS: float = 4.0  # Length of the preview clip
+    PREVIEW_HEIGHT: int = 360  # Preview resolution (lines)
+    COST_DEFAULT_CPU_PER_MPS: float = 2.0  # CPU-seconds per megapixel-second of input until encode stats calibrate it
+    COST_CALIBRATION_SAMPLES: int = 200  # Most recent encode stats the cost model is fitted to
+    MAX_REQUEST_CPU_SECONDS: float = 0  # Reject requests estimated above this many CPU-seconds (0 = no limit)
+    MAX_BACKLOG_CPU_SECONDS: float = 0  # Reject new requests while admitted work exceeds this (0 = no limit)
     
     class Config:
         env_file = ".env"
@@ -1,8 +1,12 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, update, delete, func
-from database.models import User, Video, Deposit, Withdrawal, Setting, Statistic, TariffPlan, DailyVideoUsage
+from sqlalchemy.orm import selectinload
+from database.models import (
+    User, Video, Deposit, Withdrawal, Setting, Statistic, TariffPlan, DailyVideoUsage,
+    ResultCacheEntry, DailyCacheStats, EncodeStat
+)
 from datetime import datetime, date
-from typing import Optional, List, Tuple
+from typing import Dict, Optional, List, Tuple
 
 
 async def get_user_by_telegram_id(session: AsyncSession, telegram_id: int) -> Optional[User]:
@@ -53,13 +57,20 @@ async def update_user_language(session: AsyncSession, telegram_id: int, language
 
 
 async def create_video(session: AsyncSession, user_id: int, file_id: str, mode: int,
-                       original_filename: str = None) -> Video:
-    """Create video record"""
+                       original_filename: str = None, file_unique_id: str = None,
+                       file_size: int = None, duration: float = None,
+                       width: int = None, height: int = None) -> Video:
+    """Create video record with the metadata Telegram reported for the upload"""
     video = Video(
         user_id=user_id,
         file_id=file_id,
+        file_unique_id=file_unique_id,
         mode=mode,
-        original_filename=original_filename
+        original_filename=original_filename,
+        file_size=file_size,
+        duration=duration,
+        width=width,
+        height=height
     )
     session.add(video)
     await session.commit()
@@ -84,6 +95,51 @@ async def update_video_status(session: AsyncSession, video_id: int, status: str,
     await session.commit()
 
 
+async def set_video_output_file_id(session: AsyncSession, video_id: int, file_id: str):
+    """Remember the Telegram file_id of a delivered output"""
+    await session.execute(
+        update(Video).where(Video.id == video_id).values(output_file_id=file_id)
+    )
+    await session.commit()
+
+
+async def set_video_uniqueness_score(session: AsyncSession, video_id: int, score: float):
+    """Store how much the output of a video differs from its source"""
+    await session.execute(
+        update(Video).where(Video.id == video_id).values(uniqueness_score=score)
+    )
+    await session.commit()
+
+
+async def get_output_file_id(session: AsyncSession, processed_filename: str) -> Optional[str]:
+    """Get the Telegram file_id of an already delivered output"""
+    result = await session.execute(
+        select(ResultCacheEntry.telegram_file_id)
+        .where(ResultCacheEntry.processed_filename == processed_filename)
+        .where(ResultCacheEntry.telegram_file_id.isnot(None))
+    )
+    file_id = result.scalars().first()
+    if file_id:
+        return file_id
+    
+    result = await session.execute(
+        select(Video.output_file_id)
+        .where(Video.processed_filename == processed_filename)
+        .where(Video.output_file_id.isnot(None))
+    )
+    return result.scalars().first()
+
+
+async def set_cache_entry_file_id(session: AsyncSession, processed_filename: str, file_id: str):
+    """Remember the Telegram file_id of a cached output"""
+    await session.execute(
+        update(ResultCacheEntry)
+        .where(ResultCacheEntry.processed_filename == processed_filename)
+        .values(telegram_file_id=file_id)
+    )
+    await session.commit()
+
+
 async def get_all_users(session: AsyncSession, skip: int = 0, limit: int = 100) -> List[User]:
     """Get all users with pagination"""
     result = await session.execute(select(User).offset(skip).limit(limit))
@@ -96,6 +152,12 @@ async def get_all_videos(session: AsyncSession, skip: int = 0, limit: int = 100)
     return result.scalars().all()
 
 
+async def get_videos_by_ids(session: AsyncSession, video_ids: List[int]) -> Dict[int, Video]:
+    """Videos with the given IDs, keyed by ID"""
+    result = await session.execute(select(Video).where(Video.id.in_(video_ids)))
+    return {video.id: video for video in result.scalars().all()}
+
+
 async def get_user_videos(session: AsyncSession, user_id: int) -> List[Video]:
     """Get all videos for a user"""
     result = await session.execute(select(Video).where(Video.user_id == user_id))
@@ -182,14 +244,15 @@ async def get_tariff_plan(session: AsyncSession, plan_id: int) -> Optional[Tarif
 
 async def create_tariff_plan(session: AsyncSession, name: str, description: str = None, 
                             videos_per_day: int = 10, videos_per_order: int = 5, 
-                            price: float = 0.0) -> TariffPlan:
+                            price: float = 0.0, cpu_seconds_per_day: float = 0.0) -> TariffPlan:
     """Create new tariff plan"""
     plan = TariffPlan(
         name=name,
         description=description,
         videos_per_day=videos_per_day,
         videos_per_order=videos_per_order,
-        price=price
+        price=price,
+        cpu_seconds_per_day=cpu_seconds_per_day
     )
     session.add(plan)
     await session.commit()
@@ -248,10 +311,11 @@ async def get_or_create_daily_usage(session: AsyncSession, user_id: int, check_d
     return usage
 
 
-async def increment_daily_usage(session: AsyncSession, user_id: int, count: int = 1):
-    """Increment daily video usage count"""
+async def increment_daily_usage(session: AsyncSession, user_id: int, count: int = 1, cpu_seconds: float = 0.0):
+    """Increment daily video usage count and estimated compute"""
     usage = await get_or_create_daily_usage(session, user_id)
     usage.video_count += count
+    usage.cpu_seconds = (usage.cpu_seconds or 0.0) + cpu_seconds
     await session.commit()
 
 
@@ -261,14 +325,16 @@ async def get_user_daily_usage(session: AsyncSession, user_id: int) -> int:
     return usage.video_count
 
 
-async def check_user_can_process_videos(session: AsyncSession, user_id: int, video_count: int) -> Tuple[bool, str]:
+async def check_user_can_process_videos(session: AsyncSession, user_id: int, video_count: int,
+                                        cpu_seconds: float = 0.0) -> Tuple[bool, str]:
     """
-    Check if user can process videos based on their tariff plan limits
+    Check if user can process videos based on their tariff plan limits,
+    including the plan's daily compute budget for `cpu_seconds` of estimated work
     Returns (can_process, error_message)
     """
-    # Get user with tariff plan
+    # Get user with tariff plan (loaded up front, lazy loads cannot run in an async session)
     result = await session.execute(
-        select(User).where(User.id == user_id)
+        select(User).options(selectinload(User.tariff_plan)).where(User.id == user_id)
     )
     user = result.scalar_one_or_none()
     
@@ -290,9 +356,163 @@ async def check_user_can_process_videos(session: AsyncSession, user_id: int, vid
         return False, f"Order limit exceeded. Maximum {order_limit} videos per order."
     
     # Check daily limit
-    daily_usage = await get_user_daily_usage(session, user_id)
+    usage = await get_or_create_daily_usage(session, user_id)
+    daily_usage = usage.video_count
     if daily_usage + video_count > daily_limit:
         remaining = max(0, daily_limit - daily_usage)
         return False, f"Daily limit exceeded. You have {remaining} videos remaining today (limit: {daily_limit})."
     
+    # Check daily compute budget
+    cpu_budget = user.tariff_plan.cpu_seconds_per_day if user.tariff_plan else 0
+    if cpu_budget and cpu_seconds and (usage.cpu_seconds or 0.0) + cpu_seconds > cpu_budget:
+        remaining = max(0.0, cpu_budget - (usage.cpu_seconds or 0.0))
+        return False, (f"Daily processing budget exceeded. This order needs about {cpu_seconds / 60:.1f} CPU minutes, "
+                       f"you have {remaining / 60:.1f} of {cpu_budget / 60:.1f} remaining today.")
+    
     return True, ""
+
+
+# Result cache operations
+async def get_cache_entry(session: AsyncSession, cache_key: str) -> Optional[ResultCacheEntry]:
+    """Get result cache entry by key"""
+    result = await session.execute(select(ResultCacheEntry).where(ResultCacheEntry.cache_key == cache_key))
+    return result.scalar_one_or_none()
+
+
+async def touch_cache_entry(session: AsyncSession, entry_id: int):
+    """Mark cache entry as used now and count the hit"""
+    await session.execute(
+        update(ResultCacheEntry)
+        .where(ResultCacheEntry.id == entry_id)
+        .values(last_used_at=datetime.utcnow(), hit_count=ResultCacheEntry.hit_count + 1)
+    )
+    await session.commit()
+
+
+async def create_cache_entry(session: AsyncSession, cache_key: str, processed_filename: str,
+                             file_size: int) -> ResultCacheEntry:
+    """Create result cache entry"""
+    entry = ResultCacheEntry(
+        cache_key=cache_key,
+        processed_filename=processed_filename,
+        file_size=file_size
+    )
+    session.add(entry)
+    await session.commit()
+    await session.refresh(entry)
+    return entry
+
+
+async def delete_cache_entry(session: AsyncSession, entry_id: int):
+    """Delete result cache entry"""
+    await session.execute(delete(ResultCacheEntry).where(ResultCacheEntry.id == entry_id))
+    await session.commit()
+
+
+async def get_cache_entries_lru(session: AsyncSession) -> List[ResultCacheEntry]:
+    """Get all cache entries, least recently used first"""
+    result = await session.execute(select(ResultCacheEntry).order_by(ResultCacheEntry.last_used_at))
+    return result.scalars().all()
+
+
+async def record_cache_lookup(session: AsyncSession, hit: bool):
+    """Count a cache hit or miss for today"""
+    today = date.today()
+    result = await session.execute(
+        select(DailyCacheStats).where(func.date(DailyCacheStats.date) == today)
+    )
+    stats = result.scalar_one_or_none()
+    if not stats:
+        stats = DailyCacheStats(date=datetime.combine(today, datetime.min.time()), hits=0, misses=0)
+        session.add(stats)
+    
+    if hit:
+        stats.hits += 1
+    else:
+        stats.misses += 1
+    await session.commit()
+
+
+async def get_cache_stats(session: AsyncSession) -> dict:
+    """Get result cache counters and usage"""
+    counters = await session.execute(
+        select(func.sum(DailyCacheStats.hits), func.sum(DailyCacheStats.misses))
+    )
+    hits, misses = counters.one()
+    usage = await session.execute(
+        select(func.count(ResultCacheEntry.id), func.sum(ResultCacheEntry.file_size))
+    )
+    entries, size = usage.one()
+    
+    hits = hits or 0
+    misses = misses or 0
+    lookups = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / lookups if lookups else 0.0,
+        "entries": entries or 0,
+        "size_bytes": size or 0
+    }
+
+
+async def create_encode_stat(session: AsyncSession, mode: int, job: str, stats: dict,
+                             video_id: int = None, **inputs) -> EncodeStat:
+    """Store the ffmpeg statistics of a job; `inputs` are inputs/input_width/input_height/input_duration"""
+    encode_stat = EncodeStat(mode=mode, job=job, video_id=video_id, **inputs, **stats)
+    session.add(encode_stat)
+    await session.commit()
+    return encode_stat
+
+
+async def get_encode_stats_by_video(session: AsyncSession, video_ids: List[int]) -> Dict[int, List[EncodeStat]]:
+    """Encode statistics of the given videos, keyed by video ID"""
+    result = await session.execute(
+        select(EncodeStat).where(EncodeStat.video_id.in_(video_ids)).order_by(EncodeStat.id)
+    )
+    by_video = {}
+    for encode_stat in result.scalars().all():
+        by_video.setdefault(encode_stat.video_id, []).append(encode_stat)
+    return by_video
+
+
+async def get_encode_stat_aggregates(session: AsyncSession) -> List[dict]:
+    """Encode statistics per job and input height: averages and wall time per minute of input"""
+    result = await session.execute(
+        select(
+            EncodeStat.job,
+            EncodeStat.input_height,
+            func.count(EncodeStat.id),
+            func.avg(EncodeStat.fps),
+            func.avg(EncodeStat.speed),
+            func.avg(EncodeStat.bitrate_kbps),
+            func.sum(EncodeStat.encode_seconds),
+            func.sum(EncodeStat.input_duration),
+            func.sum(EncodeStat.dropped_frames),
+            func.sum(EncodeStat.duplicated_frames)
+        )
+        .group_by(EncodeStat.job, EncodeStat.input_height)
+        .order_by(EncodeStat.job, EncodeStat.input_height)
+    )
+    aggregates = []
+    for job, height, count, fps, speed, bitrate, seconds, duration, dropped, duplicated in result.all():
+        aggregates.append({
+            "job": job,
+            "input_height": height,
+            "jobs": count,
+            "avg_fps": fps,
+            "avg_speed": speed,
+            "avg_bitrate_kbps": bitrate,
+            "encode_seconds": seconds or 0.0,
+            "input_seconds": duration or 0.0,
+            "seconds_per_input_minute": seconds / duration * 60 if seconds and duration else None,
+            "dropped_frames": dropped or 0,
+            "duplicated_frames": duplicated or 0
+        })
+    return aggregates
+
+
+async def get_recent_encode_stats(session: AsyncSession, limit: int = 200) -> List[EncodeStat]:
+    """Most recent encode statistics, newest first"""
+    result = await session.execute(select(EncodeStat).order_by(EncodeStat.id.desc()).limit(limit))
+    return result.scalars().all()
@@ -1,13 +1,27 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import text
+from sqlalchemy import event, text
 from database.models import Base
 from config import settings
+from utils.metrics import STAGE_SECONDS
 import os
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+# Columns added to existing tables after their first release: (table, column, SQLite type)
+COLUMN_MIGRATIONS = [
+    ("videos", "file_unique_id", "VARCHAR"),
+    ("videos", "output_file_id", "VARCHAR"),
+    ("result_cache", "telegram_file_id", "VARCHAR"),
+    ("videos", "width", "INTEGER"),
+    ("videos", "height", "INTEGER"),
+    ("videos", "uniqueness_score", "FLOAT"),
+    ("tariff_plans", "cpu_seconds_per_day", "FLOAT"),
+    ("daily_video_usage", "cpu_seconds", "FLOAT"),
+]
+
 # Create async engine
 engine = create_async_engine(
     settings.DATABASE_URL,
@@ -15,6 +29,21 @@ engine = create_async_engine(
     future=True
 )
 
+# Time every SQL statement as the 'db' stage. The start time lives on the execution
+# context, so statements that raise (and never reach after_cursor_execute) leave nothing behind
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _statement_started(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _statement_finished(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_query_start', None)
+    if started is not None:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage='db')
+
+
 # Create async session factory
 async_session_maker = async_sessionmaker(
     engine,
@@ -83,6 +112,20 @@ async def init_db():
                     "If using a non-SQLite database, please use Alembic or another "
                     "migration tool to add the 'tariff_plan_id' column to the 'users' table."
                 )
+            
+            # Migration: Add newer nullable columns that create_all does not add to existing tables
+            for table, column, column_type in COLUMN_MIGRATIONS:
+                try:
+                    result = await conn.execute(text(
+                        f"SELECT COUNT(*) FROM pragma_table_info('{table}') WHERE name='{column}'"
+                    ))
+                    if result.scalar() == 0:
+                        logger.info(f"Adding '{column}' column to {table} table...")
+                        await conn.execute(text(
+                            f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"
+                        ))
+                except Exception as e:
+                    logger.error(f"Failed to check/add {column} column to {table}: {e}")
 
 
 async def get_session() -> AsyncSession:
@@ -35,15 +35,20 @@ class Video(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     file_id = Column(String, nullable=False)
+    file_unique_id = Column(String, nullable=True, index=True)  # Stable Telegram ID of the uploaded file
     original_filename = Column(String, nullable=True)
     processed_filename = Column(String, nullable=True)
+    output_file_id = Column(String, nullable=True)  # Telegram file_id of the delivered output
     mode = Column(Integer, nullable=False)  # 1 or 2
-    status = Column(String, default="pending")  # pending, processing, completed, failed
+    status = Column(String, default="pending")  # pending, processing, completed, failed, cancelled
     created_at = Column(DateTime, default=datetime.utcnow)
     processed_at = Column(DateTime, nullable=True)
-    file_size = Column(Integer, nullable=True)
-    duration = Column(Float, nullable=True)
+    file_size = Column(Integer, nullable=True)  # Bytes, as reported by Telegram on upload
+    duration = Column(Float, nullable=True)  # Seconds
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
     modifications = Column(Text, nullable=True)  # JSON string of applied modifications
+    uniqueness_score = Column(Float, nullable=True)  # 0 = looks like the source, 1 = nothing alike
     
     user = relationship("User", back_populates="videos")
 
@@ -112,6 +117,7 @@ class TariffPlan(Base):
     videos_per_day = Column(Integer, nullable=False, default=10)  # Daily limit
     videos_per_order = Column(Integer, nullable=False, default=5)  # Per order/batch limit
     price = Column(Float, nullable=True, default=0.0)
+    cpu_seconds_per_day = Column(Float, nullable=True, default=0.0)  # Estimated compute budget, 0 = unlimited
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -126,5 +132,54 @@ class DailyVideoUsage(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     date = Column(DateTime, default=datetime.utcnow, index=True)
     video_count = Column(Integer, default=0)
+    cpu_seconds = Column(Float, default=0.0)  # Estimated compute of the day's requests
     
     user = relationship("User", back_populates="daily_usages")
+
+
+class ResultCacheEntry(Base):
+    __tablename__ = "result_cache"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String, unique=True, nullable=False, index=True)  # sha256 of inputs + modifications + engine version
+    processed_filename = Column(String, nullable=False)  # File in PROCESSED_VIDEO_DIR
+    file_size = Column(Integer, default=0)
+    telegram_file_id = Column(String, nullable=True)  # Set once the output has been uploaded
+    hit_count = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class DailyCacheStats(Base):
+    __tablename__ = "daily_cache_stats"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    date = Column(DateTime, default=datetime.utcnow, index=True)
+    hits = Column(Integer, default=0)
+    misses = Column(Integer, default=0)
+
+
+class EncodeStat(Base):
+    """ffmpeg statistics of one processing job, for capacity planning"""
+    __tablename__ = "encode_stats"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    video_id = Column(Integer, ForeignKey("videos.id"), nullable=True, index=True)  # Unset for merges of several uploads
+    mode = Column(Integer, nullable=False)
+    job = Column(String, nullable=False)  # Processing function, e.g. apply_modifications, merge_videos
+    inputs = Column(Integer, default=1)
+    input_width = Column(Integer, nullable=True)  # Of the first input
+    input_height = Column(Integer, nullable=True)
+    input_duration = Column(Float, nullable=True)  # Seconds, all inputs together
+    output_duration = Column(Float, nullable=True)
+    output_size = Column(Integer, nullable=True)  # Bytes
+    frames = Column(Integer, nullable=True)
+    dropped_frames = Column(Integer, default=0)
+    duplicated_frames = Column(Integer, default=0)
+    fps = Column(Float, nullable=True)  # Frames encoded per second of wall time
+    speed = Column(Float, nullable=True)  # Seconds of output per second of wall time
+    bitrate_kbps = Column(Float, nullable=True)
+    encode_seconds = Column(Float, nullable=True)  # Wall time from the first ffmpeg start to the last exit
+    processes = Column(Integer, default=1)  # ffmpeg processes run for the job
+    threads = Column(Integer, nullable=True)  # Thread budget of the job
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
@@ -5,7 +5,6 @@ Multiplatform video processing desktop application
 
 import os
 import asyncio
-import shutil
 from threading import Thread
 from kivy.app import App
 from kivy.uix.boxlayout import BoxLayout
@@ -23,16 +22,11 @@ from kivy.clock import Clock
 from config import settings
 from utils.video_processing import (
     get_video_info,
-    change_video_speed,
-    scale_video,
-    apply_filter,
-    crop_video,
-    rotate_video,
-    add_text_to_video,
-    trim_video,
+    apply_modifications,
     merge_videos,
     generate_filename
 )
+from utils.progress import ProgressStream, current_progress, format_eta
 
 # Set window size
 Window.size = (900, 700)
@@ -46,6 +40,8 @@ class VideoProcessorApp(App):
         self.processing_mode = "single"
         self.modifications = []
         self.option_spinners = []  # Keep track of option spinners
+        self.processing_loop = None
+        self.processing_task = None
         
     def build(self):
         self.title = "Video Unicalization - Desktop App"
@@ -137,7 +133,7 @@ class VideoProcessorApp(App):
         self.merge_layout.add_widget(Label(text='Merge Layout:', size_hint=(0.3, 1)))
         self.merge_spinner = Spinner(
             text='Horizontal',
-            values=('Horizontal', 'Vertical', 'Sequential'),
+            values=('Horizontal', 'Vertical', 'Grid', 'Sequential'),
             size_hint=(0.7, 1)
         )
         self.merge_layout.add_widget(self.merge_spinner)
@@ -160,16 +156,28 @@ class VideoProcessorApp(App):
         )
         main_layout.add_widget(self.status_label)
         
-        # Process button
+        # Process and cancel buttons
+        buttons_layout = BoxLayout(orientation='horizontal', size_hint=(1, 0.12), spacing=10)
         process_btn = Button(
             text='Process Video',
-            size_hint=(1, 0.12),
+            size_hint=(0.7, 1),
             background_color=(0.2, 0.8, 0.2, 1),
             font_size='18sp',
             bold=True
         )
         process_btn.bind(on_press=self.process_video)
-        main_layout.add_widget(process_btn)
+        buttons_layout.add_widget(process_btn)
+        
+        self.cancel_btn = Button(
+            text='Cancel',
+            size_hint=(0.3, 1),
+            background_color=(0.8, 0.2, 0.2, 1),
+            font_size='18sp',
+            disabled=True
+        )
+        self.cancel_btn.bind(on_press=self.cancel_processing)
+        buttons_layout.add_widget(self.cancel_btn)
+        main_layout.add_widget(buttons_layout)
         
         return main_layout
     
@@ -308,6 +316,7 @@ class VideoProcessorApp(App):
         
         # Disable button during processing
         instance.disabled = True
+        self.cancel_btn.disabled = False
         self.status_label.text = 'Processing...'
         self.progress_bar.value = 0
         
@@ -328,14 +337,27 @@ class VideoProcessorApp(App):
             os.makedirs(settings.TEMP_VIDEO_DIR, exist_ok=True)
             
             if self.processing_mode == "merge":
-                result = loop.run_until_complete(self.process_merge_videos())
+                coro = self.process_merge_videos()
             else:
-                result = loop.run_until_complete(self.process_single_video())
+                coro = self.process_single_video()
+            
+            # Keep the task so the Cancel button can stop it (and its ffmpeg process)
+            self.processing_loop = loop
+            self.processing_task = loop.create_task(coro)
+            try:
+                result = loop.run_until_complete(self.processing_task)
+            except asyncio.CancelledError:
+                result = None
+            finally:
+                self.processing_task = None
+                self.processing_loop = None
             
             loop.close()
             
             # Update UI on main thread
-            if result['success']:
+            if result is None:
+                Clock.schedule_once(lambda dt: self.on_processing_cancelled(button), 0)
+            elif result['success']:
                 Clock.schedule_once(lambda dt: self.on_processing_complete(button, result['output_path']), 0)
             else:
                 Clock.schedule_once(lambda dt: self.on_processing_error(button, result['error']), 0)
@@ -343,24 +365,33 @@ class VideoProcessorApp(App):
         except Exception as e:
             Clock.schedule_once(lambda dt: self.on_processing_error(button, str(e)), 0)
     
+    async def run_with_progress(self, coro):
+        """Await a processing coroutine while ffmpeg progress drives the progress bar"""
+        stream = ProgressStream()
+        token = current_progress.set(stream)
+        
+        async def follow():
+            async for update in stream.updates(0.25):
+                text = f"Processing... {update['percent']:.0f}% (ETA {format_eta(update['eta'])})"
+                Clock.schedule_once(lambda dt, value=update['percent']: setattr(self.progress_bar, 'value', value), 0)
+                Clock.schedule_once(lambda dt, text=text: setattr(self.status_label, 'text', text), 0)
+        
+        follower = asyncio.ensure_future(follow())
+        try:
+            return await coro
+        finally:
+            current_progress.reset(token)
+            stream.close()
+            follower.cancel()
+    
     async def process_single_video(self):
         """Process single video with modifications"""
         try:
             input_path = self.selected_video
-            current_path = input_path
-            temp_files = []
-            
-            # Update progress
-            Clock.schedule_once(lambda dt: setattr(self.progress_bar, 'value', 10), 0)
-            
-            # Use tracked spinners instead of searching for them
-            spinners = self.option_spinners
             
-            progress_step = 80 / max(len(spinners) + 1, 1)
-            current_progress = 10
-            
-            # Apply modifications
-            for spinner in reversed(spinners):
+            # Collect modifications from the tracked spinners
+            modifications = []
+            for spinner in reversed(self.option_spinners):
                 option_type = spinner.option_type
                 value = spinner.text
                 
@@ -368,52 +399,28 @@ class VideoProcessorApp(App):
                 if value in ['Original', 'None', '0°', '1.0x']:
                     continue
                 
-                output_path = os.path.join(settings.TEMP_VIDEO_DIR, generate_filename())
-                temp_files.append(output_path)
-                
-                Clock.schedule_once(
-                    lambda dt, t=option_type: setattr(self.status_label, 'text', f'Applying {t}...'), 0
-                )
-                
                 if option_type == 'speed':
-                    speed = float(value.replace('x', ''))
-                    await change_video_speed(current_path, output_path, speed)
+                    modifications.append({'type': 'speed', 'value': float(value.replace('x', ''))})
                 elif option_type == 'scale':
                     width, height = map(int, value.split('x'))
-                    await scale_video(current_path, output_path, width, height)
+                    modifications.append({'type': 'scale', 'width': width, 'height': height})
                 elif option_type == 'filter':
-                    await apply_filter(current_path, output_path, value.lower())
+                    modifications.append({'type': 'filter', 'value': value.lower()})
                 elif option_type == 'rotate':
                     angle = int(value.replace('°', ''))
                     if angle > 0:
-                        await rotate_video(current_path, output_path, angle)
-                    else:
-                        continue
-                
-                current_path = output_path
-                current_progress += progress_step
-                Clock.schedule_once(lambda dt, p=current_progress: setattr(self.progress_bar, 'value', p), 0)
+                        modifications.append({'type': 'rotate', 'angle': angle})
             
             # Apply text if provided
             if self.text_input.text.strip():
-                output_path = os.path.join(settings.TEMP_VIDEO_DIR, generate_filename())
-                temp_files.append(output_path)
-                Clock.schedule_once(lambda dt: setattr(self.status_label, 'text', 'Adding text overlay...'), 0)
-                await add_text_to_video(current_path, output_path, self.text_input.text.strip())
-                current_path = output_path
+                modifications.append({'type': 'text', 'value': self.text_input.text.strip()})
             
-            # Copy to final destination
-            final_output = os.path.join(settings.PROCESSED_VIDEO_DIR, generate_filename())
-            if current_path == input_path:
-                # No modifications, just copy
-                shutil.copy(input_path, final_output)
-            else:
-                shutil.move(current_path, final_output)
+            Clock.schedule_once(lambda dt: setattr(self.status_label, 'text', 'Applying modifications...'), 0)
             
-            # Clean up temp files
-            for temp_file in temp_files:
-                if os.path.exists(temp_file) and temp_file != current_path:
-                    os.remove(temp_file)
+            # Encode the whole chain in a single ffmpeg pass
+            final_output = os.path.join(settings.PROCESSED_VIDEO_DIR, generate_filename())
+            if not await self.run_with_progress(apply_modifications(input_path, final_output, modifications)):
+                return {'success': False, 'error': 'Failed to process video'}
             
             Clock.schedule_once(lambda dt: setattr(self.progress_bar, 'value', 100), 0)
             return {'success': True, 'output_path': final_output}
@@ -425,26 +432,24 @@ class VideoProcessorApp(App):
         """Process and merge two videos"""
         try:
             Clock.schedule_once(lambda dt: setattr(self.status_label, 'text', 'Merging videos...'), 0)
-            Clock.schedule_once(lambda dt: setattr(self.progress_bar, 'value', 30), 0)
             
             # Get merge layout
             layout_map = {
                 'Horizontal': 'horizontal',
                 'Vertical': 'vertical',
+                'Grid': 'grid',
                 'Sequential': 'sequential'
             }
             layout = layout_map.get(self.merge_spinner.text, 'horizontal')
             
             # Merge videos
             output_path = os.path.join(settings.PROCESSED_VIDEO_DIR, generate_filename())
-            Clock.schedule_once(lambda dt: setattr(self.progress_bar, 'value', 70), 0)
             
-            success = await merge_videos(
-                self.selected_video,
-                self.selected_video2,
+            success = await self.run_with_progress(merge_videos(
+                [self.selected_video, self.selected_video2],
                 output_path,
                 layout
-            )
+            ))
             
             Clock.schedule_once(lambda dt: setattr(self.progress_bar, 'value', 100), 0)
             
@@ -456,15 +461,32 @@ class VideoProcessorApp(App):
         except Exception as e:
             return {'success': False, 'error': str(e)}
     
+    def cancel_processing(self, instance):
+        """Cancel the running processing task"""
+        loop, task = self.processing_loop, self.processing_task
+        if loop and task:
+            instance.disabled = True
+            self.status_label.text = 'Cancelling...'
+            loop.call_soon_threadsafe(task.cancel)
+    
+    def on_processing_cancelled(self, button):
+        """Handle cancelled processing"""
+        button.disabled = False
+        self.cancel_btn.disabled = True
+        self.status_label.text = 'Processing cancelled'
+        self.progress_bar.value = 0
+    
     def on_processing_complete(self, button, output_path):
         """Handle successful processing"""
         button.disabled = False
+        self.cancel_btn.disabled = True
         self.status_label.text = 'Processing complete!'
         self.show_success(output_path)
     
     def on_processing_error(self, button, error):
         """Handle processing error"""
         button.disabled = False
+        self.cancel_btn.disabled = True
         self.status_label.text = 'Processing failed!'
         self.progress_bar.value = 0
         self.show_error(f'Processing error:\n{error}')
@@ -0,0 +1,1078 @@
+"""
+Test script for the video processing engine:
+- Modification graph compiler, variant jitter and previews
+- Perceptual uniqueness score
+- N-way stack layouts and piped stages
+- Mezzanine normalization
+- Segment-parallel encoding selection
+- Job executor, cancellation, thread budget and streaming combination map
+- Background upload downloads and result delivery
+- Telegram file_id reuse
+- Progress parsing and coalescing
+- Final encode statistics
+- Probe cache and stream copy detection
+- Result cache keys
+- Prometheus metrics
+- Request cost model and admission
+"""
+import asyncio
+import ffmpeg
+import utils.video_processing as video_processing
+from utils.video_processing import (
+    build_modification_graph,
+    preview_graph,
+    build_stack_graph,
+    build_mezzanine_graph,
+    mezzanine_options,
+    mezzanine_size,
+    use_segmented_encoding,
+    thread_args,
+    grid_shape,
+    output_size,
+    output_audio_codec,
+    variant_modifications,
+    get_video_info,
+    is_stream_copy_chain,
+    PIPE_OUTPUT_OPTIONS,
+    _metadata_args,
+    _variant_output_options,
+    VIDEO_FILTERS
+)
+from utils.job_executor import JobExecutor, map_as_completed
+from utils.progress import parse_final_stats, summarize_encode_stats
+from utils.metrics import Registry, Counter, Histogram, JOBS_TOTAL, STAGE_SECONDS, observe_job
+import utils.uniqueness as uniqueness
+from utils.uniqueness import dhash, phash, uniqueness_score, generate_variants_to_target, FRAME_HEIGHT, FRAME_WIDTH
+import numpy as np
+from bot.downloads import start_background, wait_for, wait_for_all, cancel_background
+import bot.delivery as bot_delivery
+from bot.delivery import result_delivery, send_video_result
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from database.models import Base, Video, ResultCacheEntry
+from database.crud import get_output_file_id
+import os
+import tempfile
+from utils.result_cache import make_cache_key
+from utils.cost_model import (
+    calibrate,
+    encode_cost,
+    estimate_groups,
+    estimate_videos,
+    plan_combinations,
+    WorkLedger,
+    MIN_CALIBRATION_SAMPLES
+)
+from types import SimpleNamespace
+from utils.progress import ProgressStream, parse_duration_line, parse_progress_time, parse_speed
+from config import settings
+
+
+def _compile(modifications, has_audio=True):
+    """Compile a modification chain into an ffmpeg command line"""
+    video, audio = build_modification_graph(ffmpeg.input('input.mp4'), modifications, has_audio)
+    streams = [video, audio] if audio is not None else [video]
+    return ffmpeg.output(*streams, 'output.mp4', vcodec='libx264').compile()
+
+
+def test_single_pass_graph():
+    """Test that a whole chain compiles into one ffmpeg invocation"""
+    print("Testing single pass graph...")
+
+    args = _compile([
+        {'type': 'speed', 'value': 1.5},
+        {'type': 'filter', 'value': 'sepia'},
+        {'type': 'scale', 'width': 640, 'height': 360},
+        {'type': 'rotate', 'angle': 90},
+        {'type': 'text', 'value': 'hello', 'x': 10, 'y': 10}
+    ])
+
+    assert args.count('-i') == 1
+    graph = args[args.index('-filter_complex') + 1]
+    for name in ['setpts', 'colorchannelmixer', 'scale=640:360', 'transpose=1', 'drawtext', 'atempo=1.5']:
+        assert name in graph, name
+    print("  ✓ Chain compiled into a single filter graph")
+
+    print("✅ Single pass graph test passed!")
+
+
+def test_filter_presets():
+    """Test that every filter preset compiles to a valid filter"""
+    print("Testing filter presets...")
+
+    for name in VIDEO_FILTERS:
+        graph = _compile([{'type': 'filter', 'value': name}], has_audio=False)[4]
+        assert '\\' not in graph, graph
+    print("  ✓ Filter presets compile without escaping")
+
+    print("✅ Filter presets test passed!")
+
+
+def test_audio_handling():
+    """Test that silent inputs produce video-only graphs"""
+    print("Testing audio handling...")
+
+    args = _compile([{'type': 'speed', 'value': 2.0}], has_audio=False)
+    assert 'atempo' not in args[args.index('-filter_complex') + 1]
+    assert args.count('-map') == 1
+    print("  ✓ Silent input has no audio branch")
+
+    args = _compile([{'type': 'rotate', 'angle': 180}])
+    graph = args[args.index('-filter_complex') + 1]
+    assert 'hflip' in graph and 'vflip' in graph
+    print("  ✓ 180° rotation uses flips")
+
+    args = _compile([{'type': 'speed', 'value': 3.0}])
+    graph = args[args.index('-filter_complex') + 1]
+    assert 'atempo=2.0' in graph and 'atempo=1.5' in graph
+    args = _compile([{'type': 'speed', 'value': 0.25}])
+    assert args[args.index('-filter_complex') + 1].count('atempo=0.5') == 2
+    print("  ✓ Out-of-range speeds chain atempo filters")
+
+    aac = {'has_audio': True, 'audio_codec': 'aac'}
+    assert output_audio_codec(aac, [{'type': 'filter', 'value': 'sepia'}]) == 'copy'
+    assert output_audio_codec(aac, [{'type': 'speed', 'value': 1.5}]) == 'aac'
+    assert output_audio_codec({'has_audio': True, 'audio_codec': 'pcm_s16le'}, [{'type': 'scale', 'width': 640, 'height': 360}]) == 'aac'
+    assert output_audio_codec({'has_audio': False}, [{'type': 'filter', 'value': 'sepia'}]) is None
+    print("  ✓ Audio untouched by the chain is copied, silent inputs get no audio codec")
+
+    print("✅ Audio handling test passed!")
+
+
+def test_variant_jitter():
+    """Test that unique copies get reproducible, in-frame jitter"""
+    print("Testing variant jitter...")
+
+    size = (1280, 720)
+    first = variant_modifications(42, 0, size)
+    assert first == variant_modifications(42, 0, size)
+    assert first != variant_modifications(42, 1, size)
+    assert first != variant_modifications(7, 0, size)
+    print("  ✓ The same seed and index reproduce the same chain")
+
+    for index in range(20):
+        crop, scale = variant_modifications(42, index, size)[:2]
+        assert crop['x'] + crop['width'] <= 1280 and crop['y'] + crop['height'] <= 720
+        assert crop['width'] % 2 == 0 and crop['height'] % 2 == 0
+        assert (scale['width'], scale['height']) == size
+    print("  ✓ Crops stay inside the frame and are scaled back to the input size")
+
+    graph = _compile(first)
+    graph = graph[graph.index('-filter_complex') + 1]
+    for name in ['crop=', 'eq=', 'hue=', 'noise=', 'atempo=']:
+        assert name in graph, name
+    print("  ✓ Jitter compiles into the same single-pass graph")
+
+    chain = [{'type': 'metadata', 'strip': True, 'tags': {'title': 'Clip', 'comment': 'mine'}}] + first
+    options = _variant_output_options(chain)
+    args = ffmpeg.output(ffmpeg.input('input.mp4'), 'copy.mp4', **options).compile()
+    tags = [args[i + 1] for i, arg in enumerate(args) if arg.startswith('-metadata:g:')]
+    assert options['map_metadata'] == -1
+    assert sorted(tags) == sorted(['title=Clip', f"comment={first[-1]['tags']['comment']}"])
+    print("  ✓ Every metadata tag of a copy is kept, the copy's own comment wins")
+
+    print("✅ Variant jitter test passed!")
+
+
+def test_preview_graph():
+    """Test that previews run the configured chain and are only ever scaled down"""
+    print("Testing preview graph...")
+
+    modifications = [{'type': 'filter', 'value': 'sepia'}, {'type': 'speed', 'value': 2.0}]
+    video, audio = preview_graph(ffmpeg.input('input.mp4', ss=3, t=4), modifications, height=360)
+    args = ffmpeg.output(video, audio, 'preview.mp4').compile()
+    graph = args[args.index('-filter_complex') + 1]
+    assert args[args.index('-ss') + 1] == '3' and args[args.index('-t') + 1] == '4'
+    assert 'colorchannelmixer' in graph and 'setpts' in graph and 'atempo=2.0' in graph
+    assert graph.index('setpts') < graph.index('scale=-2:min(360\\,ih)')
+    print("  ✓ The chain is followed by a downscale to at most 360 lines")
+
+    video, audio = preview_graph(ffmpeg.input('input.mp4'), [], has_audio=False)
+    assert audio is None
+    print("  ✓ Silent inputs get no audio branch")
+
+    print("✅ Preview graph test passed!")
+
+
+def test_uniqueness_score():
+    """Test the perceptual hashes and SSIM on synthetic frames"""
+    print("Testing uniqueness score...")
+
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:FRAME_HEIGHT, 0:FRAME_WIDTH]
+    source = np.stack([((x * 3 + y * 2 + i * 5) % 256) for i in range(8)]).astype(np.uint8)
+    assert dhash(source).shape == (8, 64) and phash(source).shape == (8, 64)
+    print("  ✓ dHash and pHash are 64 bits per frame")
+
+    same = uniqueness_score(source, source)
+    assert same['dhash'] == 0 and same['phash'] == 0
+    assert abs(same['ssim'] - 1) < 1e-9 and same['score'] < 1e-9
+    print("  ✓ Identical frames score 0")
+
+    noisy = np.clip(source + rng.normal(0, 8, source.shape), 0, 255).astype(np.uint8)
+    unrelated = rng.integers(0, 256, source.shape, dtype=np.uint8)
+    slight, different = uniqueness_score(source, noisy), uniqueness_score(source, unrelated)
+    assert 0 < slight['score'] < different['score'] <= 1
+    assert different['ssim'] < 0.2 and different['dhash'] > 0.3
+    print("  ✓ Light noise scores low, unrelated frames score high")
+
+    # Extra frames of a longer output are ignored
+    assert uniqueness_score(source, np.concatenate([source, unrelated]))['score'] < 1e-9
+    print("  ✓ Frame counts are matched")
+
+    # Tuning towards a target: copy 0 passes at once, copy 1 needs two stronger rounds
+    renders, strengths = [], {}
+
+    async def fake_generate(input_path, output_paths, seed, modifications, strength, indices):
+        renders.append((indices, strength))
+        strengths.update({path: strength for path in output_paths})
+        return True
+
+    async def fake_read(path):
+        return path
+
+    def fake_score(source, output):
+        return {'score': 0.5 if output == 'out0' else 0.1 * strengths[output]}
+
+    originals = uniqueness.generate_variants, uniqueness.read_gray_frames, uniqueness.uniqueness_score
+    uniqueness.generate_variants, uniqueness.read_gray_frames, uniqueness.uniqueness_score = (
+        fake_generate, fake_read, fake_score
+    )
+    try:
+        ok, scores = asyncio.run(generate_variants_to_target('in', ['out0', 'out1'], 7, [], target=0.2))
+    finally:
+        uniqueness.generate_variants, uniqueness.read_gray_frames, uniqueness.uniqueness_score = originals
+    assert ok and renders == [([0, 1], 1.0), ([1], 1.5), ([1], 2.25)]
+    assert scores[0] == 0.5 and abs(scores[1] - 0.225) < 1e-9
+    print("  ✓ Only copies below the target are rendered again")
+
+    print("✅ Uniqueness score test passed!")
+
+
+def test_stack_layouts():
+    """Test that N inputs are stacked in a single graph"""
+    print("Testing stack layouts...")
+
+    streams = [ffmpeg.input(f'input{i}.mp4') for i in range(3)]
+    sizes = [(1280, 720), (640, 480), (720, 1280)]
+
+    for layout, name in [('horizontal', 'hstack=inputs=3'), ('vertical', 'vstack=inputs=3')]:
+        args = ffmpeg.output(build_stack_graph(streams, sizes, layout), 'output.mp4').compile()
+        assert args.count('-i') == 3
+        assert name in args[args.index('-filter_complex') + 1]
+    print("  ✓ Horizontal and vertical merge all inputs at once")
+
+    assert grid_shape(1) == (1, 1)
+    assert grid_shape(3) == (2, 2)
+    assert grid_shape(5) == (3, 2)
+    args = ffmpeg.output(build_stack_graph(streams, sizes, 'grid', 10), 'output.mp4').compile()
+    graph = args[args.index('-filter_complex') + 1]
+    assert 'xstack=inputs=4:layout=0_0|1280_0|0_720|1280_720' in graph
+    assert 'lavfi' in args
+    print("  ✓ Grid pads the missing cell and uses xstack")
+
+    repeated = [ffmpeg.input('input0.mp4'), ffmpeg.input('input1.mp4'), ffmpeg.input('input0.mp4')]
+    args = ffmpeg.output(build_stack_graph(repeated, sizes, 'horizontal', fps='25'), 'output.mp4').compile()
+    graph = args[args.index('-filter_complex') + 1]
+    assert args.count('-i') == 2
+    assert 'split' in graph and graph.count('fps=25') == 3
+    print("  ✓ A repeated input is split and every input is resampled to one frame rate")
+
+    print("✅ Stack layouts test passed!")
+
+
+def test_pipe_stage_size():
+    """Test the frame size predicted for a piped modify stage"""
+    print("Testing piped stage sizes...")
+
+    info = {'width': 1920, 'height': 1080}
+    assert output_size(info, []) == (1920, 1080)
+    assert output_size(info, [{'type': 'scale', 'width': 640, 'height': 360}]) == (640, 360)
+    assert output_size(info, [{'type': 'rotate', 'angle': 90}]) == (1080, 1920)
+    assert output_size({'width': 1920, 'height': 1080, 'rotation': 90}, []) == (1080, 1920)
+    print("  ✓ Scale, crop and rotation are reflected in the stacked size")
+
+    assert PIPE_OUTPUT_OPTIONS['format'] == 'nut'
+    print("✅ Piped stage size test passed!")
+
+
+def test_mezzanine_graph():
+    """Test that segments are normalized to one concat-compatible profile"""
+    print("Testing mezzanine normalization...")
+
+    stream = ffmpeg.input('input.mp4')
+    video, audio = build_mezzanine_graph(stream.video, stream.audio)
+    args = ffmpeg.output(video, audio, 'output.mp4', **mezzanine_options()).compile()
+    graph = args[args.index('-filter_complex') + 1]
+    for name in ['pad=', 'fps=', 'format=yuv420p', 'aresample=48000', 'channel_layouts=stereo']:
+        assert name in graph, name
+    assert args[args.index('-sc_threshold') + 1] == '0'
+    print("  ✓ Resolution, fps, pixel format, audio layout and GOP are fixed")
+
+    video, audio = build_mezzanine_graph(stream.video, None, duration=4.0)
+    args = ffmpeg.output(video, audio, 'output.mp4', **mezzanine_options()).compile()
+    assert 'lavfi' in args
+    assert 'atrim=duration=4.0' in args[args.index('-filter_complex') + 1]
+    print("  ✓ Silent inputs get a silent track of matching length")
+
+    assert mezzanine_size([(720, 1280), (1080, 1920), (1920, 1080)]) == (720, 1280)
+    assert mezzanine_size([(1920, 1080), (640, 360), (720, 1280)]) == (1280, 720)
+    assert mezzanine_size([(500, 500), (720, 1280), (1280, 720)]) == (720, 1280)
+    assert mezzanine_size([(500, 500)]) == (1280, 720)
+    video, audio = build_mezzanine_graph(stream.video, stream.audio, size=(720, 1280))
+    graph = ffmpeg.output(video, audio, 'output.mp4').compile()
+    assert 'scale=720:1280' in ' '.join(graph) and 'pad=720:1280' in ' '.join(graph)
+    print("  ✓ The frame follows the orientation most of the videos have")
+
+    print("✅ Mezzanine normalization test passed!")
+
+
+def test_segmented_selection():
+    """Test that only long videos with modifications are split into chunks"""
+    print("Testing segmented encoding selection...")
+
+    mods = [{'type': 'filter', 'value': 'blur'}]
+    long_video = {'duration': settings.SEGMENT_MIN_DURATION + 1}
+    short_video = {'duration': settings.SEGMENT_MIN_DURATION - 1}
+
+    assert use_segmented_encoding(long_video, mods) == settings.SEGMENT_ENCODING_ENABLED
+    assert not use_segmented_encoding(short_video, mods)
+    assert not use_segmented_encoding(long_video, [])
+    assert not use_segmented_encoding({}, mods)
+    print("  ✓ Long inputs are split, short ones are encoded in one piece")
+
+    print("✅ Segmented encoding selection test passed!")
+
+
+def test_job_executor():
+    """Test that the executor bounds concurrency and runs jobs in order"""
+    print("Testing job executor...")
+
+    async def run():
+        executor = JobExecutor(max_workers=2)
+        running = 0
+        peak = 0
+        started = []
+
+        async def job(n):
+            nonlocal running, peak
+            started.append(n)
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            return n * 2
+
+        finished = []
+        executor.job_listeners.append(finished.append)
+        results = await asyncio.gather(*[executor.submit(job, n) for n in range(6)])
+        await executor.stop()
+        return results, peak, started, finished
+
+    results, peak, started, finished = asyncio.run(run())
+    assert results == [0, 2, 4, 6, 8, 10]
+    assert peak == 2
+    assert started == list(range(6))
+    print("  ✓ At most 2 jobs ran at once, in submission order")
+
+    assert len(finished) == 6 and all(job.name == 'job' for job in finished)
+    assert all(job.run_time >= 0.005 for job in finished)
+    # The last two jobs waited for two earlier rounds
+    assert finished[-1].queue_wait >= 0.015 > finished[0].queue_wait
+    print("  ✓ Listeners receive every finished job with its queue wait and run time")
+
+    print("✅ Job executor test passed!")
+
+
+def test_thread_budget():
+    """Test that concurrent jobs split the host's cores"""
+    print("Testing thread budget...")
+
+    cores = os.cpu_count() or 1
+    executor = JobExecutor(max_workers=4)
+    if settings.FFMPEG_THREADS == 0:
+        assert executor.thread_budget() == cores
+        executor.running = 3
+        assert executor.thread_budget() == max(1, cores // 4)
+        executor.running = 10
+        assert executor.thread_budget() == max(1, cores // 4)
+        print("  ✓ Budget shrinks with running jobs, bounded by the worker count")
+
+    assert thread_args(None) == ([], [])
+    global_args, output_args = thread_args(3)
+    assert global_args == ['-filter_threads', '3', '-filter_complex_threads', '3']
+    assert output_args == ['-threads', '3']
+    print("  ✓ Budget becomes filter and encoder thread options")
+
+    print("✅ Thread budget test passed!")
+
+
+def test_job_cancellation():
+    """Test that cancelling a waiting submitter cancels its running job"""
+    print("Testing job cancellation...")
+
+    async def run():
+        executor = JobExecutor(max_workers=1)
+        events = []
+
+        async def job(n):
+            try:
+                events.append(f"start {n}")
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                events.append(f"cancelled {n}")
+                raise
+            return n
+
+        async def quick():
+            return 'next'
+
+        waiter = asyncio.ensure_future(executor.submit(job, 1))
+        await asyncio.sleep(0.01)
+        queued = await executor.enqueue(job, 2)
+        await asyncio.sleep(0.01)
+        assert queued.state == 'queued'
+
+        waiter.cancel()
+        queued.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        # The worker survives and picks up the next job
+        result = await executor.submit(quick)
+        await executor.stop()
+        return events, queued.state, result
+
+    events, queued_state, result = asyncio.run(run())
+    assert events == ['start 1', 'cancelled 1']
+    assert queued_state == 'cancelled'
+    assert result == 'next'
+    print("  ✓ Running job cancelled, queued job dropped, worker kept")
+
+    print("✅ Job cancellation test passed!")
+
+
+def test_background_uploads():
+    """Test that upload work runs in the background and is collected or cancelled per user"""
+    print("Testing background uploads...")
+
+    async def run():
+        async def download(result, delay):
+            await asyncio.sleep(delay)
+            return result
+
+        start_background(1, 'a.mp4', download('a', 0.01))
+        start_background(1, 'b.mp4', download('b', 0.02))
+        results = await wait_for_all(1, ['a.mp4', 'b.mp4'])
+        missing = await wait_for(1, 'unknown.mp4')
+
+        path = os.path.join(tempfile.mkdtemp(), 'upload.mp4')
+        open(path, 'w').close()
+        task = start_background(2, path, download('c', 10))
+        cancelled = cancel_background(2)
+        await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0)
+        return results, missing, cancelled, task.cancelled(), os.path.exists(path)
+
+    results, missing, cancelled, task_cancelled, exists = asyncio.run(run())
+    assert results == ['a', 'b']
+    assert missing is None
+    print("  ✓ Done collects every download in upload order")
+    assert cancelled == 1 and task_cancelled and not exists
+    print("  ✓ Cancel stops pending downloads and deletes the upload")
+
+    print("✅ Background uploads test passed!")
+
+
+def test_result_delivery():
+    """Test that results are batched into albums and flood control is retried"""
+    print("Testing result delivery...")
+
+    class Sent:
+        def __init__(self, file_id):
+            self.video = type('Video', (), {'file_id': file_id})()
+            self.document = None
+
+    class FakeMessage:
+        def __init__(self):
+            self.calls = []
+            self.flooded = False
+
+        async def answer_video(self, video, caption):
+            if not self.flooded:
+                self.flooded = True
+                raise TelegramRetryAfter(method=None, message='Flood control', retry_after=0)
+            self.calls.append(('video', caption))
+            return Sent(caption)
+
+        async def answer_media_group(self, media):
+            self.calls.append(('album', len(media)))
+            return [Sent(item.caption) for item in media]
+
+    async def run():
+        message = FakeMessage()
+        async with result_delivery(message, album_size=3) as delivery:
+            for i in range(8):
+                delivery.send(f'result{i}.mp4', f'video {i}')
+        return message.calls, delivery.sent
+
+    calls, sent = asyncio.run(run())
+    assert sorted(calls, key=str) == [('album', 3), ('album', 3), ('video', 'video 0'), ('video', 'video 7')]
+    assert sent == 8
+    print("  ✓ The first result is sent at once, then albums, the rest as a single video")
+    print("  ✓ RetryAfter is waited out and the upload retried")
+
+    async def run_slowly():
+        message = FakeMessage()
+        message.flooded = True
+        async with result_delivery(message, album_size=10, album_wait=0.01) as delivery:
+            for i in range(3):
+                delivery.send(f'result{i}.mp4', f'video {i}')
+            await asyncio.sleep(0.1)
+            calls = list(message.calls)
+        return calls
+
+    assert asyncio.run(run_slowly()) == [('video', 'video 0'), ('album', 2)]
+    print("  ✓ An album that does not fill up is sent after the wait")
+
+    class FailingAlbums(FakeMessage):
+        async def answer_media_group(self, media):
+            raise TelegramBadRequest(method=None, message='Bad Request: album rejected')
+
+    async def run_failing():
+        message = FailingAlbums()
+        message.flooded = True
+        sent, failed = [], []
+        async with result_delivery(message, album_size=3) as delivery:
+            for i in range(4):
+                delivery.send(f'result{i}.mp4', f'video {i}',
+                              on_sent=lambda file_id: asyncio.sleep(0, sent.append(file_id)),
+                              on_failed=lambda error, i=i: asyncio.sleep(0, failed.append(i)))
+        return delivery.sent, delivery.failed, sent, sorted(failed)
+
+    assert asyncio.run(run_failing()) == (1, 3, ['video 0'], [1, 2, 3])
+    print("  ✓ Every result of a failed album reports the failure and the rest still counts")
+
+    print("✅ Result delivery test passed!")
+
+
+def test_file_id_reuse():
+    """Test that delivered outputs are sent again by their Telegram file_id"""
+    print("Testing file_id reuse...")
+
+    class Sent:
+        def __init__(self, file_id):
+            self.video = type('Video', (), {'file_id': file_id})()
+            self.document = None
+
+    class FakeMessage:
+        def __init__(self, rejected=()):
+            self.calls = []
+            self.rejected = rejected
+
+        async def answer_video(self, video, caption):
+            if isinstance(video, str):
+                if video in self.rejected:
+                    raise TelegramBadRequest(method=None, message='Bad Request: wrong file identifier')
+                self.calls.append(('file_id', video))
+                return Sent(video)
+            self.calls.append(('upload', os.path.basename(video.path)))
+            return Sent('uploaded')
+
+    engine = create_async_engine('sqlite+aiosqlite://')
+    session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    output_path = os.path.join(settings.PROCESSED_VIDEO_DIR, 'reused.mp4')
+
+    async def run():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with session_maker() as session:
+            assert await get_output_file_id(session, 'reused.mp4') is None
+            session.add(Video(user_id=1, file_id='source', mode=1, processed_filename='reused.mp4',
+                              output_file_id='video-file-id'))
+            await session.commit()
+            assert await get_output_file_id(session, 'reused.mp4') == 'video-file-id'
+            session.add(ResultCacheEntry(cache_key='key', processed_filename='reused.mp4',
+                                         telegram_file_id='cache-file-id'))
+            await session.commit()
+            assert await get_output_file_id(session, 'reused.mp4') == 'cache-file-id'
+        print("  ✓ The result cache entry's file_id is preferred over the Video row's")
+
+        message = FakeMessage()
+        assert await send_video_result(message, output_path, 'again') == 'cache-file-id'
+        assert message.calls == [('file_id', 'cache-file-id')]
+        print("  ✓ A delivered output is sent by its file_id without uploading")
+
+        message = FakeMessage(rejected={'cache-file-id'})
+        assert await send_video_result(message, output_path, 'again') == 'uploaded'
+        assert message.calls == [('upload', 'reused.mp4')]
+        async with session_maker() as session:
+            assert await get_output_file_id(session, 'reused.mp4') == 'uploaded'
+        print("  ✓ A rejected file_id falls back to an upload and is replaced")
+
+        message = FakeMessage()
+        await send_video_result(message, os.path.join(tempfile.gettempdir(), 'reused.mp4'), 'elsewhere')
+        assert message.calls == [('upload', 'reused.mp4')]
+        print("  ✓ Files outside the processed directory are always uploaded")
+
+    original = bot_delivery.async_session_maker
+    bot_delivery.async_session_maker = session_maker
+    try:
+        asyncio.run(run())
+    finally:
+        bot_delivery.async_session_maker = original
+
+    print("✅ File_id reuse test passed!")
+
+
+def test_map_as_completed():
+    """Test that combinations are pulled lazily and yielded as they finish"""
+    print("Testing streaming combination map...")
+
+    async def run():
+        pulled = []
+        running = 0
+        peak = 0
+
+        def items():
+            for n in range(5):
+                pulled.append(n)
+                yield n
+
+        async def render(n):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            # Later items finish first
+            await asyncio.sleep(0.01 * (5 - n))
+            running -= 1
+            return n * 10
+
+        results = []
+        async for item, result in map_as_completed(render, items(), 2):
+            # Never more than the in-flight window has been generated
+            assert len(pulled) - len(results) <= 2
+            results.append((item, result))
+        return results, peak
+
+    results, peak = asyncio.run(run())
+    assert sorted(results) == [(n, n * 10) for n in range(5)]
+    assert peak == 2
+    assert results[0] == (1, 10)
+    print("  ✓ At most 2 combinations in flight, yielded in completion order")
+
+    print("✅ Streaming combination map test passed!")
+
+
+def test_progress_stream():
+    """Test ffmpeg progress parsing and coalesced progress updates"""
+    print("Testing progress stream...")
+
+    assert parse_progress_time('00:01:02.500000') == 62.5
+    assert parse_progress_time('N/A') is None
+    assert parse_duration_line('  Duration: 00:02:00.04, start: 0.000000, bitrate: 1205 kb/s') == 120.04
+    assert parse_speed('2.5x') == 2.5
+    assert parse_speed('N/A') is None
+    print("  ✓ -progress values and stderr durations are parsed")
+
+    async def run():
+        stream = ProgressStream()
+        first = stream.start_process(duration=100)
+        second = stream.start_process(duration=100)
+        stream.update_process(first, out_time=50, speed=2.0)
+        stream.update_process(second, out_time=10, speed=1.0)
+        snapshot = stream.snapshot()
+
+        received = []
+
+        async def consume():
+            async for update in stream.updates(min_interval=0.05):
+                received.append(update)
+
+        consumer = asyncio.ensure_future(consume())
+        for out_time in range(11, 60):
+            stream.update_process(second, out_time=out_time, speed=1.0)
+            await asyncio.sleep(0.001)
+        stream.finish_process(first)
+        stream.finish_process(second)
+        await asyncio.sleep(0.1)
+        stream.close()
+        await consumer
+        return snapshot, received
+
+    snapshot, received = asyncio.run(run())
+    assert snapshot['percent'] == 30.0
+    assert snapshot['eta'] == 140 / 3.0
+    print("  ✓ Percent and ETA combine all running processes")
+
+    assert 1 <= len(received) < 10
+    assert received[-1]['percent'] == 100.0
+    print(f"  ✓ 50 updates coalesced into {len(received)}")
+
+    stream = ProgressStream()
+    failed = stream.start_process(duration=100)
+    retried = stream.start_process(duration=100)
+    stream.update_process(failed, out_time=40, speed=3.0)
+    stream.drop_process(failed)
+    stream.update_process(retried, out_time=25, speed=1.0)
+    assert stream.snapshot()['percent'] == 25.0
+    assert stream.snapshot()['speed'] == 1.0
+    print("  ✓ A dropped process no longer counts towards the total")
+
+    print("✅ Progress stream test passed!")
+
+
+def test_encode_stats():
+    """Test parsing of final -progress blocks and combining the runs of a job"""
+    print("Testing encode statistics...")
+
+    block = {
+        'frame': '300', 'fps': '61.5', 'bitrate': '1200.0kbits/s', 'total_size': '1500000',
+        'out_time_us': '10000000', 'out_time': '00:00:10.000000', 'dup_frames': '2', 'drop_frames': '1',
+        'speed': '2.05x', 'progress': 'end'
+    }
+    stats = parse_final_stats(block)
+    assert stats['frames'] == 300 and stats['fps'] == 61.5
+    assert stats['bitrate_kbps'] == 1200.0 and stats['output_size'] == 1500000
+    assert stats['output_duration'] == 10.0 and stats['speed'] == 2.05
+    assert stats['dropped_frames'] == 1 and stats['duplicated_frames'] == 2
+    empty = parse_final_stats({'frame': '0', 'fps': '0.00', 'bitrate': 'N/A', 'total_size': 'N/A',
+                               'out_time_us': 'N/A', 'speed': 'N/A'})
+    assert empty['bitrate_kbps'] is None and empty['output_size'] == 0 and empty['speed'] is None
+    print("  ✓ Final -progress values are parsed, N/A becomes empty")
+
+    # Two parallel producers and the consumer writing the output, which finishes last
+    producer = dict(stats, frames=150, dropped_frames=3, started_at=0.0, finished_at=4.0, threads=1)
+    consumer = dict(stats, started_at=0.5, finished_at=5.0, threads=2)
+    summary = summarize_encode_stats([producer, producer, consumer])
+    assert summary['encode_seconds'] == 5.0 and summary['frames'] == 300
+    assert summary['fps'] == 60.0 and summary['speed'] == 2.0
+    assert summary['dropped_frames'] == 7 and summary['processes'] == 3 and summary['threads'] == 2
+    assert summary['bitrate_kbps'] == 1200.0
+    print("  ✓ Output figures come from the last process, time spans every process")
+
+    print("✅ Encode statistics test passed!")
+
+
+def test_probe_cache():
+    """Test that each version of a file is probed once"""
+    print("Testing probe cache...")
+
+    probes = []
+
+    def fake_probe(path):
+        probes.append(path)
+        return {'duration': 1.0, 'width': 640, 'height': 360}
+
+    directory = tempfile.mkdtemp()
+    paths = [os.path.join(directory, f'video{i}.mp4') for i in range(3)]
+    for path in paths:
+        with open(path, 'w') as f:
+            f.write('v1')
+
+    original_probe, original_size = video_processing._probe_video, settings.PROBE_CACHE_SIZE
+    video_processing._probe_video = fake_probe
+    settings.PROBE_CACHE_SIZE = 2
+    video_processing._probe_cache.clear()
+    try:
+        async def run():
+            first = await get_video_info(paths[0])
+            first['width'] = 0
+            again = await get_video_info(paths[0])
+            assert len(probes) == 1 and again['width'] == 640
+            print("  ✓ Repeated lookups reuse the probe and get their own copy")
+
+            with open(paths[0], 'w') as f:
+                f.write('version 2')
+            await get_video_info(paths[0])
+            assert len(probes) == 2
+            print("  ✓ A rewritten file is probed again")
+
+            await get_video_info(paths[1])
+            await get_video_info(paths[2])
+            await get_video_info(paths[0])
+            assert len(probes) == 5
+            print("  ✓ Least recently used entries are evicted")
+
+        asyncio.run(run())
+    finally:
+        video_processing._probe_video = original_probe
+        settings.PROBE_CACHE_SIZE = original_size
+        video_processing._probe_cache.clear()
+
+    print("✅ Probe cache test passed!")
+
+
+def test_stream_copy_detection():
+    """Test which chains can be served by remuxing"""
+    print("Testing stream copy detection...")
+
+    assert is_stream_copy_chain([{'type': 'rotate', 'angle': 90}])
+    assert is_stream_copy_chain([{'type': 'metadata', 'strip': True}, {'type': 'rotate', 'angle': -90}])
+    assert not is_stream_copy_chain([])
+    assert not is_stream_copy_chain([{'type': 'rotate', 'angle': 90}, {'type': 'filter', 'value': 'blur'}])
+    print("  ✓ Only rotate/metadata chains are stream-copyable")
+
+    options, extra_args = _metadata_args([{'type': 'metadata', 'strip': True, 'tags': {'title': 'a', 'comment': 'b'}}])
+    assert options == {'map_metadata': -1}
+    assert extra_args == ['-metadata', 'title=a', '-metadata', 'comment=b']
+    print("  ✓ Metadata modifications become output options")
+
+    runs, probes = [], []
+
+    async def fake_run_ffmpeg(output, extra_args=None, duration=None, **kwargs):
+        runs.append((output.compile(), extra_args))
+
+    async def fake_keyframes(path):
+        probes.append(path)
+        return [0.0, 2.0, 4.0]
+
+    originals = video_processing.run_ffmpeg, video_processing.get_keyframe_times
+    video_processing.run_ffmpeg, video_processing.get_keyframe_times = fake_run_ffmpeg, fake_keyframes
+    try:
+        async def run():
+            assert await video_processing.trim_video('in.mp4', 'out.mp4', 2.02, 3.0, stream_copy=True)
+            assert await video_processing.trim_video('in.mp4', 'out.mp4', 1.0, 3.0, stream_copy=True)
+            assert await video_processing.trim_video('in.mp4', 'out.mp4', 0, 3.0, stream_copy=True)
+            assert await video_processing.trim_video('in.mp4', 'out.mp4', 2.0, 3.0, stream_copy=False)
+            await video_processing._remux_modifications('in.mp4', 'out.mp4', [
+                {'type': 'rotate', 'angle': 90},
+                {'type': 'metadata', 'strip': True, 'tags': {'title': 'a'}}
+            ], {'rotation': 0, 'duration': 5.0})
+            await video_processing._remux_modifications('in.mp4', 'out.mp4', [
+                {'type': 'rotate', 'angle': 180}, {'type': 'rotate', 'angle': 180}
+            ], {'rotation': 90, 'duration': 5.0})
+
+        asyncio.run(run())
+    finally:
+        video_processing.run_ffmpeg, video_processing.get_keyframe_times = originals
+
+    (on_keyframe, _), (between, _), (from_start, _), (disabled, _), (rotated, tags), (full_turn, _) = runs
+    assert on_keyframe[on_keyframe.index('-c') + 1] == 'copy' and '-avoid_negative_ts' in on_keyframe
+    assert on_keyframe.index('-ss') < on_keyframe.index('-i') and '-vcodec' not in on_keyframe
+    assert between[between.index('-vcodec') + 1] == 'libx264' and '-c' not in between
+    assert from_start[from_start.index('-c') + 1] == 'copy'
+    assert disabled[disabled.index('-vcodec') + 1] == 'libx264'
+    assert probes == ['in.mp4', 'in.mp4']
+    print("  ✓ Trims starting on a keyframe are remuxed, others re-encoded, and 0 is not probed")
+
+    assert rotated[rotated.index('-display_rotation') + 1] == '270'
+    assert rotated.index('-display_rotation') < rotated.index('-i')
+    assert rotated[rotated.index('-c') + 1] == 'copy' and rotated[rotated.index('-map_metadata') + 1] == '-1'
+    assert tags == ['-metadata', 'title=a']
+    assert '-display_rotation' not in full_turn and full_turn[full_turn.index('-c') + 1] == 'copy'
+    print("  ✓ Rotation remuxes set the counter-clockwise display matrix, full turns leave it alone")
+
+    print("✅ Stream copy detection test passed!")
+
+
+def test_result_cache_keys():
+    """Test that cache keys are canonical and input-sensitive"""
+    print("Testing result cache keys...")
+
+    mods = [{'type': 'scale', 'width': 640, 'height': 360}]
+    reordered = [{'height': 360, 'width': 640, 'type': 'scale'}]
+    assert make_cache_key(['abc'], mods) == make_cache_key(['abc'], reordered)
+    print("  ✓ Key ignores dict ordering")
+
+    assert make_cache_key(['abc'], mods) != make_cache_key(['abd'], mods)
+    assert make_cache_key(['abc'], mods) != make_cache_key(['abc'], [{'type': 'speed', 'value': 1.5}])
+    assert make_cache_key(['a', 'b'], mods) != make_cache_key(['b', 'a'], mods)
+    print("  ✓ Key changes with inputs, their order and modifications")
+
+    assert make_cache_key([None], mods) is None
+    print("  ✓ Unknown inputs are not cached")
+
+    print("✅ Result cache keys test passed!")
+
+
+def test_metrics():
+    """Test metric exposition and job timings"""
+    print("Testing metrics...")
+
+    registry = Registry()
+    transferred = Counter('test_bytes_total', 'Bytes', ('direction',), registry=registry)
+    durations = Histogram('test_seconds', 'Durations', ('stage',), buckets=(0.1, 1), registry=registry)
+    transferred.inc(100, direction='in')
+    transferred.inc(50, direction='in')
+    for value in [0.05, 0.5, 5]:
+        durations.observe(value, stage='encode')
+    text = registry.render()
+    assert '# TYPE test_bytes_total counter' in text
+    assert 'test_bytes_total{direction="in"} 150.0' in text
+    assert 'test_seconds_bucket{stage="encode",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{stage="encode",le="1.0"} 2' in text
+    assert 'test_seconds_bucket{stage="encode",le="+Inf"} 3' in text
+    assert 'test_seconds_sum{stage="encode"} 5.55' in text
+    assert 'test_seconds_count{stage="encode"} 3' in text
+    print("  ✓ Counters and cumulative histogram buckets are rendered")
+
+    try:
+        durations.observe(1, job='encode')
+        assert False, "wrong labels accepted"
+    except ValueError:
+        pass
+    print("  ✓ Label names are checked")
+
+    async def run():
+        executor = JobExecutor(max_workers=1)
+        executor.job_listeners.append(observe_job)
+
+        async def merge_videos():
+            return True
+
+        async def apply_modifications():
+            return False
+
+        await executor.submit(merge_videos)
+        await executor.submit(apply_modifications)
+        await executor.stop()
+
+    merges = STAGE_SECONDS.count(stage='merge')
+    failed = JOBS_TOTAL.value(job='apply_modifications', status='failed')
+    asyncio.run(run())
+    assert STAGE_SECONDS.count(stage='merge') == merges + 1
+    assert JOBS_TOTAL.value(job='merge_videos', status='done') >= 1
+    assert JOBS_TOTAL.value(job='apply_modifications', status='failed') == failed + 1
+    print("  ✓ Finished jobs are timed as merge or encode and counted by status")
+
+    print("✅ Metrics test passed!")
+
+
+def test_cost_model():
+    """Test request cost estimates, calibration and admission"""
+    print("Testing cost model...")
+
+    coefficients = {'encode': 1.0, 'merge': 1.0}
+    clip = {'width': 1280, 'height': 720, 'duration': 60}
+    mods = [{'type': 'speed', 'value': 1.5}]
+    base = encode_cost(clip, mods, coefficients)
+    assert base > 0
+    assert encode_cost(dict(clip, duration=120), mods, coefficients) == 2 * base
+    assert encode_cost(dict(clip, width=640, height=360), mods, coefficients) == base / 4
+    assert encode_cost(clip, mods + [{'type': 'filter', 'value': 'sepia'}], coefficients) > base
+    assert encode_cost(clip, mods, {'encode': 3.0, 'merge': 1.0}) == 3 * base
+    print("  ✓ Cost scales with resolution, duration, filters and the coefficient")
+
+    assert encode_cost(clip, [], coefficients) == 0
+    assert encode_cost(clip, [{'type': 'rotate', 'angle': 90}], coefficients) < base / 10
+    assert estimate_videos([clip, clip], mods, coefficients, variants=3) > 6 * base
+    print("  ✓ Unchanged and remuxed inputs are cheap, unique copies multiply")
+
+    assert plan_combinations('sequential', [2, 3]) == [[(0, 0), (0, 1), (1, 0), (1, 1), (1, 2)]]
+    assert plan_combinations('first_with_first', [2, 3, 1]) == [[(0, 0), (1, 0), (2, 0)], [(0, 1), (1, 1)]]
+    assert len(plan_combinations('all_with_all', [3, 4])) == 12
+    assert len(plan_combinations('all_with_all', [3, 4], limit=5)) == 5
+    groups = [([clip, clip], mods), ([clip, clip], [])]
+    side_by_side = estimate_groups(groups, 'all_with_all', 'hstack', coefficients)
+    assert side_by_side > estimate_groups(groups, 'all_with_all', 'hstack', coefficients, limit=2)
+    assert estimate_groups(groups, 'sequential', 'hstack', coefficients) < side_by_side
+    print("  ✓ Combine strategies are planned like the handlers render them")
+
+    def stat(job, seconds, threads=1):
+        return SimpleNamespace(job=job, encode_seconds=seconds, threads=threads,
+                               input_width=1280, input_height=720, input_duration=10)
+
+    default = settings.COST_DEFAULT_CPU_PER_MPS
+    few = calibrate([stat('apply_modifications', 18.432)] * (MIN_CALIBRATION_SAMPLES - 1))
+    assert few == {'encode': default, 'merge': default}
+    fitted = calibrate([stat('apply_modifications', 4.608, threads=2)] * MIN_CALIBRATION_SAMPLES
+                       + [stat('generate_variants', 100.0)] * MIN_CALIBRATION_SAMPLES)
+    assert abs(fitted['encode'] - 1.0) < 1e-9 and fitted['merge'] == default
+    print("  ✓ Coefficients are fitted to encode stats once enough are recorded")
+
+    original = settings.MAX_REQUEST_CPU_SECONDS, settings.MAX_BACKLOG_CPU_SECONDS
+    settings.MAX_REQUEST_CPU_SECONDS, settings.MAX_BACKLOG_CPU_SECONDS = 100, 150
+    try:
+        ledger = WorkLedger()
+        assert not ledger.check(101)[0]
+        assert ledger.check(100)[0]
+        # Uploads encoded before Done count towards the size of their order
+        assert ledger.check(50, already_admitted=50)[0]
+        assert not ledger.check(60, already_admitted=50)[0]
+
+        async def run():
+            async with ledger.admit(100):
+                assert ledger.admitted == 100
+                assert ledger.eta(20) == 120 / (os.cpu_count() or 1)
+                assert ledger.check(50)[0] and not ledger.check(51)[0]
+            assert ledger.admitted == 0
+
+        asyncio.run(run())
+    finally:
+        settings.MAX_REQUEST_CPU_SECONDS, settings.MAX_BACKLOG_CPU_SECONDS = original
+    print("  ✓ Oversized requests and a full backlog are turned away")
+
+    print("✅ Cost model test passed!")
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("Video Processing Test Suite")
+    print("=" * 50)
+    print()
+
+    try:
+        test_single_pass_graph()
+        print()
+        test_filter_presets()
+        print()
+        test_audio_handling()
+        print()
+        test_variant_jitter()
+        print()
+        test_preview_graph()
+        print()
+        test_uniqueness_score()
+        print()
+        test_stack_layouts()
+        print()
+        test_pipe_stage_size()
+        print()
+        test_mezzanine_graph()
+        print()
+        test_segmented_selection()
+        print()
+        test_job_executor()
+        print()
+        test_job_cancellation()
+        print()
+        test_thread_budget()
+        print()
+        test_background_uploads()
+        print()
+        test_result_delivery()
+        print()
+        test_file_id_reuse()
+        print()
+        test_map_as_completed()
+        print()
+        test_progress_stream()
+        print()
+        test_encode_stats()
+        print()
+        test_probe_cache()
+        print()
+        test_stream_copy_detection()
+        print()
+        test_result_cache_keys()
+        print()
+        test_metrics()
+        print()
+        test_cost_model()
+        print()
+        print("=" * 50)
+        print("✅ ALL TESTS PASSED!")
+        print("=" * 50)
+    except AssertionError as e:
+        print()
+        print("=" * 50)
+        print(f"❌ TEST FAILED: {e}")
+        print("=" * 50)
+        exit(1)
+    except Exception as e:
+        print()
+        print("=" * 50)
+        print(f"❌ ERROR: {e}")
+        import traceback
+        traceback.print_exc()
+        print("=" * 50)
+        exit(1)
@@ -0,0 +1,212 @@
+"""
+Compute cost of processing requests, in estimated CPU-seconds.
+
+Cost grows with the megapixel-seconds of the inputs (resolution x duration) and the
+number of filters in the compiled graph. The CPU-seconds per megapixel-second of
+encodes and merges are fitted to the encode stats recorded by earlier jobs. Estimates
+drive admission control (oversized requests, a full backlog), the ETA shown to users
+and the daily compute budgets of tariff plans.
+"""
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+import ffmpeg
+from config import settings
+from database.database import async_session_maker
+from database.crud import get_recent_encode_stats
+from utils.metrics import Gauge
+from utils.video_processing import (
+    build_modification_graph,
+    is_stream_copy_chain,
+    output_size,
+    variant_modifications
+)
+
+# Each filter of the graph adds this share of a plain re-encode
+FILTER_WEIGHT = 0.1
+# Mezzanine normalization adds scale, pad, fps and format filters
+MEZZANINE_FILTERS = 4
+# Merging adds scaling and the stack filter
+MERGE_FILTERS = 2
+# A remux costs this share of a re-encode
+REMUX_FACTOR = 0.02
+# Encode stats needed before the fitted coefficient replaces the default
+MIN_CALIBRATION_SAMPLES = 5
+CALIBRATION_TTL = 300
+
+# Jobs whose stats calibrate each coefficient. Unique copies are left out:
+# the number of copies an encode produced is not recorded
+CALIBRATION_JOBS = {
+    'apply_modifications': 'encode',
+    'merge_videos': 'merge',
+    'merge_videos_piped': 'merge',
+}
+
+
+def video_info(video) -> Dict:
+    """Probe-like info from a Video row or a Telegram video (upload metadata)"""
+    return {'width': video.width, 'height': video.height, 'duration': video.duration}
+
+
+def megapixel_seconds(info: Dict) -> float:
+    width, height = info.get('width') or 1280, info.get('height') or 720
+    return width * height / 1_000_000 * (info.get('duration') or 0)
+
+
+def graph_filter_count(modifications: List[Dict], has_audio: bool = True) -> int:
+    """Filters in the compiled graph of a modification chain"""
+    video, audio = build_modification_graph(ffmpeg.input('input.mp4'), modifications, has_audio)
+    args = ffmpeg.output(*[stream for stream in (video, audio) if stream is not None], 'output.mp4').compile()
+    if '-filter_complex' not in args:
+        return 0
+    graph = args[args.index('-filter_complex') + 1]
+    return sum(len(chain.split(',')) for chain in graph.split(';'))
+
+
+def calibrate(stats: Sequence) -> Dict[str, float]:
+    """CPU-seconds per megapixel-second of encodes and merges, fitted to EncodeStat rows"""
+    cpu = {'encode': 0.0, 'merge': 0.0}
+    work = {'encode': 0.0, 'merge': 0.0}
+    samples = {'encode': 0, 'merge': 0}
+    for stat in stats:
+        family = CALIBRATION_JOBS.get(stat.job)
+        if not family or not (stat.encode_seconds and stat.input_duration):
+            continue
+        # The job's ffmpeg processes may use up to its thread budget
+        cpu[family] += stat.encode_seconds * (stat.threads or 1)
+        work[family] += megapixel_seconds({
+            'width': stat.input_width, 'height': stat.input_height, 'duration': stat.input_duration
+        })
+        samples[family] += 1
+    return {
+        family: cpu[family] / work[family]
+        if samples[family] >= MIN_CALIBRATION_SAMPLES and work[family] else settings.COST_DEFAULT_CPU_PER_MPS
+        for family in cpu
+    }
+
+
+_calibration: Dict = {'at': None, 'coefficients': None}
+
+
+async def load_coefficients() -> Dict[str, float]:
+    """calibrate() on the most recent encode stats, refreshed every CALIBRATION_TTL seconds"""
+    if _calibration['at'] is None or time.monotonic() - _calibration['at'] > CALIBRATION_TTL:
+        async with async_session_maker() as session:
+            stats = await get_recent_encode_stats(session, settings.COST_CALIBRATION_SAMPLES)
+        _calibration.update(at=time.monotonic(), coefficients=calibrate(stats))
+    return _calibration['coefficients']
+
+
+def encode_cost(info: Dict, modifications: List[Dict], coefficients: Dict[str, float],
+                copies: int = 1, mezzanine: bool = False) -> float:
+    """CPU-seconds to apply a modification chain to one input, for `copies` unique copies"""
+    if not modifications and not mezzanine and copies == 1:
+        # Returned unchanged
+        return 0.0
+    work = megapixel_seconds(info) * coefficients['encode']
+    if copies == 1 and not mezzanine and is_stream_copy_chain(modifications):
+        return work * REMUX_FACTOR
+    filters = graph_filter_count(modifications)
+    if copies > 1:
+        filters += graph_filter_count(variant_modifications(0, 0, output_size(info, modifications)))
+    if mezzanine:
+        filters += MEZZANINE_FILTERS
+    return work * (1 + FILTER_WEIGHT * filters) * copies
+
+
+def combination_cost(items: List[Tuple[Dict, List[Dict]]], layout: str, coefficients: Dict[str, float],
+                     piped: bool = False) -> float:
+    """CPU-seconds to combine (info, modifications) inputs; with `piped` their chains run in the merge"""
+    work = sum(megapixel_seconds(info) for info, _ in items) * coefficients['merge']
+    if layout == 'sequential':
+        # Normalized segments are concatenated by remuxing
+        return work * REMUX_FACTOR
+    filters = MERGE_FILTERS * len(items)
+    if piped:
+        filters += sum(graph_filter_count(modifications) for _, modifications in items)
+    return work * (1 + FILTER_WEIGHT * filters)
+
+
+def plan_combinations(strategy: str, group_sizes: List[int],
+                      limit: Optional[int] = None) -> List[List[Tuple[int, int]]]:
+    """
+    (group, video) indices of every output a combine strategy produces, as Mode 2 and Mode N
+    build them; `limit` caps all_with_all like MAX_CARTESIAN_COMBINATIONS does in Mode N
+    """
+    if strategy == 'sequential':
+        return [[(group, index) for group, size in enumerate(group_sizes) for index in range(size)]]
+    if strategy == 'all_with_all':
+        return [
+            list(enumerate(indices))
+            for indices in itertools.islice(itertools.product(*[range(size) for size in group_sizes]), limit)
+        ]
+    combinations = []
+    for index in range(max(group_sizes, default=0)):
+        combination = [(group, index) for group, size in enumerate(group_sizes) if index < size]
+        if len(combination) >= 2:
+            combinations.append(combination)
+    return combinations
+
+
+def estimate_videos(infos: List[Dict], modifications: List[Dict], coefficients: Dict[str, float],
+                    variants: int = 1) -> float:
+    """CPU-seconds of a Mode 1 request"""
+    return sum(encode_cost(info, modifications, coefficients, variants) for info in infos)
+
+
+def estimate_groups(groups: List[Tuple[List[Dict], List[Dict]]], strategy: str, layout: str,
+                    coefficients: Dict[str, float], limit: Optional[int] = None) -> float:
+    """CPU-seconds of a Mode 2 / Mode N request; `groups` are (input infos, modifications)"""
+    mezzanine = strategy == 'sequential' or layout == 'sequential'
+    piped = settings.PIPED_STAGES_ENABLED and strategy == 'first_with_first' and not mezzanine
+    total = 0.0
+    if not piped:
+        for infos, modifications in groups:
+            total += sum(encode_cost(info, modifications, coefficients, mezzanine=mezzanine) for info in infos)
+    for combination in plan_combinations(strategy, [len(infos) for infos, _ in groups], limit):
+        items = [(groups[group][0][index], groups[group][1]) for group, index in combination]
+        total += combination_cost(items, 'sequential' if strategy == 'sequential' else layout, coefficients, piped)
+    return total
+
+
+class WorkLedger:
+    """Estimated CPU-seconds of the requests admitted and not finished yet"""
+
+    def __init__(self):
+        self.admitted = 0.0
+
+    def check(self, cpu_seconds: float, already_admitted: float = 0.0) -> Tuple[bool, str]:
+        """
+        Whether `cpu_seconds` more work of a request may start, `already_admitted` of it
+        being admitted earlier (uploads encoded before Done); returns (allowed, error_message)
+        """
+        total = already_admitted + cpu_seconds
+        if settings.MAX_REQUEST_CPU_SECONDS and total > settings.MAX_REQUEST_CPU_SECONDS:
+            return False, (f"This order is too large: it needs about {total / 60:.1f} CPU minutes, "
+                           f"at most {settings.MAX_REQUEST_CPU_SECONDS / 60:.1f} are allowed per order.")
+        # A request is never turned away while nothing else is running
+        if (settings.MAX_BACKLOG_CPU_SECONDS and self.admitted
+                and self.admitted + cpu_seconds > settings.MAX_BACKLOG_CPU_SECONDS):
+            return False, "The server is busy with other orders right now."
+        return True, ""
+
+    def eta(self, cpu_seconds: float) -> float:
+        """Seconds until a request of `cpu_seconds` admitted now is done, on all cores"""
+        return (self.admitted + cpu_seconds) / (os.cpu_count() or 1)
+
+    @asynccontextmanager
+    async def admit(self, cpu_seconds: float):
+        """Count a request's estimate in the backlog while the block runs"""
+        self.admitted += cpu_seconds
+        try:
+            yield
+        finally:
+            self.admitted -= cpu_seconds
+
+
+work_ledger = WorkLedger()
+
+Gauge('videobot_admitted_cpu_seconds', 'Estimated CPU-seconds of admitted unfinished requests',
+      lambda: work_ledger.admitted)
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import os
+import time
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from config import settings
+from utils.progress import current_encode_stats, current_progress
+
+logger = logging.getLogger(__name__)
+
+
+def default_worker_count() -> int:
+    """Number of concurrent ffmpeg jobs for this host"""
+    if settings.MAX_CONCURRENT_JOBS > 0:
+        return settings.MAX_CONCURRENT_JOBS
+    # libx264 already spreads one encode over several threads,
+    # so a few full-speed jobs beat many jobs fighting for the same cores
+    return max(1, (os.cpu_count() or 1) // 4)
+
+
+# Threads a job's ffmpeg processes may use; None outside the executor (no limit)
+current_thread_budget: ContextVar[Optional[int]] = ContextVar('current_thread_budget', default=None)
+
+
+class Job:
+    """
+    Handle of a unit of work in the executor queue.
+    Awaiting it returns the result; cancel() drops it from the queue or,
+    once running, cancels it so its ffmpeg process is killed.
+    """
+
+    def __init__(self, func: Callable[..., Awaitable[Any]], args: tuple, kwargs: dict):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.future.add_done_callback(self._on_done)
+        self.task: Optional[asyncio.Task] = None
+        # Workers run in their own tasks, so carry the submitter's progress stream
+        # and encode stats collector over
+        self.progress = current_progress.get()
+        self.encode_stats = current_encode_stats.get()
+        # time.monotonic() when the job was queued, picked up by a worker and finished
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def name(self) -> str:
+        return getattr(self.func, '__name__', repr(self.func))
+
+    @property
+    def queue_wait(self) -> Optional[float]:
+        """Seconds the job waited for a free worker"""
+        if self.started_at is None:
+            return None
+        return self.started_at - self.enqueued_at
+
+    @property
+    def run_time(self) -> Optional[float]:
+        """Seconds the job ran on a worker"""
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    @property
+    def state(self) -> str:
+        if self.future.cancelled():
+            return 'cancelled'
+        if self.future.done():
+            return 'done'
+        return 'running' if self.task else 'queued'
+
+    def cancel(self) -> bool:
+        return self.future.cancel()
+
+    def _on_done(self, future: asyncio.Future):
+        if future.cancelled() and self.task and not self.task.done():
+            self.task.cancel()
+
+    def __await__(self):
+        return self.future.__await__()
+
+
+class JobExecutor:
+    """
+    FIFO job queue in front of a bounded number of ffmpeg workers.
+    Handlers submit work and await its result; at most `max_workers` jobs run at once
+    and the rest wait in order instead of slowing every running encode down.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers or default_worker_count()
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self.running = 0
+        # Called with every job that ran once it finished (timings, metrics)
+        self.job_listeners: List[Callable[[Job], Any]] = []
+
+    @property
+    def queued(self) -> int:
+        """Number of jobs waiting for a free worker"""
+        return self._queue.qsize() if self._queue else 0
+
+    def thread_budget(self) -> int:
+        """
+        Threads for a job starting now: the host's cores split between the jobs
+        that will be running alongside it, so parallel encodes do not oversubscribe the CPU
+        """
+        if settings.FFMPEG_THREADS > 0:
+            return settings.FFMPEG_THREADS
+        concurrent = min(self.max_workers, self.running + self.queued + 1)
+        return max(1, (os.cpu_count() or 1) // concurrent)
+
+    async def start(self):
+        """Start worker tasks on the running event loop"""
+        if self._workers:
+            return
+        self._queue = asyncio.Queue(maxsize=settings.JOB_QUEUE_SIZE)
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"job-worker-{i}")
+            for i in range(self.max_workers)
+        ]
+
+    async def stop(self):
+        """Stop workers and fail jobs that never started"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+        while self._queue and not self._queue.empty():
+            job = self._queue.get_nowait()
+            if not job.future.done():
+                job.future.cancel()
+        self._queue = None
+
+    async def enqueue(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Job:
+        """Enqueue a coroutine function and return its job handle"""
+        await self.start()
+        job = Job(func, args, kwargs)
+        await self._queue.put(job)
+        return job
+
+    async def submit(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+        Enqueue a coroutine function and wait for its result.
+        Cancelling the waiting task cancels the job as well.
+        """
+        job = await self.enqueue(func, *args, **kwargs)
+        return await job
+
+    def _job_finished(self, task: asyncio.Task):
+        self.running -= 1
+
+    def _notify_listeners(self, job: Job):
+        job.finished_at = time.monotonic()
+        for listener in self.job_listeners:
+            try:
+                listener(job)
+            except Exception:
+                logger.exception("Job listener failed")
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.future.done():
+                    continue
+                current_progress.set(job.progress)
+                current_encode_stats.set(job.encode_stats)
+                current_thread_budget.set(self.thread_budget())
+                job.started_at = time.monotonic()
+                # Run in a separate task so cancelling the job does not stop the worker
+                job.task = asyncio.create_task(job.func(*job.args, **job.kwargs))
+                self.running += 1
+                job.task.add_done_callback(self._job_finished)
+                result = await asyncio.shield(job.task)
+                if not job.future.done():
+                    job.future.set_result(result)
+            except asyncio.CancelledError:
+                if job.task and not job.task.done():
+                    job.task.cancel()
+                    await asyncio.gather(job.task, return_exceptions=True)
+                if not job.future.done():
+                    job.future.cancel()
+                # A cancelled job lands here too; keep the worker unless it is being stopped itself
+                if asyncio.current_task().cancelling():
+                    raise
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                if job.started_at is not None:
+                    self._notify_listeners(job)
+                self._queue.task_done()
+
+
+job_executor = JobExecutor()
+
+
+async def map_as_completed(func: Callable[[Any], Awaitable[Any]], items: Iterable,
+                           concurrency: int) -> AsyncIterator[Tuple[Any, Any]]:
+    """
+    Pull items lazily from `items`, keep at most `concurrency` calls of `func` in flight
+    and yield (item, result) pairs as soon as each call finishes.
+    Calls still running are cancelled if the consumer stops early or a call fails.
+    """
+    iterator = iter(items)
+    pending: Dict[asyncio.Task, Any] = {}
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < concurrency:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[asyncio.ensure_future(func(item))] = item
+
+            if not pending:
+                return
+
+            done, _ = await asyncio.wait(pending.keys(), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                item = pending.pop(task)
+                yield item, task.result()
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,207 @@
+"""
+Process-local metrics in the Prometheus text exposition format.
+
+Every video job reports how long it spent in each stage (Telegram download, probe,
+job queue, encode, merge, Telegram upload, database) and the bytes it moved, so a
+latency spike can be traced to Telegram I/O, ffmpeg or SQLite. The API serves the
+registry of its process on /metrics; the bot process serves its own with
+start_exporter() when METRICS_PORT is set.
+"""
+import math
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from aiohttp import web
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds, from a database statement to a long encode
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Registry:
+    """Metrics of this process, rendered together for a scrape"""
+
+    def __init__(self):
+        self._metrics: Dict[str, 'Metric'] = {}
+
+    def register(self, metric: 'Metric'):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 registry: Optional[Registry] = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[str]:
+        return iter(())
+
+
+class Counter(Metric):
+    """Monotonic total, e.g. bytes transferred"""
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        if amount < 0:
+            raise ValueError("Counters can only go up")
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Gauge(Metric):
+    """Current value read from `collect` at scrape time, e.g. the job queue length"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, collect: Callable[[], float],
+                 registry: Optional[Registry] = REGISTRY):
+        super().__init__(name, documentation, (), registry)
+        self.collect = collect
+
+    def samples(self) -> Iterator[str]:
+        yield f'{self.name} {_format_value(self.collect())}'
+
+
+class Histogram(Metric):
+    """Distribution of durations in cumulative buckets, with their sum and count"""
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> (count per bucket, sum)
+        self._values: Dict[Tuple[str, ...], List] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts, _ = entry = self._values.setdefault(key, [[0] * len(self.buckets), 0.0])
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block, also when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ('le',), key + (_format_value(bound),))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_format_value(total)}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+STAGE_SECONDS = Histogram(
+    'videobot_stage_seconds',
+    'Time spent per stage: download, probe, queue_wait, encode, merge, upload, db',
+    ('stage',)
+)
+JOB_SECONDS = Histogram('videobot_job_seconds', 'Run time of executor jobs by function', ('job',))
+JOBS_TOTAL = Counter('videobot_jobs_total', 'Executor jobs finished, by function and status', ('job', 'status'))
+BYTES_TOTAL = Counter('videobot_bytes_total', 'Video bytes downloaded from (in) and uploaded to (out) Telegram',
+                      ('direction',))
+
+# Jobs combining several inputs into one output; every other job is an encode
+MERGE_JOBS = {'merge_videos', 'merge_videos_piped', 'concatenate_videos'}
+
+
+def observe_job(job) -> None:
+    """JobExecutor listener: queue wait, run time and outcome of a finished job"""
+    STAGE_SECONDS.observe(job.queue_wait, stage='queue_wait')
+    STAGE_SECONDS.observe(job.run_time, stage='merge' if job.name in MERGE_JOBS else 'encode')
+    JOB_SECONDS.observe(job.run_time, job=job.name)
+    if job.future.cancelled():
+        status = 'cancelled'
+    elif job.future.exception() is not None or job.future.result() is False:
+        # Processing helpers report failure by returning False
+        status = 'failed'
+    else:
+        status = 'done'
+    JOBS_TOTAL.inc(job=job.name, status=status)
+
+
+def register_executor(executor) -> None:
+    """Report the jobs of `executor` and export its queue length and running jobs"""
+    executor.job_listeners.append(observe_job)
+    Gauge('videobot_jobs_queued', 'Jobs waiting for a free worker', lambda: executor.queued)
+    Gauge('videobot_jobs_running', 'Jobs running on a worker', lambda: executor.running)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=REGISTRY.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def start_exporter(port: int, host: str = '0.0.0.0') -> web.AppRunner:
+    """Serve /metrics of this process on `port`; stop it with `await runner.cleanup()`"""
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,183 @@
+import asyncio
+import itertools
+import re
+import time
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, List, Optional
+
+_DURATION_RE = re.compile(r'Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)')
+
+
+def parse_progress_time(value: str) -> Optional[float]:
+    """Seconds from an ffmpeg HH:MM:SS.micro timestamp"""
+    try:
+        hours, minutes, seconds = value.strip().split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except (ValueError, AttributeError):
+        return None
+
+
+def parse_duration_line(line: str) -> Optional[float]:
+    """Input duration from an ffmpeg stderr 'Duration:' line"""
+    match = _DURATION_RE.search(line)
+    if not match:
+        return None
+    return int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3))
+
+
+def parse_speed(value: str) -> Optional[float]:
+    """Encoding speed from an ffmpeg '1.5x' progress value"""
+    try:
+        return float(value.strip().rstrip('x'))
+    except (ValueError, AttributeError):
+        return None
+
+
+def _progress_number(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_final_stats(block: Dict[str, str]) -> Dict:
+    """Frames, fps, bitrate, output size and time, dropped/duplicated frames and speed of a -progress block"""
+    out_time = _progress_number(block.get('out_time_us'))
+    bitrate = (block.get('bitrate') or '').strip()
+    return {
+        'frames': int(_progress_number(block.get('frame')) or 0),
+        'fps': _progress_number(block.get('fps')),
+        'bitrate_kbps': _progress_number(bitrate[:-len('kbits/s')]) if bitrate.endswith('kbits/s') else None,
+        'output_size': int(_progress_number(block.get('total_size')) or 0),
+        'output_duration': out_time / 1_000_000 if out_time and out_time > 0 else parse_progress_time(
+            block.get('out_time', '')),
+        'dropped_frames': int(_progress_number(block.get('drop_frames')) or 0),
+        'duplicated_frames': int(_progress_number(block.get('dup_frames')) or 0),
+        'speed': parse_speed(block.get('speed', '')),
+    }
+
+
+def summarize_encode_stats(runs: List[Dict]) -> Dict:
+    """
+    Combine the stats of the ffmpeg processes of one job. Output figures come from the
+    process that finished last (the one writing the final file); time spans all of them.
+    """
+    last = max(runs, key=lambda run: run['finished_at'])
+    encode_seconds = last['finished_at'] - min(run['started_at'] for run in runs)
+    output_duration = last['output_duration'] or 0.0
+    return {
+        'frames': last['frames'],
+        'output_size': last['output_size'],
+        'output_duration': output_duration,
+        'bitrate_kbps': (last['output_size'] * 8 / output_duration / 1000
+                         if last['output_size'] and output_duration else last['bitrate_kbps']),
+        'dropped_frames': sum(run['dropped_frames'] for run in runs),
+        'duplicated_frames': sum(run['duplicated_frames'] for run in runs),
+        'encode_seconds': encode_seconds,
+        'fps': last['frames'] / encode_seconds if encode_seconds > 0 else last['fps'],
+        'speed': output_duration / encode_seconds if encode_seconds > 0 else last['speed'],
+        'processes': len(runs),
+        'threads': max(run['threads'] or 0 for run in runs) or None,
+    }
+
+
+def format_eta(seconds: Optional[float]) -> str:
+    """Format an ETA as M:SS or H:MM:SS"""
+    if seconds is None:
+        return "—"
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+class ProgressStream:
+    """
+    Progress of every ffmpeg process started for one request, merged into one stream.
+    run_ffmpeg publishes into the stream set in `current_progress`; consumers iterate
+    `updates()` and receive coalesced snapshots no more often than they ask for.
+    """
+
+    def __init__(self):
+        self._processes: Dict[int, Dict] = {}
+        self._ids = itertools.count()
+        self._changed = asyncio.Event()
+        self._closed = False
+        self.stage = ''
+
+    def start_process(self, duration: Optional[float] = None) -> int:
+        """Register an ffmpeg process expected to produce `duration` seconds of output"""
+        process_id = next(self._ids)
+        self._processes[process_id] = {'duration': duration, 'out_time': 0.0, 'speed': None, 'fps': None}
+        self._changed.set()
+        return process_id
+
+    def set_duration(self, process_id: int, duration: float):
+        process = self._processes[process_id]
+        if not process['duration']:
+            process['duration'] = duration
+            self._changed.set()
+
+    def update_process(self, process_id: int, out_time: Optional[float] = None,
+                       speed: Optional[float] = None, fps: Optional[float] = None):
+        process = self._processes[process_id]
+        if out_time is not None:
+            process['out_time'] = max(0.0, out_time)
+        process['speed'] = speed
+        process['fps'] = fps
+        self._changed.set()
+
+    def finish_process(self, process_id: int):
+        process = self._processes[process_id]
+        if process['duration']:
+            process['out_time'] = process['duration']
+        process['speed'] = None
+        process['fps'] = None
+        self._changed.set()
+
+    def drop_process(self, process_id: int):
+        """Forget a process that failed or was cancelled, so it no longer counts towards the total"""
+        self._processes.pop(process_id, None)
+        self._changed.set()
+
+    def set_stage(self, stage: str):
+        """Human readable step shown next to the numbers, e.g. 'Video 2/5'"""
+        self.stage = stage
+        self._changed.set()
+
+    def snapshot(self) -> Dict:
+        """Overall percent, ETA in seconds, current speed and fps"""
+        known = [p for p in self._processes.values() if p['duration']]
+        total = sum(p['duration'] for p in known)
+        done = sum(min(p['out_time'], p['duration']) for p in known)
+        running = [p for p in self._processes.values() if p['speed']]
+        speed = sum(p['speed'] for p in running)
+
+        percent = 100.0 * done / total if total else 0.0
+        eta = (total - done) / speed if speed and total else None
+        fps = sum(p['fps'] or 0 for p in running) or None
+        return {'percent': percent, 'eta': eta, 'speed': speed or None, 'fps': fps, 'stage': self.stage}
+
+    def close(self):
+        self._closed = True
+        self._changed.set()
+
+    async def updates(self, min_interval: float = 1.0) -> AsyncIterator[Dict]:
+        """Yield a snapshot after each change, at most once per `min_interval` seconds"""
+        while True:
+            await self._changed.wait()
+            if self._closed:
+                return
+            self._changed.clear()
+            started = time.monotonic()
+            yield self.snapshot()
+            await asyncio.sleep(max(0.0, min_interval - (time.monotonic() - started)))
+
+
+# Stream that ffmpeg processes started by the current task report into
+current_progress: ContextVar[Optional[ProgressStream]] = ContextVar('current_progress', default=None)
+
+# List the final stats of every ffmpeg process started by the current task are appended to
+current_encode_stats: ContextVar[Optional[List[Dict]]] = ContextVar('current_encode_stats', default=None)
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import shutil
+from typing import Any, Awaitable, Callable, List, Optional
+from config import settings
+from database.database import async_session_maker
+from database.crud import (
+    get_cache_entry,
+    touch_cache_entry,
+    create_cache_entry,
+    delete_cache_entry,
+    get_cache_entries_lru,
+    record_cache_lookup
+)
+from utils.video_processing import ENGINE_VERSION, generate_filename
+
+
+def canonical_json(value: Any) -> str:
+    """Serialize modifications so equal specs always produce the same string"""
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def make_cache_key(source_keys: List[Optional[str]], spec: Any) -> Optional[str]:
+    """
+    Build a cache key from the input identities (Telegram file_unique_id),
+    the processing spec (modifications, layout, ...) and the engine version.
+    Returns None when an input has no known identity.
+    """
+    if not source_keys or not all(source_keys):
+        return None
+    payload = canonical_json({'engine': ENGINE_VERSION, 'sources': list(source_keys), 'spec': spec})
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+async def get_cached_result(cache_key: str) -> Optional[str]:
+    """Return the path of a cached output, or None on a miss"""
+    if not settings.RESULT_CACHE_ENABLED:
+        return None
+
+    async with async_session_maker() as session:
+        entry = await get_cache_entry(session, cache_key)
+        path = os.path.join(settings.PROCESSED_VIDEO_DIR, entry.processed_filename) if entry else None
+
+        if entry and not os.path.exists(path):
+            # Output was removed behind our back, forget it
+            await delete_cache_entry(session, entry.id)
+            entry = None
+
+        await record_cache_lookup(session, hit=entry is not None)
+        if not entry:
+            return None
+
+        await touch_cache_entry(session, entry.id)
+        return path
+
+
+async def store_result(cache_key: str, output_path: str) -> Optional[str]:
+    """
+    Keep a finished output in the cache. Outputs outside PROCESSED_VIDEO_DIR are copied in.
+    Returns the cached path.
+    """
+    if not settings.RESULT_CACHE_ENABLED or not os.path.exists(output_path):
+        return None
+
+    processed_dir = os.path.abspath(settings.PROCESSED_VIDEO_DIR)
+    if os.path.dirname(os.path.abspath(output_path)) != processed_dir:
+        cached_path = os.path.join(settings.PROCESSED_VIDEO_DIR, generate_filename())
+        shutil.copyfile(output_path, cached_path)
+    else:
+        cached_path = output_path
+
+    async with async_session_maker() as session:
+        if await get_cache_entry(session, cache_key):
+            return cached_path
+        await create_cache_entry(
+            session, cache_key, os.path.basename(cached_path), os.path.getsize(cached_path)
+        )
+
+    await evict_results()
+    return cached_path
+
+
+async def evict_results():
+    """Drop least recently used outputs until the cache fits its size and entry limits"""
+    max_bytes = settings.RESULT_CACHE_MAX_SIZE_MB * 1024 * 1024
+
+    async with async_session_maker() as session:
+        entries = await get_cache_entries_lru(session)
+        total_size = sum(entry.file_size or 0 for entry in entries)
+        count = len(entries)
+
+        for entry in entries:
+            if total_size <= max_bytes and count <= settings.RESULT_CACHE_MAX_ENTRIES:
+                break
+
+            path = os.path.join(settings.PROCESSED_VIDEO_DIR, entry.processed_filename)
+            if os.path.exists(path):
+                os.remove(path)
+            await delete_cache_entry(session, entry.id)
+            total_size -= entry.file_size or 0
+            count -= 1
+
+
+async def get_or_render(cache_key: Optional[str], output_path: str,
+                        render: Callable[[], Awaitable[bool]]) -> str:
+    """
+    Return the cached output for `cache_key`, or call `render` to produce `output_path`
+    and cache it. Raises RuntimeError when rendering fails.
+    """
+    if cache_key:
+        cached_path = await get_cached_result(cache_key)
+        if cached_path:
+            return cached_path
+
+    if not await render():
+        raise RuntimeError("Video processing failed")
+
+    if cache_key:
+        await store_result(cache_key, output_path)
+    return output_path
@@ -0,0 +1,161 @@
+"""
+Perceptual uniqueness of a processed video compared to its source.
+
+Frames are sampled at the same relative positions of both videos, decoded by ffmpeg
+straight to small grayscale frames on a pipe and compared with NumPy:
+dHash and pHash Hamming distances and a block SSIM. A score of 0 means the output
+looks identical to the source, values towards 1 mean it looks nothing alike.
+"""
+import asyncio
+from typing import Dict, List, Optional, Tuple
+import ffmpeg
+import numpy as np
+from config import settings
+from utils.video_processing import _niced, _terminate, generate_variants, get_video_info
+
+# Analysis frame size: 8x9 blocks of 8 pixels for dHash, halved to 32x36 for pHash
+FRAME_HEIGHT, FRAME_WIDTH = 64, 72
+SSIM_BLOCK = 8
+_SSIM_C1 = (0.01 * 255) ** 2
+_SSIM_C2 = (0.03 * 255) ** 2
+
+
+async def read_gray_frames(video_path: str, samples: Optional[int] = None) -> np.ndarray:
+    """
+    Decode `samples` evenly spaced frames as FRAME_HEIGHT x FRAME_WIDTH grayscale
+    through a rawvideo pipe. Returns a (frames, height, width) uint8 array.
+    """
+    samples = samples or settings.UNIQUENESS_SAMPLE_FRAMES
+    info = await get_video_info(video_path)
+    duration = info.get('duration')
+    if not duration:
+        raise RuntimeError(f"Cannot read the duration of {video_path}")
+
+    args = (
+        ffmpeg.input(video_path)
+        .video
+        .filter('fps', fps=f'{samples}/{duration}')
+        .filter('scale', FRAME_WIDTH, FRAME_HEIGHT, flags='area')
+        .output('pipe:', format='rawvideo', pix_fmt='gray', vframes=samples)
+        .compile()
+    )
+    args = args[:1] + ['-v', 'error'] + args[1:]
+    process = await asyncio.create_subprocess_exec(
+        *_niced(args),
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await process.communicate()
+    except BaseException:
+        await _terminate(process)
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(stderr.decode(errors='ignore').strip() or "Frame sampling failed")
+
+    frame_size = FRAME_HEIGHT * FRAME_WIDTH
+    count = len(stdout) // frame_size
+    if not count:
+        raise RuntimeError(f"No frames decoded from {video_path}")
+    return np.frombuffer(stdout[:count * frame_size], dtype=np.uint8).reshape(count, FRAME_HEIGHT, FRAME_WIDTH)
+
+
+def _block_mean(frames: np.ndarray, block_height: int, block_width: int) -> np.ndarray:
+    """Downscale (n, h, w) frames by averaging block_height x block_width blocks"""
+    n, height, width = frames.shape
+    blocks = frames.reshape(n, height // block_height, block_height, width // block_width, block_width)
+    return blocks.mean(axis=(2, 4))
+
+
+def dhash(frames: np.ndarray) -> np.ndarray:
+    """64-bit difference hash of every frame: brightness gradients of an 8x9 thumbnail"""
+    thumbnails = _block_mean(frames.astype(np.float32), frames.shape[1] // 8, frames.shape[2] // 9)
+    return (thumbnails[:, :, 1:] > thumbnails[:, :, :-1]).reshape(len(frames), -1)
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    """Orthonormal DCT-II basis"""
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2.0 / size)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+def phash(frames: np.ndarray) -> np.ndarray:
+    """64-bit perceptual hash of every frame: low DCT frequencies above their median"""
+    small = _block_mean(frames.astype(np.float32), 2, 2)
+    rows, columns = _dct_matrix(small.shape[1]), _dct_matrix(small.shape[2])
+    coefficients = rows @ small @ columns.T
+    low = coefficients[:, :8, :8].reshape(len(frames), -1)
+    # The DC term only carries the average brightness
+    return low > np.median(low[:, 1:], axis=1, keepdims=True)
+
+
+def block_ssim(source: np.ndarray, output: np.ndarray) -> np.ndarray:
+    """Mean SSIM over non-overlapping SSIM_BLOCK blocks, per frame pair"""
+    def blocks(frames):
+        n, height, width = frames.shape
+        shaped = frames.astype(np.float64).reshape(
+            n, height // SSIM_BLOCK, SSIM_BLOCK, width // SSIM_BLOCK, SSIM_BLOCK
+        )
+        return shaped.transpose(0, 1, 3, 2, 4).reshape(n, -1, SSIM_BLOCK * SSIM_BLOCK)
+
+    x, y = blocks(source), blocks(output)
+    mu_x, mu_y = x.mean(axis=2), y.mean(axis=2)
+    var_x, var_y = x.var(axis=2), y.var(axis=2)
+    covariance = ((x - mu_x[..., None]) * (y - mu_y[..., None])).mean(axis=2)
+    ssim = ((2 * mu_x * mu_y + _SSIM_C1) * (2 * covariance + _SSIM_C2)) / (
+        (mu_x ** 2 + mu_y ** 2 + _SSIM_C1) * (var_x + var_y + _SSIM_C2)
+    )
+    return ssim.mean(axis=1)
+
+
+def uniqueness_score(source: np.ndarray, output: np.ndarray) -> Dict[str, float]:
+    """
+    Compare frames sampled from a source and an output.
+    Returns the mean normalized dHash and pHash distances, the mean SSIM and the
+    combined score (average of both distances and 1 - SSIM), all between 0 and 1.
+    """
+    count = min(len(source), len(output))
+    source, output = source[:count], output[:count]
+    dhash_distance = float(np.mean(dhash(source) != dhash(output)))
+    phash_distance = float(np.mean(phash(source) != phash(output)))
+    ssim = float(np.clip(block_ssim(source, output), -1.0, 1.0).mean())
+    score = (dhash_distance + phash_distance + (1.0 - max(ssim, 0.0))) / 3
+    return {'dhash': dhash_distance, 'phash': phash_distance, 'ssim': ssim, 'score': score}
+
+
+async def measure_outputs(source_path: str, output_paths: List[str]) -> List[float]:
+    """Uniqueness score of every output of one source; the source is decoded once"""
+    source, *outputs = await asyncio.gather(
+        read_gray_frames(source_path), *[read_gray_frames(path) for path in output_paths]
+    )
+    return [uniqueness_score(source, output)['score'] for output in outputs]
+
+
+async def generate_variants_to_target(input_path: str, output_paths: List[str], seed: int,
+                                      modifications: Optional[List[Dict]] = None,
+                                      target: Optional[float] = None) -> Tuple[bool, List[float]]:
+    """
+    generate_variants(), raising the jitter strength of the copies below the `target`
+    score (defaults to settings.UNIQUENESS_TARGET) and re-rendering only those until
+    every copy reaches it or the last round is done. Returns success and the score of each copy.
+    """
+    target = settings.UNIQUENESS_TARGET if target is None else target
+    source = await read_gray_frames(input_path)
+    strength, scores = 1.0, [0.0] * len(output_paths)
+    pending = list(range(len(output_paths)))
+    for _ in range(max(1, settings.UNIQUENESS_TUNE_ROUNDS)):
+        paths = [output_paths[index] for index in pending]
+        if not await generate_variants(input_path, paths, seed, modifications, strength, pending):
+            return False, []
+        outputs = await asyncio.gather(*[read_gray_frames(path) for path in paths])
+        for index, output in zip(pending, outputs):
+            scores[index] = uniqueness_score(source, output)['score']
+        pending = [index for index in pending if scores[index] < target]
+        if not pending:
+            break
+        strength *= 1.5
+    return True, scores
@@ -1,11 +1,30 @@
 import ffmpeg
+import math
 import os
 import random
+import shutil
+import signal
 import string
+import tempfile
+import time
+from collections import OrderedDict, deque
 from typing import Dict, Optional, List, Tuple
 from config import settings
+from utils.job_executor import job_executor, current_thread_budget
+from utils.metrics import STAGE_SECONDS
+from utils.progress import (
+    current_encode_stats,
+    current_progress,
+    parse_duration_line,
+    parse_final_stats,
+    parse_progress_time,
+    parse_speed
+)
 import asyncio
 
+# Bump whenever generated graphs change, so cached results from older versions are not reused
+ENGINE_VERSION = "4"
+
 
 def generate_filename(extension: str = "mp4") -> str:
     """Generate random filename"""
@@ -13,211 +32,1118 @@ def generate_filename(extension: str = "mp4") -> str:
     return f"{random_string}.{extension}"
 
 
+async def _terminate(process, timeout: float = 5.0) -> None:
+    """Terminate an ffmpeg process group, killing it if it does not exit in time"""
+    if process.returncode is not None:
+        return
+    
+    def send(sig):
+        try:
+            if os.name == 'posix':
+                os.killpg(process.pid, sig)
+            else:
+                process.send_signal(sig)
+        except ProcessLookupError:
+            pass
+    
+    send(signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), timeout)
+    except asyncio.TimeoutError:
+        send(signal.SIGKILL if os.name == 'posix' else signal.SIGTERM)
+        await process.wait()
+
+
+def _remove_partial_output(path: str) -> None:
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def thread_args(threads: Optional[int]) -> Tuple[List[str], List[str]]:
+    """Global and output options limiting ffmpeg's filter and encoder threads"""
+    if not threads:
+        return [], []
+    return (
+        ['-filter_threads', str(threads), '-filter_complex_threads', str(threads)],
+        ['-threads', str(threads)]
+    )
+
+
+def _niced(args: List[str]) -> List[str]:
+    """
+    Prefix a command with `nice` so it runs below the bot and API event loops.
+    The process starts niced, so every thread it creates inherits the priority.
+    """
+    if settings.FFMPEG_NICE and shutil.which('nice'):
+        return ['nice', '-n', str(settings.FFMPEG_NICE)] + list(args)
+    return list(args)
+
+
+async def run_ffmpeg(output, extra_args: Optional[List[str]] = None,
+                     duration: Optional[float] = None, threads: Optional[int] = None,
+                     pass_fds: Tuple[int, ...] = ()) -> None:
+    """
+    Run a compiled ffmpeg-python output as an async subprocess.
+    `extra_args` are inserted right before the output path (e.g. repeated -metadata options).
+    When a progress stream is set in `current_progress`, ffmpeg's -progress output is
+    published to it; `duration` is the expected output length used for the percentage.
+    When a list is set in `current_encode_stats`, the final stats of a successful run
+    (frames, fps, bitrate, speed, dropped frames, ...) are appended to it.
+    `threads` defaults to the thread budget the executor gave the current job.
+    `pass_fds` are pipe ends handed to ffmpeg (as pipe:N); they are closed here once it started or failed to.
+    """
+    threads = threads or current_thread_budget.get()
+    global_args, output_args = thread_args(threads)
+    try:
+        # Compiled without overwrite_output() so the output path stays the last argument
+        args = output.compile()
+    except BaseException:
+        for fd in pass_fds:
+            os.close(fd)
+        raise
+    args = args[:1] + ['-y'] + global_args + args[1:-1] + output_args + list(extra_args or []) + args[-1:]
+    args = args[:1] + ['-progress', 'pipe:1', '-nostats'] + args[1:]
+    
+    progress = current_progress.get()
+    if progress:
+        process_id = progress.start_process(duration)
+    
+    finished = False
+    try:
+        started_at = time.monotonic()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *_niced(args),
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                # Own process group, so cancelling kills ffmpeg together with anything it spawned
+                start_new_session=os.name == 'posix',
+                pass_fds=pass_fds
+            )
+        finally:
+            # Only the child may hold the pipe ends, otherwise readers never see EOF
+            for fd in pass_fds:
+                os.close(fd)
+        stderr_tail = deque(maxlen=20)
+        
+        async def read_stderr():
+            async for line in process.stderr:
+                line = line.decode(errors='ignore').rstrip()
+                stderr_tail.append(line)
+                if progress and not duration:
+                    input_duration = parse_duration_line(line)
+                    if input_duration:
+                        progress.set_duration(process_id, input_duration)
+        
+        final_block = {}
+        
+        async def read_progress():
+            # -progress writes key=value lines in blocks terminated by progress=continue|end
+            nonlocal final_block
+            block = {}
+            async for line in process.stdout:
+                key, _, value = line.decode(errors='ignore').strip().partition('=')
+                block[key] = value
+                if key == 'progress':
+                    if progress:
+                        fps = block.get('fps')
+                        progress.update_process(
+                            process_id,
+                            out_time=parse_progress_time(block.get('out_time', '')),
+                            speed=parse_speed(block.get('speed', '')),
+                            fps=float(fps) if fps and fps != 'N/A' else None
+                        )
+                    final_block, block = block, {}
+        
+        try:
+            await asyncio.gather(read_stderr(), read_progress())
+            await process.wait()
+        except BaseException:
+            # Cancelled: stop the encode and drop its partial output
+            await _terminate(process)
+            _remove_partial_output(args[-1])
+            raise
+        
+        if process.returncode != 0:
+            _remove_partial_output(args[-1])
+            error = [line for line in stderr_tail if line.strip()]
+            raise RuntimeError(error[-1] if error else f"ffmpeg exited with code {process.returncode}")
+        finished = True
+    finally:
+        if progress:
+            # A failed or cancelled run must not hold the request's progress back
+            if finished:
+                progress.finish_process(process_id)
+            else:
+                progress.drop_process(process_id)
+    
+    encode_stats = current_encode_stats.get()
+    if encode_stats is not None and final_block:
+        stats = parse_final_stats(final_block)
+        stats.update(started_at=started_at, finished_at=time.monotonic(), threads=threads)
+        encode_stats.append(stats)
+
+
+def _stream_rotation(video_stream: Dict) -> int:
+    """Counter-clockwise display rotation of a probed video stream"""
+    for side_data in video_stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            return int(side_data['rotation'])
+    return -int(video_stream.get('tags', {}).get('rotate', 0))
+
+
+async def get_keyframe_times(video_path: str) -> List[float]:
+    """Get keyframe timestamps of the first video stream (demux only, no decoding)"""
+    process = await asyncio.create_subprocess_exec(
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', video_path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    stdout, _ = await process.communicate()
+    
+    times = []
+    for line in stdout.decode(errors='ignore').splitlines():
+        parts = line.split(',')
+        if len(parts) >= 2 and 'K' in parts[1] and parts[0] not in ('', 'N/A'):
+            times.append(float(parts[0]))
+    return sorted(times)
+
+
+def is_stream_copy_chain(modifications: List[Dict]) -> bool:
+    """Whether a modification chain can be served by remuxing without re-encoding"""
+    return bool(modifications) and all(
+        mod['type'] in STREAM_COPY_MODIFICATIONS and
+        (mod['type'] != 'rotate' or mod['angle'] % 90 == 0)
+        for mod in modifications
+    )
+
+
+def _metadata_args(modifications: List[Dict]) -> Tuple[Dict, List[str]]:
+    """Collect output options and -metadata arguments for metadata modifications"""
+    options = {}
+    extra_args = []
+    for mod in modifications:
+        if mod['type'] != 'metadata':
+            continue
+        if mod.get('strip'):
+            options['map_metadata'] = -1
+        for key, value in mod.get('tags', {}).items():
+            extra_args += ['-metadata', f'{key}={value}']
+    return options, extra_args
+
+
+async def _remux_modifications(input_path: str, output_path: str, modifications: List[Dict],
+                               info: Dict) -> None:
+    """Apply a stream-copy chain: rotation through the display matrix plus metadata"""
+    input_options = {}
+    angle = sum(mod['angle'] for mod in modifications if mod['type'] == 'rotate')
+    if angle % 360:
+        # display_rotation is counter-clockwise, the bot's angles are clockwise
+        input_options['display_rotation'] = (info.get('rotation', 0) - angle) % 360
+    
+    options, extra_args = _metadata_args(modifications)
+    stream = ffmpeg.input(input_path, **input_options)
+    output = ffmpeg.output(stream, output_path, c='copy', **options)
+    await run_ffmpeg(output, extra_args, duration=info.get('duration'))
+
+
+# (absolute path, mtime, size) -> probe result, least recently used first
+_probe_cache: 'OrderedDict[Tuple[str, int, int], Dict]' = OrderedDict()
+
+
+def _probe_key(video_path: str) -> Tuple[str, int, int]:
+    """Identity of one version of a file; rewriting it changes the key"""
+    stat = os.stat(video_path)
+    return os.path.abspath(video_path), stat.st_mtime_ns, stat.st_size
+
+
+def _probe_video(video_path: str) -> Dict:
+    """Run ffprobe and extract the fields the engine uses"""
+    probe = ffmpeg.probe(video_path)
+    video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
+    audio_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'audio'), None)
+    
+    info = {
+        'duration': float(probe['format']['duration']),
+        'size': int(probe['format']['size']),
+        'width': int(video_stream['width']) if video_stream else 0,
+        'height': int(video_stream['height']) if video_stream else 0,
+        'has_audio': audio_stream is not None,
+        'video_codec': video_stream.get('codec_name') if video_stream else None,
+        'pix_fmt': video_stream.get('pix_fmt') if video_stream else None,
+        'fps': video_stream.get('r_frame_rate') if video_stream else None,
+        'rotation': _stream_rotation(video_stream) if video_stream else 0,
+        'audio_codec': audio_stream.get('codec_name') if audio_stream else None,
+        'sample_rate': audio_stream.get('sample_rate') if audio_stream else None,
+        'channels': audio_stream.get('channels') if audio_stream else None
+    }
+    return info
+
+
 async def get_video_info(video_path: str) -> Dict:
-    """Get video information"""
+    """
+    Get video information.
+    Results are kept in an LRU keyed by path, mtime and size, so each version of a file
+    is probed once however many steps ask for it.
+    """
     try:
-        probe = ffmpeg.probe(video_path)
-        video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
-        audio_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'audio'), None)
-        
-        info = {
-            'duration': float(probe['format']['duration']),
-            'size': int(probe['format']['size']),
-            'width': int(video_stream['width']) if video_stream else 0,
-            'height': int(video_stream['height']) if video_stream else 0,
-            'has_audio': audio_stream is not None
-        }
-        return info
+        key = _probe_key(video_path)
+        info = _probe_cache.get(key)
+        if info is None:
+            with STAGE_SECONDS.time(stage='probe'):
+                info = await asyncio.to_thread(_probe_video, video_path)
+            _probe_cache[key] = info
+            while len(_probe_cache) > settings.PROBE_CACHE_SIZE:
+                _probe_cache.popitem(last=False)
+        else:
+            _probe_cache.move_to_end(key)
+        return dict(info)
     except Exception as e:
         print(f"Error getting video info: {e}")
         return {}
 
 
-async def change_video_speed(input_path: str, output_path: str, speed: float = 1.5) -> bool:
-    """Change video playback speed"""
+# Filter presets selectable from the bot and desktop UIs: name -> (ffmpeg filter, options)
+VIDEO_FILTERS = {
+    'hue': ('hue', {'s': 0.5}),
+    'brightness': ('eq', {'brightness': 0.1}),
+    'contrast': ('eq', {'contrast': 1.5}),
+    'saturation': ('eq', {'saturation': 1.5}),
+    'blur': ('boxblur', {'luma_radius': 2, 'luma_power': 1}),
+    'sharpen': ('unsharp', {'lx': 5, 'ly': 5, 'la': 1.0, 'cx': 5, 'cy': 5, 'ca': 0.0}),
+    'grayscale': ('hue', {'s': 0}),
+    'sepia': ('colorchannelmixer', {
+        'rr': .393, 'rg': .769, 'rb': .189,
+        'gr': .349, 'gg': .686, 'gb': .168,
+        'br': .272, 'bg': .534, 'bb': .131
+    }),
+    'negative': ('negate', {}),
+    'noise': ('noise', {'alls': 20, 'allf': 't+u'})
+}
+
+
+# Max distance in seconds between a trim point and a keyframe for a stream-copy cut
+KEYFRAME_TOLERANCE = 0.05
+
+# Modifications that only touch container-level data and never need a re-encode
+STREAM_COPY_MODIFICATIONS = {'rotate', 'metadata'}
+
+# Modifications that filter each stream; audio no modification touches is copied.
+# Every audio modification also filters the video, so video is always re-encoded
+VIDEO_MODIFICATIONS = {'speed', 'filter', 'scale', 'rotate', 'crop', 'text', 'adjust', 'noise'}
+AUDIO_MODIFICATIONS = {'speed'}
+
+# Audio codecs the mp4 muxer accepts, so they can be copied into the output as they are
+MP4_AUDIO_CODECS = {'aac', 'mp3', 'alac', 'opus', 'ac3', 'eac3', 'flac'}
+
+# Speed multipliers accepted from the UIs
+MIN_SPEED = 0.25
+MAX_SPEED = 4.0
+
+
+def _rotate(video, angle: int):
+    """Rotate a video stream clockwise by a multiple of 90 degrees"""
+    angle = angle % 360
+    if angle == 90:
+        return video.filter('transpose', 1)
+    if angle == 180:
+        return video.filter('hflip').filter('vflip')
+    if angle == 270:
+        return video.filter('transpose', 2)
+    return video
+
+
+def atempo_chain(audio, factor: float):
+    """Change audio tempo by any factor, chaining atempo filters that each stay within 0.5-2.0"""
+    while factor > 2.0:
+        audio = audio.filter('atempo', 2.0)
+        factor /= 2.0
+    while factor < 0.5:
+        audio = audio.filter('atempo', 0.5)
+        factor /= 0.5
+    return audio.filter('atempo', factor)
+
+
+def output_audio_codec(info: Dict, modifications: List[Dict]) -> Optional[str]:
+    """
+    Audio codec for re-encoding a chain: 'copy' when only the video is filtered,
+    None for silent inputs.
+    """
+    types = {mod['type'] for mod in modifications}
+    if not info.get('has_audio', True):
+        return None
+    if types & VIDEO_MODIFICATIONS and not types & AUDIO_MODIFICATIONS \
+            and info.get('audio_codec') in MP4_AUDIO_CODECS:
+        return 'copy'
+    return 'aac'
+
+
+def build_modification_graph(stream, modifications: List[Dict], has_audio: bool = True):
+    """
+    Compile a list of modifications into a single filter graph.
+    Returns (video, audio) output streams; audio is None when the input has none.
+    """
+    return apply_chain(stream.video, stream.audio if has_audio else None, modifications)
+
+
+def apply_chain(video, audio, modifications: List[Dict]):
+    """Append the filters of a modification chain to a video and an optional audio stream"""
+    for mod in modifications:
+        mod_type = mod['type']
+        
+        if mod_type == 'speed':
+            video = video.filter('setpts', f'{1.0 / mod["value"]}*PTS')
+            if audio is not None:
+                audio = atempo_chain(audio, mod['value'])
+        elif mod_type == 'filter':
+            filter_name, options = VIDEO_FILTERS.get(mod['value'], VIDEO_FILTERS['hue'])
+            video = video.filter(filter_name, **options)
+        elif mod_type == 'scale':
+            video = video.filter('scale', mod['width'], mod['height'])
+        elif mod_type == 'rotate':
+            video = _rotate(video, mod['angle'])
+        elif mod_type == 'crop':
+            video = video.crop(mod.get('x', 0), mod.get('y', 0), mod['width'], mod['height'])
+        elif mod_type == 'adjust':
+            video = video.filter(
+                'eq', brightness=mod.get('brightness', 0), contrast=mod.get('contrast', 1),
+                saturation=mod.get('saturation', 1)
+            ).filter('hue', h=mod.get('hue', 0))
+        elif mod_type == 'noise':
+            video = video.filter('noise', alls=mod['strength'], allf='t')
+        elif mod_type == 'text':
+            video = video.drawtext(
+                text=mod['value'],
+                x=mod.get('x', 10),
+                y=mod.get('y', 10),
+                fontsize=mod.get('fontsize', 24),
+                fontcolor=mod.get('fontcolor', 'white'),
+                box=1,
+                boxcolor='black@0.5',
+                boxborderw=5
+            )
+    
+    return video, audio
+
+
+def segment_worker_count() -> int:
+    """Number of chunks encoded at once by segment-parallel encoding"""
+    if settings.SEGMENT_WORKERS > 0:
+        return settings.SEGMENT_WORKERS
+    # Stay within the job's thread budget: about two threads per chunk encoder
+    return max(2, (current_thread_budget.get() or os.cpu_count() or 1) // 2)
+
+
+def use_segmented_encoding(info: Dict, modifications: List[Dict]) -> bool:
+    """Whether an input is long enough to be worth splitting across cores"""
+    return (
+        settings.SEGMENT_ENCODING_ENABLED
+        and bool(modifications)
+        and (info.get('duration') or 0) >= settings.SEGMENT_MIN_DURATION
+    )
+
+
+async def split_at_keyframes(input_path: str, output_dir: str, segment_duration: float) -> List[str]:
+    """
+    Split the video stream into chunks by stream copy.
+    The segment muxer only cuts on keyframes, so chunks are about `segment_duration` long.
+    """
+    pattern = os.path.join(output_dir, 'chunk_%05d.mp4')
+    output = ffmpeg.output(
+        ffmpeg.input(input_path).video, pattern,
+        c='copy', f='segment', segment_time=segment_duration, reset_timestamps=1
+    )
+    await run_ffmpeg(output)
+    return sorted(
+        os.path.join(output_dir, name) for name in os.listdir(output_dir) if name.startswith('chunk_')
+    )
+
+
+async def encode_segmented(input_path: str, output_path: str, modifications: List[Dict],
+                           info: Dict, workers: Optional[int] = None) -> None:
+    """
+    Apply a modification chain to a long video using several encoder processes.
+    The video is split at keyframes, chunks are encoded in parallel and joined by stream copy.
+    Audio is processed in one piece to avoid gaps at chunk boundaries (or copied when the
+    chain leaves it alone), then muxed back.
+    """
+    work_dir = tempfile.mkdtemp(prefix='segments_', dir=settings.TEMP_VIDEO_DIR)
+    try:
+        chunks = await split_at_keyframes(input_path, work_dir, settings.SEGMENT_DURATION)
+        if not chunks:
+            raise RuntimeError("Splitting produced no chunks")
+        
+        workers = workers or segment_worker_count()
+        semaphore = asyncio.Semaphore(workers)
+        # Chunks share the job's thread budget
+        chunk_threads = max(1, (current_thread_budget.get() or os.cpu_count() or 1) // workers)
+        
+        async def encode_chunk(chunk_path: str) -> str:
+            encoded_path = os.path.join(work_dir, 'encoded_' + os.path.basename(chunk_path))
+            video, _ = build_modification_graph(ffmpeg.input(chunk_path), modifications, has_audio=False)
+            async with semaphore:
+                await run_ffmpeg(ffmpeg.output(video, encoded_path, vcodec='libx264'), threads=chunk_threads)
+            return encoded_path
+        
+        acodec = output_audio_codec(info, modifications)
+        
+        async def encode_audio() -> Optional[str]:
+            if acodec is None:
+                return None
+            if acodec == 'copy':
+                # Untouched audio is muxed straight from the input
+                return input_path
+            audio_path = os.path.join(work_dir, 'audio.m4a')
+            _, audio = build_modification_graph(ffmpeg.input(input_path), modifications, has_audio=True)
+            await run_ffmpeg(ffmpeg.output(audio, audio_path, acodec='aac'))
+            return audio_path
+        
+        encoded = await asyncio.gather(*[encode_chunk(chunk) for chunk in chunks], encode_audio())
+        encoded_chunks, audio_path = encoded[:-1], encoded[-1]
+        
+        video_path = os.path.join(work_dir, 'video.mp4')
+        if not await concatenate_videos(encoded_chunks, video_path, stream_copy=True):
+            raise RuntimeError("Joining encoded chunks failed")
+        
+        options, extra_args = _metadata_args(modifications)
+        streams = [ffmpeg.input(video_path).video]
+        if audio_path:
+            streams.append(ffmpeg.input(audio_path).audio)
+        await run_ffmpeg(ffmpeg.output(*streams, output_path, c='copy', **options), extra_args)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def output_duration(info: Dict, modifications: List[Dict]) -> Optional[float]:
+    """Expected output length of a modification chain applied to a probed input"""
+    duration = info.get('duration')
+    if not duration:
+        return None
+    for mod in modifications:
+        if mod['type'] == 'speed':
+            duration /= mod['value']
+    return duration
+
+
+MEZZANINE_SAMPLE_RATE = 48000
+
+
+def mezzanine_options() -> Dict:
+    """Encoder options shared by every mezzanine segment"""
+    return {
+        'vcodec': 'libx264',
+        'pix_fmt': 'yuv420p',
+        'g': settings.MEZZANINE_GOP,
+        'keyint_min': settings.MEZZANINE_GOP,
+        'sc_threshold': 0,
+        'video_track_timescale': 90000,
+        'acodec': 'aac',
+        'ar': MEZZANINE_SAMPLE_RATE,
+        'ac': 2
+    }
+
+
+def mezzanine_size(sizes: List[Tuple[int, int]]) -> Tuple[int, int]:
+    """
+    Mezzanine frame for segments of these sizes: MEZZANINE_WIDTH x MEZZANINE_HEIGHT turned
+    to the orientation most of them have, ties going to the first one that is not square
+    """
+    long_side = max(settings.MEZZANINE_WIDTH, settings.MEZZANINE_HEIGHT)
+    short_side = min(settings.MEZZANINE_WIDTH, settings.MEZZANINE_HEIGHT)
+    portrait = sum(1 for width, height in sizes if height > width)
+    landscape = sum(1 for width, height in sizes if width > height)
+    if portrait == landscape:
+        oriented = [height > width for width, height in sizes if width != height]
+        vertical = oriented[0] if oriented else False
+    else:
+        vertical = portrait > landscape
+    return (short_side, long_side) if vertical else (long_side, short_side)
+
+
+async def choose_mezzanine_size(groups: List[Tuple[List[str], List[Dict]]]) -> Tuple[int, int]:
+    """mezzanine_size() of the videos of (paths, modifications) groups as their modifications leave them"""
+    sizes = []
+    for paths, modifications in groups:
+        for path in paths:
+            sizes.append(output_size(await get_video_info(path), modifications))
+    return mezzanine_size(sizes)
+
+
+def build_mezzanine_graph(video, audio, duration: Optional[float] = None,
+                          size: Optional[Tuple[int, int]] = None):
+    """
+    Normalize streams to the mezzanine profile (resolution, fps, pixel format, audio layout).
+    `size` is the frame, see mezzanine_size(); it defaults to MEZZANINE_WIDTH x MEZZANINE_HEIGHT.
+    Inputs without audio get silence so every segment has the same streams.
+    """
+    width, height = size or (settings.MEZZANINE_WIDTH, settings.MEZZANINE_HEIGHT)
+    video = (
+        video
+        .filter('scale', width, height, force_original_aspect_ratio='decrease')
+        .filter('pad', width, height, '(ow-iw)/2', '(oh-ih)/2')
+        .filter('setsar', 1)
+        .filter('fps', settings.MEZZANINE_FPS)
+        .filter('format', 'yuv420p')
+    )
+    if audio is None:
+        silence = ffmpeg.input(f'anullsrc=r={MEZZANINE_SAMPLE_RATE}:cl=stereo', f='lavfi')
+        audio = silence.audio.filter('atrim', duration=duration or 1)
+    audio = (
+        audio
+        .filter('aresample', MEZZANINE_SAMPLE_RATE)
+        .filter('aformat', sample_fmts='fltp', channel_layouts='stereo')
+    )
+    return video, audio
+
+
+async def apply_modifications(input_path: str, output_path: str, modifications: List[Dict],
+                              stream_copy: Optional[bool] = None, mezzanine: bool = False,
+                              segmented: Optional[bool] = None,
+                              frame_size: Optional[Tuple[int, int]] = None) -> bool:
+    """
+    Apply a whole modification chain with a single decode and a single encode.
+    Chains that only rotate or touch metadata are remuxed with -c copy instead,
+    unless `stream_copy` is False (defaults to settings.STREAM_COPY_ENABLED).
+    With `mezzanine` the output is also normalized to the mezzanine profile in the same encode,
+    in a `frame_size` frame.
+    Long inputs are encoded in parallel chunks unless `segmented` is False.
+    """
     try:
-        video_speed = 1.0 / speed
-        audio_speed = speed
+        if not modifications and not mezzanine:
+            shutil.copyfile(input_path, output_path)
+            return True
+        
+        info = await get_video_info(input_path)
+        
+        if stream_copy is None:
+            stream_copy = settings.STREAM_COPY_ENABLED
+        if stream_copy and not mezzanine and is_stream_copy_chain(modifications):
+            try:
+                await _remux_modifications(input_path, output_path, modifications, info)
+                return True
+            except Exception as e:
+                print(f"Stream copy failed, re-encoding: {e}")
+        
+        if segmented is None:
+            segmented = use_segmented_encoding(info, modifications)
+        if segmented and not mezzanine:
+            try:
+                await encode_segmented(input_path, output_path, modifications, info)
+                return True
+            except Exception as e:
+                print(f"Segmented encoding failed, encoding in one piece: {e}")
         
         stream = ffmpeg.input(input_path)
-        video = stream.video.filter('setpts', f'{video_speed}*PTS')
-        audio = stream.audio.filter('atempo', audio_speed)
+        video, audio = build_modification_graph(stream, modifications, info.get('has_audio', True))
         
-        output = ffmpeg.output(video, audio, output_path, vcodec='libx264', acodec='aac')
-        await asyncio.get_event_loop().run_in_executor(None, output.run)
+        options, extra_args = _metadata_args(modifications)
+        duration = output_duration(info, modifications)
+        if mezzanine:
+            video, audio = build_mezzanine_graph(video, audio, duration, frame_size)
+            output = ffmpeg.output(video, audio, output_path, **mezzanine_options(), **options)
+        else:
+            # Audio the chain does not filter is copied instead of re-encoded
+            acodec = output_audio_codec(info, modifications)
+            if acodec == 'copy':
+                audio = stream.audio
+            if audio is not None:
+                output = ffmpeg.output(video, audio, output_path, vcodec='libx264', acodec=acodec, **options)
+            else:
+                output = ffmpeg.output(video, output_path, vcodec='libx264', **options)
+        await run_ffmpeg(output, extra_args, duration=duration)
         return True
     except Exception as e:
-        print(f"Error changing video speed: {e}")
+        print(f"Error applying modifications: {e}")
         return False
 
 
+async def apply_modifications_to_group(video_paths: List[str], modifications: List[Dict],
+                                       prefix: str = "temp", mezzanine: bool = False,
+                                       frame_size: Optional[Tuple[int, int]] = None) -> List[str]:
+    """
+    Apply the same modification chain to every video of a group.
+    Each video is queued as a separate job on the shared executor.
+    Videos without modifications are returned unchanged unless they must be
+    normalized to the mezzanine profile (in a `frame_size` frame).
+    """
+    if not modifications and not mezzanine:
+        return list(video_paths)
+    
+    processed_paths = [
+        os.path.join(settings.TEMP_VIDEO_DIR, f"{prefix}_{idx}_{generate_filename()}")
+        for idx in range(len(video_paths))
+    ]
+    try:
+        results = await asyncio.gather(*[
+            job_executor.submit(apply_modifications, video_path, output_path, modifications,
+                                mezzanine=mezzanine, frame_size=frame_size)
+            for video_path, output_path in zip(video_paths, processed_paths)
+        ])
+        
+        for idx, success in enumerate(results):
+            if not success:
+                raise RuntimeError(f"Failed to process video {idx + 1}")
+    except BaseException:
+        # Failed or cancelled: outputs of the videos that did finish are useless
+        for path in processed_paths:
+            _remove_partial_output(path)
+        raise
+    return processed_paths
+
+
+async def change_video_speed(input_path: str, output_path: str, speed: float = 1.5) -> bool:
+    """Change video playback speed"""
+    return await apply_modifications(input_path, output_path, [{'type': 'speed', 'value': speed}])
+
+
 async def scale_video(input_path: str, output_path: str, width: int = 1280, height: int = 720) -> bool:
     """Scale video to specified dimensions"""
-    try:
-        stream = ffmpeg.input(input_path)
-        stream = ffmpeg.filter(stream, 'scale', width, height)
-        output = ffmpeg.output(stream, output_path, vcodec='libx264', acodec='aac')
-        await asyncio.get_event_loop().run_in_executor(None, output.run)
-        return True
-    except Exception as e:
-        print(f"Error scaling video: {e}")
-        return False
+    return await apply_modifications(
+        input_path, output_path, [{'type': 'scale', 'width': width, 'height': height}]
+    )
 
 
 async def apply_filter(input_path: str, output_path: str, filter_name: str = 'hue') -> bool:
     """Apply video filter"""
+    return await apply_modifications(input_path, output_path, [{'type': 'filter', 'value': filter_name}])
+
+
+async def crop_video(input_path: str, output_path: str, width: int, height: int, x: int = 0, y: int = 0) -> bool:
+    """Crop video to specified dimensions"""
+    return await apply_modifications(
+        input_path, output_path, [{'type': 'crop', 'width': width, 'height': height, 'x': x, 'y': y}]
+    )
+
+
+async def rotate_video(input_path: str, output_path: str, angle: int = 90,
+                       stream_copy: Optional[bool] = None) -> bool:
+    """Rotate video by specified angle"""
+    return await apply_modifications(
+        input_path, output_path, [{'type': 'rotate', 'angle': angle}], stream_copy
+    )
+
+
+async def strip_metadata(input_path: str, output_path: str, tags: Optional[Dict[str, str]] = None,
+                         stream_copy: Optional[bool] = None) -> bool:
+    """Remove container metadata and optionally write new tags"""
+    return await apply_modifications(
+        input_path, output_path, [{'type': 'metadata', 'strip': True, 'tags': tags or {}}], stream_copy
+    )
+
+
+async def add_text_to_video(input_path: str, output_path: str, text: str, 
+                           x: int = 10, y: int = 10, fontsize: int = 24, 
+                           fontcolor: str = 'white') -> bool:
+    """Add text overlay to video"""
+    return await apply_modifications(input_path, output_path, [{
+        'type': 'text', 'value': text, 'x': x, 'y': y,
+        'fontsize': fontsize, 'fontcolor': fontcolor
+    }])
+
+
+async def trim_video(input_path: str, output_path: str, start_time: float = 0, end_time: float = None,
+                     stream_copy: Optional[bool] = None) -> bool:
+    """
+    Trim video to specified time range.
+    When the start falls on a keyframe the cut is a remux with -c copy.
+    """
     try:
-        stream = ffmpeg.input(input_path)
+        input_options = {'ss': start_time}
+        if end_time:
+            input_options['t'] = end_time - start_time
+        
+        if stream_copy is None:
+            stream_copy = settings.STREAM_COPY_ENABLED
+        if stream_copy:
+            keyframes = [0.0] if start_time == 0 else await get_keyframe_times(input_path)
+            if any(abs(t - start_time) <= KEYFRAME_TOLERANCE for t in keyframes):
+                stream = ffmpeg.input(input_path, **input_options)
+                output = ffmpeg.output(stream, output_path, c='copy', avoid_negative_ts='make_zero')
+                await run_ffmpeg(output, duration=input_options.get('t'))
+                return True
         
-        filters = {
-            'hue': 'hue=s=0.5',
-            'brightness': 'eq=brightness=0.1',
-            'contrast': 'eq=contrast=1.5',
-            'saturation': 'eq=saturation=1.5',
-            'blur': 'boxblur=2:1',
-            'sharpen': 'unsharp=5:5:1.0:5:5:0.0',
-            'grayscale': 'hue=s=0',
-            'sepia': 'colorchannelmixer=.393:.769:.189:0:.349:.686:.168:0:.272:.534:.131',
-            'negative': 'negate',
-            'noise': 'noise=alls=20:allf=t+u'
-        }
-        
-        filter_str = filters.get(filter_name, 'hue=s=0.5')
-        stream = ffmpeg.filter(stream, 'split').filter(filter_str)
+        stream = ffmpeg.input(input_path, **input_options)
         output = ffmpeg.output(stream, output_path, vcodec='libx264', acodec='aac')
-        await asyncio.get_event_loop().run_in_executor(None, output.run)
+        await run_ffmpeg(output, duration=input_options.get('t'))
         return True
     except Exception as e:
-        print(f"Error applying filter: {e}")
+        print(f"Error trimming video: {e}")
         return False
 
 
-async def crop_video(input_path: str, output_path: str, width: int, height: int, x: int = 0, y: int = 0) -> bool:
-    """Crop video to specified dimensions"""
+def variant_modifications(seed: int, index: int, size: Tuple[int, int],
+                          strength: float = 1.0) -> List[Dict]:
+    """
+    Seeded random jitter that makes variant `index` of a `size` video unique:
+    a slight crop scaled back to the original size, color, grain and speed changes
+    and a new comment tag. The same seed and index always give the same chain;
+    `strength` scales how far every change may go.
+    """
+    rng = random.Random(f'{seed}:{index}')
+    width, height = _even(size[0]), _even(size[1])
+    shrink = min(0.2, rng.uniform(0.01, 0.04) * strength)
+    crop_width, crop_height = _even(width * (1 - shrink)), _even(height * (1 - shrink))
+    return [
+        {'type': 'crop', 'width': crop_width, 'height': crop_height,
+         'x': rng.randint(0, width - crop_width), 'y': rng.randint(0, height - crop_height)},
+        {'type': 'scale', 'width': width, 'height': height},
+        {'type': 'adjust', 'brightness': round(rng.uniform(-0.03, 0.03) * strength, 3),
+         'contrast': round(1 + rng.uniform(-0.03, 0.03) * strength, 3),
+         'saturation': round(1 + rng.uniform(-0.05, 0.05) * strength, 3),
+         'hue': round(rng.uniform(-4, 4) * strength, 1)},
+        {'type': 'noise', 'strength': rng.randint(1, max(1, round(4 * strength)))},
+        {'type': 'speed', 'value': round(1 + max(-0.1, min(0.1, rng.uniform(-0.02, 0.02) * strength)), 3)},
+        {'type': 'metadata', 'strip': True, 'tags': {'comment': '%032x' % rng.getrandbits(128)}}
+    ]
+
+
+def preview_graph(stream, modifications: List[Dict], has_audio: bool = True, height: int = 360):
+    """The modification chain followed by a downscale to at most `height` lines"""
+    video, audio = build_modification_graph(stream, modifications, has_audio)
+    return video.filter('scale', -2, f'min({height},ih)'), audio
+
+
+async def render_preview(input_path: str, output_path: str, modifications: List[Dict],
+                         variant_seed: Optional[int] = None) -> bool:
+    """
+    Render a short low-resolution clip of a modification chain so it can be checked before
+    the full encode: settings.PREVIEW_SECONDS from the middle of the input, scaled down to
+    settings.PREVIEW_HEIGHT and encoded with the fastest x264 preset.
+    With `variant_seed` the jitter of the first unique copy is shown as well.
+    """
     try:
-        stream = ffmpeg.input(input_path)
-        stream = ffmpeg.crop(stream, x, y, width, height)
-        output = ffmpeg.output(stream, output_path, vcodec='libx264', acodec='aac')
-        await asyncio.get_event_loop().run_in_executor(None, output.run)
+        info = await get_video_info(input_path)
+        duration = info.get('duration') or 0
+        seconds = min(settings.PREVIEW_SECONDS, duration) if duration else settings.PREVIEW_SECONDS
+        if variant_seed is not None:
+            modifications = modifications + variant_modifications(
+                variant_seed, 0, output_size(info, modifications)
+            )
+        
+        stream = ffmpeg.input(input_path, ss=max(0.0, (duration - seconds) / 2), t=seconds)
+        video, audio = preview_graph(stream, modifications, info.get('has_audio', True), settings.PREVIEW_HEIGHT)
+        options = {'vcodec': 'libx264', 'preset': 'ultrafast', 'crf': 30, 'pix_fmt': 'yuv420p'}
+        if audio is not None:
+            output = ffmpeg.output(video, audio, output_path, acodec='aac', **options)
+        else:
+            output = ffmpeg.output(video, output_path, **options)
+        await run_ffmpeg(output, duration=output_duration({'duration': seconds}, modifications))
         return True
     except Exception as e:
-        print(f"Error cropping video: {e}")
+        print(f"Error rendering preview: {e}")
         return False
 
 
-async def rotate_video(input_path: str, output_path: str, angle: int = 90) -> bool:
-    """Rotate video by specified angle"""
+def _variant_output_options(modifications: List[Dict]) -> Dict:
+    """
+    Metadata of a variant as per-output options. Several outputs share one command line,
+    so the trailing -metadata arguments of _metadata_args cannot be used; each tag becomes
+    its own -metadata:g:N option instead.
+    """
+    options, extra_args = _metadata_args(modifications)
+    # ['-metadata', 'key=value', ...]; a later tag replaces an earlier one with the same key,
+    # and ffmpeg-python sorts options, so only one option per key is passed
+    tags = dict(tag.split('=', 1) for tag in extra_args[1::2])
+    for index, (key, value) in enumerate(tags.items()):
+        options[f'metadata:g:{index}'] = f'{key}={value}'
+    return options
+
+
+async def generate_variants(input_path: str, output_paths: List[str], seed: int,
+                            modifications: Optional[List[Dict]] = None, strength: float = 1.0,
+                            indices: Optional[List[int]] = None) -> bool:
+    """
+    Produce one unique variant per output path from a single decode: the input is split
+    into a branch per variant, each with its own seeded jitter and encoder, in one ffmpeg process.
+    `modifications` are applied to every variant before the jitter. `indices` are the variant
+    numbers of the output paths (default 0, 1, ...), to re-render some copies of a set.
+    """
+    modifications = modifications or []
+    indices = list(range(len(output_paths))) if indices is None else indices
     try:
+        info = await get_video_info(input_path)
+        has_audio = info.get('has_audio', True)
+        size = output_size(info, modifications)
+        count = len(output_paths)
+        
         stream = ffmpeg.input(input_path)
+        base_video, base_audio = build_modification_graph(stream, modifications, has_audio)
+        videos = base_video.split()
+        audios = base_audio.filter_multi_output('asplit', count) if base_audio is not None else None
+        # The encoders share the job's thread budget
+        threads = max(1, (current_thread_budget.get() or os.cpu_count() or 1) // count)
         
-        # FFmpeg rotation: 0=90°CCW, 1=90°CW, 2=90°CCW, 3=90°CW+vflip
-        rotation_map = {
-            90: 1,
-            180: 2,
-            270: 3,
-            -90: 0
-        }
+        outputs, durations = [], []
+        for index, output_path in enumerate(output_paths):
+            jitter = variant_modifications(seed, indices[index], size, strength)
+            chain = modifications + jitter
+            video, audio = apply_chain(videos[index], audios[index] if audios else None, jitter)
+            acodec = output_audio_codec(info, chain)
+            options = dict(_variant_output_options(chain), vcodec='libx264', threads=threads)
+            if audio is not None:
+                outputs.append(ffmpeg.output(video, audio, output_path, acodec=acodec, **options))
+            else:
+                outputs.append(ffmpeg.output(video, output_path, **options))
+            durations.append(output_duration(info, chain) or 0)
         
-        transpose = rotation_map.get(angle % 360, 1)
-        stream = ffmpeg.filter(stream, 'transpose', transpose)
-        output = ffmpeg.output(stream, output_path, vcodec='libx264', acodec='aac')
-        await asyncio.get_event_loop().run_in_executor(None, output.run)
+        try:
+            await run_ffmpeg(ffmpeg.merge_outputs(*outputs), duration=max(durations) or None, threads=threads)
+        except BaseException:
+            # run_ffmpeg only knows about the last output
+            for output_path in output_paths:
+                _remove_partial_output(output_path)
+            raise
         return True
     except Exception as e:
-        print(f"Error rotating video: {e}")
+        print(f"Error generating variants: {e}")
         return False
 
 
-async def add_text_to_video(input_path: str, output_path: str, text: str, 
-                           x: int = 10, y: int = 10, fontsize: int = 24, 
-                           fontcolor: str = 'white') -> bool:
-    """Add text overlay to video"""
-    try:
-        stream = ffmpeg.input(input_path)
-        stream = ffmpeg.drawtext(
-            stream,
-            text=text,
-            x=x,
-            y=y,
-            fontsize=fontsize,
-            fontcolor=fontcolor,
-            box=1,
-            boxcolor='black@0.5',
-            boxborderw=5
+def _even(value: int) -> int:
+    """Round a dimension down to an even number, as yuv420p requires"""
+    return max(2, int(value) - int(value) % 2)
+
+
+def grid_shape(count: int) -> Tuple[int, int]:
+    """Columns and rows of the smallest near-square grid holding `count` videos"""
+    columns = math.ceil(math.sqrt(count))
+    rows = math.ceil(count / columns)
+    return columns, rows
+
+
+def _input_videos(streams: List) -> List:
+    """Video stream of each input; the same file listed twice is read once and split"""
+    repeats = {}
+    for stream in streams:
+        repeats[hash(stream)] = repeats.get(hash(stream), 0) + 1
+
+    splits, videos = {}, []
+    for stream in streams:
+        key = hash(stream)
+        if repeats[key] == 1:
+            videos.append(stream.video)
+            continue
+        if key not in splits:
+            splits[key] = [stream.video.split(), 0]
+        node, used = splits[key]
+        videos.append(node[used])
+        splits[key][1] += 1
+    return videos
+
+
+def build_stack_graph(streams: List, sizes: List[Tuple[int, int]], layout: str = 'horizontal',
+                      duration: Optional[float] = None, fps: str = '30'):
+    """
+    Stack the video of several inputs in one filter graph.
+    horizontal scales every input to the first one's height, vertical to its width,
+    grid fits each input into a cell the size of the first one.
+    All inputs are resampled to `fps`; stacking mixed frame rates has no usable output rate.
+    """
+    width, height = _even(sizes[0][0]), _even(sizes[0][1])
+    inputs = _input_videos(streams)
+
+    if layout == 'horizontal':
+        videos = [v.filter('scale', -2, height).filter('setsar', 1).filter('fps', fps) for v in inputs]
+        return ffmpeg.filter(videos, 'hstack', inputs=len(videos))
+
+    if layout == 'vertical':
+        videos = [v.filter('scale', width, -2).filter('setsar', 1).filter('fps', fps) for v in inputs]
+        return ffmpeg.filter(videos, 'vstack', inputs=len(videos))
+
+    if layout == 'grid':
+        columns, rows = grid_shape(len(streams))
+        videos = [
+            v
+            .filter('scale', width, height, force_original_aspect_ratio='decrease')
+            .filter('pad', width, height, '(ow-iw)/2', '(oh-ih)/2')
+            .filter('setsar', 1)
+            .filter('fps', fps)
+            for v in inputs
+        ]
+        # Empty cells of an incomplete last row are filled with black
+        for _ in range(columns * rows - len(videos)):
+            filler = ffmpeg.input(
+                f'color=c=black:s={width}x{height}:r={fps}:d={duration or 1}', f='lavfi'
+            )
+            videos.append(filler.video.filter('setsar', 1))
+        cells = '|'.join(
+            f'{(i % columns) * width}_{(i // columns) * height}' for i in range(len(videos))
         )
-        output = ffmpeg.output(stream, output_path, vcodec='libx264', acodec='aac')
-        await asyncio.get_event_loop().run_in_executor(None, output.run)
-        return True
-    except Exception as e:
-        print(f"Error adding text to video: {e}")
-        return False
+        return ffmpeg.filter(videos, 'xstack', inputs=len(videos), layout=cells)
+
+    raise ValueError(f"Unknown layout: {layout}")
 
 
-async def trim_video(input_path: str, output_path: str, start_time: float = 0, end_time: float = None) -> bool:
-    """Trim video to specified time range"""
+async def merge_videos(input_paths: List[str], output_path: str, layout: str = 'horizontal') -> bool:
+    """
+    Merge any number of videos side by side, vertically, in a grid,
+    or one after another, with a single encode
+    """
     try:
-        if end_time:
-            duration = end_time - start_time
-            stream = ffmpeg.input(input_path, ss=start_time, t=duration)
-        else:
-            stream = ffmpeg.input(input_path, ss=start_time)
+        if layout == 'sequential':
+            return await concatenate_videos(input_paths, output_path)
         
-        output = ffmpeg.output(stream, output_path, vcodec='libx264', acodec='aac')
-        await asyncio.get_event_loop().run_in_executor(None, output.run)
+        infos = await asyncio.gather(*[get_video_info(path) for path in input_paths])
+        sizes = [output_size(info, []) for info in infos]
+        duration = max(info.get('duration') or 0 for info in infos)
+        
+        streams = [ffmpeg.input(path) for path in input_paths]
+        joined = build_stack_graph(streams, sizes, layout, duration, infos[0].get('fps') or '30')
+        
+        output = ffmpeg.output(joined, output_path, vcodec='libx264')
+        await run_ffmpeg(output, duration=duration)
         return True
     except Exception as e:
-        print(f"Error trimming video: {e}")
+        print(f"Error merging videos: {e}")
         return False
 
 
-async def merge_videos(input_path1: str, input_path2: str, output_path: str, 
-                      layout: str = 'horizontal') -> bool:
-    """Merge two videos side by side or vertically"""
+# Intermediate format for piped stages: streamable container, fast lossless intra codec
+PIPE_OUTPUT_OPTIONS = {'format': 'nut', 'vcodec': 'ffvhuff'}
+
+
+def output_size(info: Dict, modifications: List[Dict]) -> Tuple[int, int]:
+    """Frame size a modification chain produces from a probed input"""
+    width, height = info.get('width') or 1280, info.get('height') or 720
+    if info.get('rotation', 0) % 180:
+        # Decoding applies the display rotation
+        width, height = height, width
+    for mod in modifications:
+        if mod['type'] in ('scale', 'crop'):
+            width, height = mod['width'], mod['height']
+        elif mod['type'] == 'rotate' and mod['angle'] % 180:
+            width, height = height, width
+    return width, height
+
+
+async def run_pipeline(stages: List) -> None:
+    """Run concurrent ffmpeg stages; if one fails or is cancelled, all are stopped"""
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
     try:
-        input1 = ffmpeg.input(input_path1)
-        input2 = ffmpeg.input(input_path2)
-        
-        if layout == 'horizontal':
-            # Side by side
-            joined = ffmpeg.filter([input1, input2], 'hstack')
-        elif layout == 'vertical':
-            # One above the other
-            joined = ffmpeg.filter([input1, input2], 'vstack')
-        else:
-            # Concatenate (one after another)
-            joined = ffmpeg.concat(input1, input2, v=1, a=1)
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def merge_videos_piped(items: List[Tuple[str, List[Dict]]], output_path: str,
+                             layout: str = 'horizontal') -> bool:
+    """
+    Apply each input's modifications and stack the results in one pipeline.
+    Every (input path, modifications) pair runs as its own ffmpeg process writing NUT into a pipe
+    that the merging process reads, so all stages run at once and nothing is written to disk
+    except the final output.
+    """
+    # Pipe ends no stage has taken over yet; a stage cancelled before it starts never closes its own
+    open_fds = set()
+    try:
+        infos = await asyncio.gather(*[get_video_info(path) for path, _ in items])
+        sizes = [output_size(info, mods) for info, (_, mods) in zip(infos, items)]
+        durations = [output_duration(info, mods) or 0 for info, (_, mods) in zip(infos, items)]
+        threads = max(1, (current_thread_budget.get() or os.cpu_count() or 1) // (len(items) + 1))
         
-        output = ffmpeg.output(joined, output_path, vcodec='libx264', acodec='aac')
-        await asyncio.get_event_loop().run_in_executor(None, output.run)
+        async def stage(output, duration, fds):
+            # run_ffmpeg owns the pipe ends from here on
+            open_fds.difference_update(fds)
+            await run_ffmpeg(output, duration=duration, threads=threads, pass_fds=fds)
+        
+        stages, read_fds = [], []
+        for (path, mods), info in zip(items, infos):
+            read_fd, write_fd = os.pipe()
+            open_fds.update((read_fd, write_fd))
+            read_fds.append(read_fd)
+            video, _ = build_modification_graph(ffmpeg.input(path), mods, has_audio=False)
+            producer = ffmpeg.output(video, f'pipe:{write_fd}', **PIPE_OUTPUT_OPTIONS)
+            stages.append((producer, output_duration(info, mods), (write_fd,)))
+        
+        streams = [ffmpeg.input(f'pipe:{fd}', f='nut') for fd in read_fds]
+        joined = build_stack_graph(streams, sizes, layout, max(durations), infos[0].get('fps') or '30')
+        consumer = ffmpeg.output(joined, output_path, vcodec='libx264')
+        stages.append((consumer, max(durations) or None, tuple(read_fds)))
+        
+        await run_pipeline([stage(*args) for args in stages])
         return True
     except Exception as e:
-        print(f"Error merging videos: {e}")
+        print(f"Error merging videos through pipes: {e}")
         return False
+    finally:
+        for fd in open_fds:
+            os.close(fd)
+
+
+def _concat_signature(info: Dict) -> Tuple:
+    """Codec parameters that must match for a stream-copy concat"""
+    return (
+        info.get('video_codec'), info.get('width'), info.get('height'), info.get('pix_fmt'),
+        info.get('fps'), info.get('audio_codec'), info.get('sample_rate'), info.get('channels')
+    )
 
 
-async def concatenate_videos(input_paths: List[str], output_path: str) -> bool:
-    """Concatenate multiple videos one after another"""
+def _same_concat_signature(infos: List[Dict]) -> bool:
+    return all(infos) and len({_concat_signature(info) for info in infos}) == 1
+
+
+async def concatenate_videos(input_paths: List[str], output_path: str,
+                             stream_copy: Optional[bool] = None) -> bool:
+    """
+    Concatenate multiple videos one after another.
+    Inputs with matching codec parameters are joined by the concat demuxer with -c copy,
+    anything else is re-encoded through the concat filter.
+    """
+    concat_file = os.path.join(settings.TEMP_VIDEO_DIR, f'concat_{generate_filename("txt")}')
     try:
-        # Create concat file
-        concat_file = os.path.join(settings.TEMP_VIDEO_DIR, 'concat_list.txt')
-        with open(concat_file, 'w') as f:
-            for path in input_paths:
-                f.write(f"file '{path}'\n")
-        
-        # Use concat demuxer
-        cmd = f'ffmpeg -f concat -safe 0 -i {concat_file} -c copy {output_path}'
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        await process.communicate()
+        if stream_copy is None:
+            stream_copy = settings.STREAM_COPY_ENABLED
         
-        # Clean up
-        if os.path.exists(concat_file):
-            os.remove(concat_file)
+        infos = await asyncio.gather(*[get_video_info(path) for path in input_paths])
+        duration = sum(info.get('duration') or 0 for info in infos) or None
+        
+        if stream_copy and _same_concat_signature(infos):
+            # Paths in the list are resolved relative to the list file, so write them absolute
+            with open(concat_file, 'w') as f:
+                for path in input_paths:
+                    escaped = os.path.abspath(path).replace("'", "'\\''")
+                    f.write(f"file '{escaped}'\n")
+            
+            stream = ffmpeg.input(concat_file, f='concat', safe=0)
+            output = ffmpeg.output(stream, output_path, c='copy')
+            try:
+                await run_ffmpeg(output, duration=duration)
+                return True
+            except Exception as e:
+                print(f"Stream copy concat failed, re-encoding: {e}")
         
-        return process.returncode == 0
+        width = infos[0].get('width') or 1280
+        height = infos[0].get('height') or 720
+        with_audio = all(info.get('has_audio') for info in infos)
+        
+        segments = []
+        for path in input_paths:
+            stream = ffmpeg.input(path)
+            video = (
+                stream.video
+                .filter('scale', width, height, force_original_aspect_ratio='decrease')
+                .filter('pad', width, height, '(ow-iw)/2', '(oh-ih)/2')
+                .filter('setsar', 1)
+            )
+            segments.append(video)
+            if with_audio:
+                segments.append(stream.audio)
+        
+        joined = ffmpeg.concat(*segments, v=1, a=1 if with_audio else 0).node
+        if with_audio:
+            output = ffmpeg.output(joined[0], joined[1], output_path, vcodec='libx264', acodec='aac')
+        else:
+            output = ffmpeg.output(joined[0], output_path, vcodec='libx264')
+        await run_ffmpeg(output, duration=duration)
+        return True
     except Exception as e:
         print(f"Error concatenating videos: {e}")
         return False
+    finally:
+        if os.path.exists(concat_file):
+            os.remove(concat_file)